@@ -49,6 +49,13 @@ def dataseting_main(params, log_level=logging.DEBUG):
     csv_gen_path = os.path.join(gs.PKG_DATA_DIR, f"dataset_gen_{station_name}_"
                                                  f"{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.csv")
 
+    if params.update_profiles_info:
+        logger.info(f"\nStart updating the profiles info table for period: "
+                    f"[{start_date.strftime('%Y-%m-%d')},{end_date.strftime('%Y-%m-%d')}]")
+        dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime().tolist()
+        ds_utils.update_profiles_info(station, dates)
+        logger.info(f"\nDone updating the profiles info table: {ds_utils.get_profiles_info_path(station)}")
+
     if params.do_dataset:
         df_csv_path = csv_gen_path if params.generated_mode else csv_path
         logger.info(f"\nStart doing {mode} dataset for period: "
@@ -123,11 +130,15 @@ def dataseting_main(params, log_level=logging.DEBUG):
 
 # %% Dataset creating helper functions
 def create_dataset(station_name='haifa', start_date=datetime(2017, 9, 1),
-                   end_date=datetime(2017, 9, 2), sample_size='29.5min', list_dates=None):
+                   end_date=datetime(2017, 9, 2), sample_size='29.5min', list_dates=None,
+                   use_profiles_info: bool = True):
     """
     CHOOSE: telescope: far_range , METHOD: Klett_Method
     each sample will have 60 bins (aka 30 mins length)
     path to db:  stationdb_file
+    :param use_profiles_info: If True (default), the info of TROPOS profiles is taken from the profiles info table
+    (see ds_utils.update_profiles_info(), the table is refreshed for the required dates). Otherwise, the profile files
+    are searched and loaded per each row of the database.
     :param list_dates:
     :param sample_size:
     :param station_name:
@@ -176,6 +187,8 @@ def create_dataset(station_name='haifa', start_date=datetime(2017, 9, 1),
     else:
         dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime().tolist()
 
+    profiles_info = ds_utils.update_profiles_info(station, dates) if use_profiles_info else None
+
     full_df = pd.DataFrame()
     for wavelength in tqdm(wavelengths):
         for day_date in dates:
@@ -190,7 +203,8 @@ def create_dataset(station_name='haifa', start_date=datetime(2017, 9, 1),
                                                          f"during {day_date.strftime('%Y-%m-%d')} in '{db_path}'")
                 df['date'] = day_date.strftime('%Y-%m-%d')
 
-                df = ds_utils.add_profiles_values(df, station, day_date, file_type='profiles')
+                df = ds_utils.add_profiles_values(df, station, day_date, file_type='profiles',
+                                                  profiles_info=profiles_info)
                 df = df.rename(
                     {'liconst': 'LC', 'uncertainty_liconst': 'LC_std', 'matched_nc_profile': 'profile_path'},
                     axis='columns')
@@ -672,6 +686,9 @@ def prepare_samples(station, start_date, end_date, top_height=15.3, generated=Fa
 if __name__ == '__main__':
     parser = utils.get_base_arguments()
 
+    parser.add_argument('--update_profiles_info', action='store_true',
+                        help='Whether to create or refresh the table of info extracted from TROPOS profiles')
+
     parser.add_argument('--do_dataset', action='store_true',
                         help='Whether to create a dataset')
 
@@ -1,5 +1,6 @@
 import logging
 import os
+import re
 import sqlite3
 import sys
 from datetime import datetime
@@ -78,8 +79,164 @@ def query_database(query="SELECT * FROM lidar_calibration_constant;",
     return df
 
 
-def add_profiles_values(df, station, day_date, file_type='profiles'):
+def get_info_from_profile_ds(data: xr.Dataset, wavelength: int) -> tuple:
+    """
+    Get the r_0,r_1, and delta_r of the selected wavelength, and the statistics of klett's retrievals.
+    The values are following rebasing according to sea-level height.
+    Note: reference_height in the profile is in meters units
+    :param data: xr.Dataset(). A profile dataset of TROPOS (*_profiles.nc)
+    :param wavelength: wavelength [nm] e.g., for the green channel 532 [nm]
+    :return: tuple of the values ordered as in PROFILES_INFO_COLUMNS
+    """
+    # get altitude to rebase the reference heights according to sea-level-height
+    altitude = data.altitude.item()
+    [r0, r1] = data[f'reference_height_{wavelength}'].values
+    [bin_r0, bin_r1] = [np.argmin(abs(data.height.values - r)) for r in [r0, r1]]
+    delta_r = r1 - r0
+    lr_aeronet = data[f'LR_aeronet_{wavelength}'].fillna('').item()
+    lr_used = 50.0 if ('50.0 [Sr]' in data.aerBsc_klett_532.retrieving_info) else lr_aeronet
+    # TODO: use pd.describe() --> gives count,mean,max,min,std,25%,50%,75% in a single command
+    aerBsc_klett_max = data[f'aerBsc_klett_{wavelength}'].values.max()
+    aerExt_klett_max = aerBsc_klett_max * lr_used if (lr_used != '' and aerBsc_klett_max != '') else ''
+    aerBsc_klett_min = data[f'aerBsc_klett_{wavelength}'].values.min()
+    aerExt_klett_min = aerBsc_klett_min * lr_used if (lr_used != '' and aerBsc_klett_min != '') else ''
+    aerBsc_klett_mean = data[f'aerBsc_klett_{wavelength}'].values.mean()
+    aerExt_klett_mean = aerBsc_klett_mean * lr_used if (lr_used != '' and aerBsc_klett_mean != '') else ''
+    aerBsc_klett_std = data[f'aerBsc_klett_{wavelength}'].values.std()
+    aerExt_klett_std = (lr_used * data[f'aerBsc_klett_{wavelength}'].values).std() if \
+        (lr_used != '' and aerBsc_klett_mean != '') else ''
+    return r0 + altitude, r1 + altitude, delta_r, bin_r0, bin_r1, \
+           lr_aeronet, lr_used, aerBsc_klett_max, aerExt_klett_max, \
+           aerBsc_klett_min, aerExt_klett_min, aerBsc_klett_mean, \
+           aerExt_klett_mean, aerBsc_klett_std, aerExt_klett_std
+
+
+PROFILES_INFO_KEYS = ['date', 'start_hm', 'end_hm', 'wavelength']
+PROFILES_INFO_COLUMNS = ['r0', 'r1', 'dr', 'bin_r0', 'bin_r1',
+                         'lr_aeronet', 'lr_used', 'aerBsc_klett_max', 'aerExt_klett_max',
+                         'aerBsc_klett_min', 'aerExt_klett_min',
+                         'aerBsc_klett_mean', 'aerExt_klett_mean', 'aerBsc_klett_std', 'aerExt_klett_std']
+
+
+def get_profiles_info_path(station: gs.Station) -> str:
+    """
+    :param station: gs.station() object of the lidar station
+    :return: path to the csv table of scalar info extracted from the TROPOS profiles (*_profiles.nc) of the station
+    """
+    return os.path.join(gs.PKG_DATA_DIR, f"profiles_info_{station.name}.csv")
+
+
+def load_profiles_info(station: gs.Station, csv_path: str = None) -> pd.DataFrame:
+    """
+    Load the table of profiles info of the station (see update_profiles_info()).
+    :param station: gs.station() object of the lidar station
+    :param csv_path: Optional. Path to the table, if None the default path of the station is used.
+    :return: pd.DataFrame(). The table of profiles info, or an empty table if it was not created yet.
+    """
+    csv_path = csv_path if csv_path else get_profiles_info_path(station)
+    if not os.path.exists(csv_path):
+        return pd.DataFrame(columns=['profile_path', 'mtime'] + PROFILES_INFO_KEYS + PROFILES_INFO_COLUMNS)
+    # The hours are kept as strings, to preserve leading zeros (e.g. '0030')
+    return pd.read_csv(csv_path, dtype={'date': str, 'start_hm': str, 'end_hm': str})
+
+
+def extract_profile_info(profile_path: str) -> pd.DataFrame:
+    """
+    Extract the scalar info of a TROPOS profile file for all the elastic wavelengths.
+    :param profile_path: path to a TROPOS profile file (*_profiles.nc)
+    :return: pd.DataFrame() with a row per wavelength and the columns: 'profile_path', 'wavelength' and
+    PROFILES_INFO_COLUMNS. An empty dataframe is returned if the file could not be processed.
+    """
+    logger = logging.getLogger()
+    wavelengths = gs.LAMBDA_nm().get_elastic()
+    try:
+        data = xr_utils.load_dataset(profile_path)
+        rows = [get_info_from_profile_ds(data, wavelength) for wavelength in wavelengths]
+    except Exception:
+        logger.exception(f"\nFailed extracting info from profile: {profile_path}")
+        return pd.DataFrame()
+    info_df = pd.DataFrame(rows, columns=PROFILES_INFO_COLUMNS)
+    info_df.insert(0, 'wavelength', wavelengths)
+    info_df.insert(0, 'profile_path', profile_path)
+    return info_df
+
+
+def update_profiles_info(station: gs.Station, dates: list, csv_path: str = None, njobs: int = -1) -> pd.DataFrame:
+    """
+    Create or refresh the table of profiles info of the station, for the TROPOS profiles (*_profiles.nc) of the given
+    dates. Only profile files that are new, or were modified since the last update (according to their mtime),
+    are loaded again. The extraction is done in parallel.
+    The table replaces globing and loading of the profiles per database row (see add_profiles_values()).
+
+    :param station: gs.station() object of the lidar station
+    :param dates: list of datetime.datetime objects of the days to scan
+    :param csv_path: Optional. Path to the table, if None the default path of the station is used.
+    :param njobs: number of processes for the extraction. -1 (default) for all cpu-s.
+    :return: pd.DataFrame(). The updated table of profiles info (of all the dates stored in it).
+    """
+    logger = logging.getLogger()
+    csv_path = csv_path if csv_path else get_profiles_info_path(station)
+    info_df = load_profiles_info(station, csv_path)
+
+    # Scan the profile files of the required days
+    scanned = []
+    for day_date in dates:
+        paths = prep_utils.get_TROPOS_dataset_paths(station, day_date, file_type='profiles', level='level1a')
+        for path in paths:
+            match_obj = re.match(r".*_(\d{4})_(\d{4})_profiles\.nc$", os.path.basename(path))
+            if match_obj is None:
+                logger.warning(f"\nUnexpected name of profile file: {path}. Skipping it.")
+                continue
+            start_hm, end_hm = match_obj.groups()
+            scanned.append((path, os.stat(path).st_mtime_ns, day_date.strftime('%Y-%m-%d'), start_hm, end_hm))
+    scanned_df = pd.DataFrame(scanned, columns=['profile_path', 'mtime', 'date', 'start_hm', 'end_hm'])
+
+    # Split to files that are up-to-date in the table, and files that require (re)extraction
+    cached_df = info_df[['profile_path', 'mtime']].drop_duplicates()
+    scanned_df = scanned_df.merge(cached_df, on=['profile_path', 'mtime'], how='left', indicator=True)
+    new_df = scanned_df[scanned_df['_merge'] == 'left_only'].drop(columns='_merge')
+    scanned_df = scanned_df.drop(columns='_merge')
+
+    # Drop rows of modified files, and of files that were removed from the scanned days
+    scanned_days = [day_date.strftime('%Y-%m-%d') for day_date in dates]
+    stale_rows = info_df['profile_path'].isin(new_df['profile_path']) | \
+                 (info_df['date'].isin(scanned_days) & ~info_df['profile_path'].isin(scanned_df['profile_path']))
+    info_df = info_df[~stale_rows]
+
+    logger.info(f"\nFound {len(scanned_df)} profile files, {len(new_df)} of them require extraction.")
+    if not new_df.empty:
+        if njobs == -1:
+            njobs = mp.cpu_count()
+        num_processes = min(njobs, len(new_df))
+        with mp.Pool(num_processes) as p:
+            results = p.map(extract_profile_info, new_df['profile_path'].tolist())
+        results = [res for res in results if not res.empty]
+        if results:
+            new_info_df = new_df.merge(pd.concat(results, ignore_index=True), on='profile_path', how='inner')
+            info_df = pd.concat([info_df, new_info_df], ignore_index=True)
+
+    info_df = info_df[['profile_path', 'mtime'] + PROFILES_INFO_KEYS + PROFILES_INFO_COLUMNS]
+    info_df = info_df.sort_values(by=['date', 'profile_path', 'wavelength'], ignore_index=True)
+    info_df.to_csv(csv_path, index=False)
+    logger.info(f"\nThe profiles info table saved to: {csv_path}")
+    return load_profiles_info(station, csv_path)
+
+
+def add_profiles_values(df, station, day_date, file_type='profiles', profiles_info: pd.DataFrame = None):
+    """
+    Add the path of the matched profile file, and the profile's info (see PROFILES_INFO_COLUMNS) to each row of df.
+    Rows without a matched profile are removed.
+    :param df: pd.DataFrame ( ) result from database query
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.datetime object of the measuring date
+    :param file_type: type of the profiles files, E.g. 'profiles'
+    :param profiles_info: Optional. The table created by update_profiles_info(). If given, the values are merged
+    from the table, instead of globing and loading the profile files of each row.
+    :return: df with the added columns
+    """
     logger = logging.getLogger()
+    if profiles_info is not None:
+        return _merge_profiles_info(df, station, day_date, profiles_info)
     paths = []
     inds = []
     inds2remove = []
@@ -107,43 +264,39 @@ def add_profiles_values(df, station, day_date, file_type='profiles'):
         df.reset_index(drop=True, inplace=True)
 
     def _get_info_from_profile_nc(row):
-        """
-        Get the r_0,r_1, and delta_r of the selected row. The values are following rebasing according to sea-level height.
-        Note: reference_height in each row should be in meters units
-        :param row:
-        :return:
-        """
         data = xr_utils.load_dataset(row['matched_nc_profile'])
-        wavelength = row.wavelength
-        # get altitude to rebase the reference heights according to sea-level-height
-        altitude = data.altitude.item()
-        [r0, r1] = data[f'reference_height_{wavelength}'].values
-        [bin_r0, bin_r1] = [np.argmin(abs(data.height.values - r)) for r in [r0, r1]]
-        delta_r = r1 - r0
-        lr_aeronet = data[f'LR_aeronet_{wavelength}'].fillna('').item()
-        lr_used = 50.0 if ('50.0 [Sr]' in data.aerBsc_klett_532.retrieving_info) else lr_aeronet
-        # TODO: use pd.describe() --> gives count,mean,max,min,std,25%,50%,75% in a single command
-        aerBsc_klett_max = data[f'aerBsc_klett_{wavelength}'].values.max()
-        aerExt_klett_max = aerBsc_klett_max * lr_used if (lr_used != '' and aerBsc_klett_max != '') else ''
-        aerBsc_klett_min = data[f'aerBsc_klett_{wavelength}'].values.min()
-        aerExt_klett_min = aerBsc_klett_min * lr_used if (lr_used != '' and aerBsc_klett_min != '') else ''
-        aerBsc_klett_mean = data[f'aerBsc_klett_{wavelength}'].values.mean()
-        aerExt_klett_mean = aerBsc_klett_mean * lr_used if (lr_used != '' and aerBsc_klett_mean != '') else ''
-        aerBsc_klett_std = data[f'aerBsc_klett_{wavelength}'].values.std()
-        aerExt_klett_std = (lr_used * data[f'aerBsc_klett_{wavelength}'].values).std() if \
-            (lr_used != '' and aerBsc_klett_mean != '') else ''
-        return r0 + altitude, r1 + altitude, delta_r, bin_r0, bin_r1, \
-               lr_aeronet, lr_used, aerBsc_klett_max, aerExt_klett_max, \
-               aerBsc_klett_min, aerExt_klett_min, aerBsc_klett_mean, \
-               aerExt_klett_mean, aerBsc_klett_std, aerExt_klett_std
-
-    df[['r0', 'r1', 'dr', 'bin_r0', 'bin_r1',
-        'lr_aeronet', 'lr_used', 'aerBsc_klett_max', 'aerExt_klett_max',
-        'aerBsc_klett_min', 'aerExt_klett_min',
-        'aerBsc_klett_mean', 'aerExt_klett_mean', 'aerBsc_klett_std', 'aerExt_klett_std']] = df.apply(
-        _get_info_from_profile_nc,
-        axis=1,
-        result_type='expand')
+        return get_info_from_profile_ds(data, row.wavelength)
+
+    df[PROFILES_INFO_COLUMNS] = df.apply(_get_info_from_profile_nc, axis=1, result_type='expand')
+    return df
+
+
+def _merge_profiles_info(df, station, day_date, profiles_info: pd.DataFrame):
+    """
+    Same as add_profiles_values(), with the values taken from the table of profiles info.
+    As with the glob search, the first (sorted) profile file is used if several files match the same times.
+    """
+    logger = logging.getLogger()
+    keys_df = pd.DataFrame({'date': df.cali_start_time.dt.strftime('%Y-%m-%d'),
+                            'start_hm': df.cali_start_time.dt.strftime('%H%M'),
+                            'end_hm': df.cali_stop_time.dt.strftime('%H%M'),
+                            'wavelength': df.wavelength.astype(int)})
+    info_df = profiles_info.sort_values(by='profile_path').drop_duplicates(subset=PROFILES_INFO_KEYS, keep='first')
+    info_df = info_df.astype({'wavelength': int})[['profile_path'] + PROFILES_INFO_KEYS + PROFILES_INFO_COLUMNS]
+    matched_df = keys_df.merge(info_df, on=PROFILES_INFO_KEYS, how='left')
+    matched_df.index = df.index
+
+    df['matched_nc_profile'] = matched_df['profile_path']
+    df[PROFILES_INFO_COLUMNS] = matched_df[PROFILES_INFO_COLUMNS]
+    unmatched = df['matched_nc_profile'].isna()
+    if unmatched.any():
+        for _, row in df[unmatched].iterrows():
+            logger.error(
+                f"Non resolved 'matched_nc_profile' for {station.name} station,"
+                f" at date {day_date.strftime('%Y-%m-%d')} and times  ,{row.cali_start_time} ,"
+                f"{row.cali_stop_time}. Removing related row.")
+        df.drop(df.index[unmatched.values], inplace=True)
+        df.reset_index(drop=True, inplace=True)
     return df
 
 
@@ -1,3 +1,4 @@
+import logging
 import os
 from datetime import datetime, timedelta, date
 
@@ -6,7 +7,6 @@ import matplotlib.ticker as mticker
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import sklearn as sk
 import xarray as xr
 from scipy import stats
 from scipy.stats import multivariate_normal
@@ -15,6 +15,7 @@ from learning_lidar.utils import vis_utils
 
 vis_utils.set_visualization_settings()
 
+import learning_lidar.dataseting.dataseting_utils as ds_utils
 import learning_lidar.generation.generation_utils as gen_utils
 from learning_lidar.utils import utils, xr_utils, vis_utils, proc_utils, global_settings as gs
 from learning_lidar.generation.generate_density_utils import LR_tropos
@@ -57,6 +58,34 @@ def gaussian2density(means_x, means_y, stds_x, stds_y, grid):
     return density
 
 
+def sample_LR_cond_A(Z_LR_A: np.ndarray, LR_grid: np.ndarray, A_grid: np.ndarray, A_samples: np.ndarray,
+                     rng: np.random.Generator = None) -> (np.ndarray, np.ndarray):
+    """
+    Sampling LR from the conditioned probability P(x=LR|y=A), for each value of A_samples.
+    The joint density is given on a fixed (LR, A) grid. Each column of the grid (a value of A) is converted to a
+    conditional CDF, and LR values are drawn for all samples by one vectorized inverse-CDF lookup.
+    :param Z_LR_A: np.array of the joint density P(x=LR,y=A) on the grid, of shape (len(LR_grid), len(A_grid))
+    :param LR_grid: np.array of the (uniform) LR values of the grid
+    :param A_grid: np.array of the (uniform) A values of the grid
+    :param A_samples: np.array of A values to condition on. Each value is taken at the nearest grid point.
+    :param rng: np.random.Generator (or a seed). None for unpredictable samples.
+    :return: LR_samp - np.array of the sampled LR values (of LR_grid), in the size of A_samples
+             Z_cond - np.array of the conditioned densities of each sample, of shape (len(A_samples), len(LR_grid))
+    """
+    rng = np.random.default_rng(rng)
+    dA = A_grid[1] - A_grid[0]
+    A_inds = np.clip(np.rint((np.asarray(A_samples) - A_grid[0]) / dA), 0, len(A_grid) - 1).astype(int)
+    Z_cond = Z_LR_A[:, A_inds].T
+
+    cdf = np.cumsum(Z_cond, axis=1)
+    total = cdf[:, -1:]
+    # A column of zero density (far from the data) is sampled uniformly
+    cdf = np.where(total > 0, cdf / np.where(total > 0, total, 1), np.linspace(1 / len(LR_grid), 1, len(LR_grid)))
+    u = rng.random((len(A_inds), 1))
+    LR_inds = np.minimum((cdf < u).sum(axis=1), len(LR_grid) - 1)
+    return LR_grid[LR_inds], Z_cond
+
+
 def plot_angstrom_exponent_distribution(x, y, x_label, y_label, date_):
     fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(8, 6))
     ax.scatter(x=x, y=y, s=5)
@@ -70,8 +99,11 @@ def plot_angstrom_exponent_distribution(x, y, x_label, y_label, date_):
 
 
 def kde_estimation_main(args, month, year, data_folder):
+    logger = logging.getLogger()
     #  Load measurements from AERONET for current month
     station = gs.Station(station_name=args.station_name)
+    # A generator per month, such that each month is reproducible given args.seed
+    rng = np.random.default_rng(None if args.seed is None else [args.seed, year, month])
     start_date, end_date = args.start_date, args.end_date
 
     folder_name = station.aeronet_folder
@@ -106,7 +138,7 @@ def kde_estimation_main(args, month, year, data_folder):
     kernel = stats.gaussian_kde(values)
 
     # Sample new points
-    [x1, y1] = kernel.resample(2 * monthdays)
+    [x1, y1] = kernel.resample(2 * monthdays, seed=rng)
     scores_new = kernel(np.vstack([x1, y1]))
     # TODO: the argpartition was to make sure values are within limits .
     #  so make sure the usage of rejection sampling is done correctly
@@ -221,29 +253,14 @@ def kde_estimation_main(args, month, year, data_folder):
         plt.show()
 
     # 3. Sampling $LR$ from 1D conditioned probability $P(x=LR|y=A)$
-    LR_samp = []
-    fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(9, 6))
-    for ang in ang_355_532:
-        # calc conditioned density for each value of Angstrom Exponent list
-        X_, Y_ = np.mgrid[xmin:xmax:200j, ang:ang:1j]
-        positions_ = np.vstack([X_.ravel(), Y_.ravel()])
-        Z_ = np.reshape(kernel_LR_A(positions_).T, X_.shape)
-        yy_i = Z_.reshape(Z_.size)
-        xx_i = X_.reshape(X_.size)
-        kernel_LR_cond_A_i = stats.gaussian_kde(yy_i)
-        random_state = sk.utils.check_random_state(None)
-        weights = kernel_LR_cond_A_i.dataset[0, :]
-        maxv = weights.max()
-        minv = weights.min()
-        weights = (weights - minv) / (maxv - minv)
-        weights /= weights.sum()
-        # TODO: sample from conditioned distribution and make sure that samples correlate with 95%.
-        indx = random_state.choice(kernel_LR_cond_A_i.n, size=1, p=weights)
-        ax.plot(xx_i, yy_i, linewidth=0.8)
-        ax.scatter(x=xx_i[indx], y=yy_i[indx], s=10)
-        LR_samp.append(xx_i[indx])
+    # TODO: sample from conditioned distribution and make sure that samples correlate with 95%.
+    LR_grid, A_grid = X[:, 0], Y[0, :]
+    LR_samp, Z_cond = sample_LR_cond_A(Z, LR_grid, A_grid, ang_355_532, rng=rng)
 
     if args.plot_results:
+        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(9, 6))
+        ax.plot(LR_grid, Z_cond.T, linewidth=0.8)
+        ax.scatter(x=LR_samp, y=Z_cond[np.arange(len(LR_samp)), np.searchsorted(LR_grid, LR_samp)], s=10)
         plt.xlabel(r'$\rm \, LR_{355[nm]}$')
         plt.ylabel(r'$\rm A 355-532$')
 
@@ -257,7 +274,6 @@ def kde_estimation_main(args, month, year, data_folder):
         # plt.savefig(os.path.join('figures', title+'.pdf'))
         plt.show()
 
-    LR_samp = np.array(LR_samp).reshape(2 * monthdays)
 
     if args.plot_results:
         # 4. Show the joint density, and the new samples of LR
@@ -291,8 +307,6 @@ def kde_estimation_main(args, month, year, data_folder):
     km_scale = 1E+3
 
     monthdays = (date(year, month + 1, 1) - date(year, month, 1)).days
-    # TODO: use the new dataset which already includes the required statistics
-    #  remember also to convert backscatter to km units
     csv_name = f"dataset_{station.name}_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}_extended.csv"
     csv_path_extended = os.path.join(data_folder, csv_name)
     df_extended = pd.read_csv(csv_path_extended)
@@ -300,16 +314,24 @@ def kde_estimation_main(args, month, year, data_folder):
     grps_month = df_extended.groupby(df_extended['date'].dt.month).groups
     key_month = month
     df_month = df_extended.iloc[grps_month.get(key_month).values].reset_index()
-    rm = []
-    beta_532 = []
-    grps_files = df_month.groupby(df_month.profile_path).groups
-    for key, v in zip(grps_files.keys(), grps_files.values()):
-        ds_profile = xr_utils.load_dataset(key)
-        max_beta_532 = ds_profile.aerBsc_klett_532.values.max()
-        max_beta_532 *= km_scale  # converting 1/(sr m) to  1/(sr km)
-        cur_rm = df_month['rm'].iloc[v.values[0]]
-        beta_532.append(max_beta_532)
-        rm.append(cur_rm)
+    # Max beta_532 of each profile is taken from the table of profiles info (instead of loading the profiles).
+    # The table is refreshed only for new or modified profile files of the month (see ds_utils.update_profiles_info())
+    month_dates = pd.date_range(start_day, end_day, freq='D').to_pydatetime().tolist()
+    profiles_info = ds_utils.update_profiles_info(station, month_dates)
+    info_532 = profiles_info.loc[profiles_info.wavelength.astype(int) == 532, ['profile_path', 'aerBsc_klett_max']]
+    df_profiles = df_month.drop_duplicates(subset='profile_path', keep='first')[['profile_path', 'rm']]
+    # the paths of the dataset and of the profiles info can be written differently (relative, separators), so the
+    # profiles are matched by their absolute normalized paths
+    df_profiles['norm_path'] = df_profiles['profile_path'].apply(os.path.abspath)
+    info_532 = info_532.assign(norm_path=info_532['profile_path'].apply(os.path.abspath)).drop(columns='profile_path')
+    info_532 = info_532.drop_duplicates(subset='norm_path', keep='first')
+    df_profiles = df_profiles.merge(info_532, on='norm_path', how='left', indicator=True)
+    unmatched = df_profiles.loc[df_profiles['_merge'] == 'left_only', 'profile_path']
+    if len(unmatched):
+        logger.warning(f"\n{len(unmatched)} of {len(df_profiles)} profiles of {start_day.strftime('%Y-%m')} have no "
+                       f"info of 532nm, and are ignored in the KDE of rm and beta_532:\n{unmatched.tolist()}")
+    rm = df_profiles['rm'].values
+    beta_532 = df_profiles['aerBsc_klett_max'].values * km_scale  # converting 1/(sr m) to  1/(sr km)
 
     # 2 . Estimate kernel density for $r_{m}$ vs. $\beta_{532}^{max}$
     df_rm_beta = pd.DataFrame(columns=['rm', 'beta-532'], data=np.array([rm, beta_532]).T)
@@ -340,18 +362,8 @@ def kde_estimation_main(args, month, year, data_folder):
                  np.ceil(df_rm_beta['rm'].max())]
     beta_bounds = [0.0, 1.0]
 
-    rm_v = []
-    beta_v = []
-    for day in range(monthdays):
-        valid_domain = False
-        while ~valid_domain:
-            sample_rm, sample_beta = kernel_rm_beta.resample(1)[:, 0]
-            valid_domain = gen_utils.valid_box_domain(sample_rm, sample_beta,
-                                                      rm_bounds, beta_bounds)
-        rm_v.append(sample_rm)
-        beta_v.append(sample_beta)
-    print(rm_v, beta_v)
-    rm_new, beta_532_new = np.array(rm_v), np.array(beta_v)
+    rm_new, beta_532_new = gen_utils.sample_kde_in_box(kernel_rm_beta, monthdays, bounds=[rm_bounds, beta_bounds],
+                                                       rng=rng)
     # x_,y_ = kernel_rm_beta.resample(monthdays+10)
     # scores_new = kernel_rm_beta([x_, y_])
     # max_ind = np.argpartition(scores_new, -monthdays)[-monthdays:]
@@ -436,7 +448,7 @@ def kde_estimation_main(args, month, year, data_folder):
         points[0:monthdays * 2, 1] = p_slice.values
         points[-1, 1] = p_slice.values[-1]
         # calc bezier
-        path_ang355532 = proc_utils.Bezier.evaluate_bezier(points, int(dn_t))
+        path_ang355532 = proc_utils.Bezier.fast_evaluate_bezier(points, int(dn_t))
         # Set the time index in which the interpolation is calculated.
         time_index = pd.date_range(start=start_date, end=end_time, freq=f'30S')
         ds_bezier = xr.Dataset(
@@ -487,6 +499,9 @@ if __name__ == '__main__':
     parser.add_argument('--extended_smoothing_bezier', action='store_true',
                         help='Whether to do extended smoothing bezier')
 
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the KDE sampling (default: None - not reproducible)')
+
     args = parser.parse_args()
 
     # start_date and end_date should correspond to the extended csv!
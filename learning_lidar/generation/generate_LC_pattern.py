@@ -193,15 +193,16 @@ def generate_LC_pattern_main(params):
 
     n_total = difft.days * station.total_time_bins + difft.seconds / station.freq
     dn_t = np.int(n_total / (n_pts - 1))
-    # initialize the points at times of n_pts
-    points = np.empty((n_pts, 2))
-    points[:, 0] = np.array([n * dn_t for n in range(n_pts)])
+    # initialize the points at times of n_pts, for all wavelengths
+    points = np.empty((len(wavelengths), n_pts, 2))
+    points[:, :, 0] = np.array([n * dn_t for n in range(n_pts)])
+    for ind, wavelength in enumerate(wavelengths):
+        points[ind, :, 1] = ds_gen_p.p_new.sel(Wavelength=wavelength, Time=tslice).values
+    paths = proc_utils.Bezier.fast_evaluate_bezier(points, dn_t)
     # Set the time index in which the interpolation is calculated.
     power_time_index = pd.date_range(start=start_date, end=final_dt, freq=f'{station.freq}S')
     paths_chan = []
-    for wavelength in wavelengths:
-        points[:, 1] = ds_gen_p.p_new.sel(Wavelength=wavelength, Time=tslice).values
-        path = proc_utils.Bezier.evaluate_bezier(points, dn_t)
+    for wavelength, path in zip(wavelengths, paths):
         paths_chan.append(xr.Dataset(
             data_vars={'p': ('Time', path[:, 1]),
                        'lambda_nm': ('Wavelength', np.uint16([wavelength]))
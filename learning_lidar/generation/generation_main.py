@@ -9,7 +9,7 @@ from generate_LC_pattern import generate_LC_pattern_main
 from generate_bg_signals import BackgroundGenerator
 from generate_density import generate_density_main
 from learning_lidar.utils import utils, global_settings as gs
-from read_AERONET_data import read_aeronet_data_main
+from read_AERONET_data import read_aeronet_data_period
 
 if __name__ == '__main__':
     parser = utils.get_base_arguments()
@@ -18,6 +18,9 @@ if __name__ == '__main__':
     parser.add_argument('--extended_smoothing_bezier', action='store_true',
                         help='Whether to do extended smoothing bezier')
 
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the KDE sampling (default: None - not reproducible)')
+
     # For daily signals generation
     parser.add_argument('--update_overlap_only', action='store_true',
                         help='Whether to update the overlap only or create from scratch')
@@ -37,11 +40,10 @@ if __name__ == '__main__':
 
     # 2. Daily Angstrom Exponent and Optical Depth
     logger.info("Generating Angstrom Exponent and Optical Depth...")
-    for month_date in pd.date_range(start=args.start_date, end=args.end_date, freq='MS'):
-        read_aeronet_data_main(station_name=args.station_name,
-                               month=month_date.month,
-                               year=month_date.year,
-                               plot_results=args.plot_results)
+    read_aeronet_data_period(station_name=args.station_name,
+                             start_date=args.start_date,
+                             end_date=args.end_date,
+                             plot_results=args.plot_results)
 
     # 3. Initial parameters for density generation
 
@@ -1,4 +1,5 @@
 import calendar
+import logging
 import os
 from datetime import datetime, timedelta
 from typing import Union
@@ -328,3 +329,46 @@ def save_full_params_dataset(station, start_date, end_date, data, type_):
 
 def valid_box_domain(x, y, bounds_x, bounds_y):
     return bounds_x[0] <= x <= bounds_x[1] and bounds_y[0] <= y <= bounds_y[1]
+
+
+def sample_kde_in_box(kernel, n_samples: int, bounds: list, rng: np.random.Generator = None,
+                      oversample: float = 1.5, max_block: int = 100000, max_iters: int = 100) -> np.ndarray:
+    """
+    Rejection sampling from a KDE truncated to a box domain.
+    Samples are drawn in blocks and masked against the bounds at once. Blocks are added until there are enough
+    valid samples, where the size of each block is set by the acceptance rate observed so far.
+    :param kernel: scipy.stats.gaussian_kde() of d dimensions
+    :param n_samples: the number of required samples
+    :param bounds: list of d bounds [min, max], one per dimension (e.g., [bounds_x, bounds_y])
+    :param rng: np.random.Generator (or a seed). None for unpredictable samples.
+    :param oversample: the factor of samples to draw relative to the expected number of required samples
+    :param max_block: the maximal number of samples drawn in one block
+    :param max_iters: the maximal number of blocks. Raises ValueError if not enough samples were accepted.
+    :return: samples - np.array of shape (d, n_samples). The acceptance rate is logged (with a warning if it is low).
+    """
+    logger = logging.getLogger()
+    rng = np.random.default_rng(rng)
+    bounds = np.asarray(bounds, dtype=float)
+    blocks = []
+    n_accepted, n_drawn = 0, 0
+    block_size = int(np.ceil(oversample * n_samples))
+    for _ in range(max_iters):
+        block = kernel.resample(block_size, seed=rng)
+        valid = np.all((block >= bounds[:, [0]]) & (block <= bounds[:, [1]]), axis=0)
+        blocks.append(block[:, valid])
+        n_accepted += valid.sum()
+        n_drawn += block_size
+        if n_accepted >= n_samples:
+            break
+        acceptance_rate = max(n_accepted, 1) / n_drawn
+        block_size = min(int(np.ceil(oversample * (n_samples - n_accepted) / acceptance_rate)), max_block)
+    else:
+        raise ValueError(f"Only {n_accepted} of {n_samples} samples are within the bounds {bounds.tolist()}, "
+                         f"after drawing {n_drawn} samples")
+
+    acceptance_rate = n_accepted / n_drawn
+    logger.info(f"\nKDE rejection sampling within {bounds.tolist()}: acceptance rate {100 * acceptance_rate:.2f}%"
+                f" ({n_accepted} of {n_drawn})")
+    if acceptance_rate < 0.1:
+        logger.warning(f"\nLow acceptance rate ({100 * acceptance_rate:.2f}%), check the bounds {bounds.tolist()}")
+    return np.hstack(blocks)[:, :n_samples]
@@ -1,5 +1,10 @@
+import calendar
+import glob
+import hashlib
+import logging
 import os
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
+from itertools import combinations
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -17,90 +22,188 @@ vis_utils.set_visualization_settings()
 # TODO NAN values in ds_aod.aod??
 
 
-def read_aeronet_data_main(station_name, month, year, plot_results):
+AERONET_AOD_COLUMNS = ['AOD_1640nm', 'AOD_1020nm', 'AOD_675nm', 'AOD_500nm', 'AOD_380nm', 'AOD_340nm']
+
+
+def get_aeronet_lev20_paths(station: gs.Station, start_day: datetime, end_day: datetime) -> list:
     """
-    calculate Angstrom exponent based on AERONET measurements taken from the sunphotometere on EE building
-    Assumes aeronet files to exist. if not, download from - https://aeronet.gsfc.nasa.gov/cgi-bin/webtool_aod_v3?stage=3&region=Middle_East&state=Israel&site=Technion_Haifa_IL&place_code=10&if_polarized=0
+    Retrieves the AERONET '.lev20' files of the station that overlap the period [start_day, end_day].
+    The files are expected at: <station.aeronet_folder>/<YYYYMMDD>_<YYYYMMDD>_<station.aeronet_name>/<same name>.lev20
+    :param station: gs.station() object of the lidar station
+    :param start_day: datetime.datetime object of the period start
+    :param end_day: datetime.datetime object of the period end
+    :return: sorted list of paths
+    """
+    paths = []
+    pattern = os.path.join(station.aeronet_folder, f"*_{station.aeronet_name}", f"*_{station.aeronet_name}.lev20")
+    for path in sorted(glob.glob(pattern)):
+        file_start, file_end = os.path.basename(path).split('_')[0:2]
+        file_start, file_end = datetime.strptime(file_start, '%Y%m%d'), datetime.strptime(file_end, '%Y%m%d')
+        if file_start <= end_day and file_end >= start_day:
+            paths.append(path)
+    return paths
 
-    Mean values per day will be using as typical values for aerosols creation
-    :return: Angstrom exponent data for the wavelengths couples: [(355, 532), (355, 1064), (532, 1064)]
+
+def parse_aeronet_lev20(file_name: str) -> pd.DataFrame:
     """
-    # Load AERONET file of month-year
-    station = gs.Station(station_name)
+    Parse an AERONET '.lev20' file to the measured AOD.
+    :param file_name: path to the '.lev20' file
+    :return: pd.DataFrame() of the measured AOD, indexed by time, with a column per measured wavelength [nm]
+    """
+    aeronet_data = pd.read_csv(file_name, skiprows=6).dropna()
+    df_dt = pd.to_datetime(aeronet_data['Date(dd:mm:yyyy)'] + aeronet_data['Time(hh:mm:ss)'],
+                           format="%d:%m:%Y%H:%M:%S")
+    df_aod = aeronet_data[AERONET_AOD_COLUMNS].astype(float)
+    df_aod.index = df_dt
+    df_aod.columns = [int(col.split('_')[1].replace('nm', '')) for col in AERONET_AOD_COLUMNS]
+    return df_aod.sort_index(axis=1)
+
+
+def load_aeronet_lev20(file_name: str, cache_folder: str) -> pd.DataFrame:
+    """
+    Load the measured AOD of an AERONET '.lev20' file (see parse_aeronet_lev20()), through a netcdf cache.
+    The cache file is keyed by the hash of the '.lev20' file, so a modified file is parsed again.
+    :param file_name: path to the '.lev20' file
+    :param cache_folder: the folder of the cached files
+    :return: pd.DataFrame() of the measured AOD, indexed by time, with a column per measured wavelength [nm]
+    """
+    logger = logging.getLogger()
+    with open(file_name, 'rb') as f:
+        file_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    cache_path = os.path.join(cache_folder, f"{base_name}_{file_hash}.nc")
+    if os.path.exists(cache_path):
+        logger.debug(f"\nLoading cached AERONET data: {cache_path}")
+        return xr_utils.load_dataset(cache_path).aod.to_pandas()
+
+    df_aod = parse_aeronet_lev20(file_name)
+    # Remove cached files of previous versions of the '.lev20' file
+    for old_path in glob.glob(os.path.join(cache_folder, f"{base_name}_*.nc")):
+        os.remove(old_path)
+    ds_cache = xr.Dataset(data_vars={'aod': (('Time', 'Wavelength'), df_aod.values)},
+                          coords={'Time': df_aod.index.values, 'Wavelength': df_aod.columns.values},
+                          attrs={'source_file': file_name, 'sha1': file_hash})
+    xr_utils.save_dataset(ds_cache, folder_name=cache_folder, nc_name=os.path.basename(cache_path), optim_size=False)
+    return df_aod
 
-    monthdays = (date(year, month + 1, 1) - date(year, month, 1)).days
-    start_day = datetime(year, month, 1, 0, 0)
-    end_day = datetime(year, month, monthdays, 0, 0)
-    wavelengths = [355, 532, 1064]
 
-    base_name = f"{start_day.strftime('%Y%m%d')}_{end_day.strftime('%Y%m%d')}_{station.aeronet_name}"
-    file_name = os.path.join(station.aeronet_folder, base_name, base_name + '.lev20')
+def calc_aod_angstrom(df_aod: pd.DataFrame, wavelengths: list) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Calculate AOD for the required wavelengths (e.g., 355,532,1064), by linear interpolation of the nearest
+    measured wavelengths, and the Angstrom Exponent of all couples of the required wavelengths.
+    :param df_aod: pd.DataFrame() of the measured AOD, indexed by time, with a column per measured wavelength [nm]
+    :param wavelengths: list of the required wavelengths [nm]. Each should be between two measured wavelengths.
+    :return: df_aod_new - pd.DataFrame() of AOD with a column per wavelength. Negative (missing) values are NaN.
+             df_ang - pd.DataFrame() of Angstrom Exponent with a column per couple, e.g., '355-532'
+    """
+    measured = df_aod.columns.values
+    # Interpolation weights of the measured wavelengths, per required wavelength
+    weights = np.zeros((len(measured), len(wavelengths)))
+    for ind, wavelength in enumerate(wavelengths):
+        ind_next = np.searchsorted(measured, wavelength)
+        ratio = (measured[ind_next] - wavelength) / (measured[ind_next] - measured[ind_next - 1])
+        weights[ind_next - 1, ind] = ratio
+        weights[ind_next, ind] = 1 - ratio
+    aod = df_aod.values @ weights
+    aod[aod < 0] = np.nan
+    df_aod_new = pd.DataFrame(aod, index=df_aod.index, columns=wavelengths)
+
+    couples = list(combinations(sorted(wavelengths), 2))
+    df_ang = pd.DataFrame({f"{lambda_1}-{lambda_2}": misc_lidar.angstrom(df_aod_new[lambda_1].values,
+                                                                         df_aod_new[lambda_2].values,
+                                                                         lambda_1, lambda_2)
+                           for lambda_1, lambda_2 in couples}, index=df_aod.index)
+    return df_aod_new, df_ang
+
+
+def load_aeronet_period(station: gs.Station, start_day: datetime, end_day: datetime,
+                        wavelengths: list = [355, 532, 1064]) -> (xr.Dataset, xr.Dataset):
+    """
+    Load AOD and Angstrom Exponent of a period, from all the AERONET '.lev20' files overlapping it.
+    Each file is parsed once, and cached in <station.aeronet_folder>/cache (see load_aeronet_lev20())
+    :param station: gs.station() object of the lidar station
+    :param start_day: datetime.datetime object of the period start
+    :param end_day: datetime.datetime object of the period's last day
+    :param wavelengths: list of the required wavelengths [nm]
+    :return: ds_aod, ds_ang - datasets of AOD (Wavelength, Time) and of Angstrom Exponent (Wavelengths, Time)
+    """
+    paths = get_aeronet_lev20_paths(station, start_day, end_day)
     # TODO : add automatic download of `.lev20' file from AERONET in case a file is missing.
-    aeronet_data = pd.read_csv(file_name, skiprows=6).dropna()
+    if not paths:
+        raise FileNotFoundError(f"No AERONET '.lev20' files of {station.aeronet_name} for the period "
+                                f"[{start_day.strftime('%Y-%m-%d')},{end_day.strftime('%Y-%m-%d')}]")
+    cache_folder = os.path.join(station.aeronet_folder, 'cache')
+    df_measured = pd.concat([load_aeronet_lev20(path, cache_folder) for path in paths])
+    df_measured = df_measured[~df_measured.index.duplicated(keep='first')].sort_index()
+    df_measured = df_measured.loc[start_day:end_day + timedelta(days=1) - timedelta(seconds=1)]
 
-    # Parse data and rename columns for easier extrapolation of AOD values
-    df_dt = pd.to_datetime(aeronet_data['Date(dd:mm:yyyy)'] + aeronet_data['Time(hh:mm:ss)'], format="%d:%m:%Y%H:%M:%S")
-    columns = ['AOD_1640nm', 'AOD_1020nm', 'AOD_675nm', 'AOD_500nm', 'AOD_380nm', 'AOD_340nm']
-    df_AOD_ANGSTROM = aeronet_data[columns].copy(deep=True)
-    df_AOD_ANGSTROM.index = df_dt
-    for col in sorted(columns):
-        col_new = int(col.split('_')[1].replace('nm', ''))
-        df_AOD_ANGSTROM.rename(columns={col: col_new}, inplace=True)
-
-    cols = df_AOD_ANGSTROM.columns.values.tolist()
-    cols.extend(wavelengths)
-    df_AOD_ANGSTROM = df_AOD_ANGSTROM.reindex(cols, axis='columns').sort_index(axis=1)
-
-    # Calculate AOD for missing wavelengths as $355,532,1064$
-    # by interpolation values from the nearest existing measured wavelengths.
-    cols = df_AOD_ANGSTROM.columns.values.tolist()
-    for wavelength in wavelengths:
-        col_ind = df_AOD_ANGSTROM.columns.get_loc(wavelength)
-        ratio = (cols[col_ind + 1] - cols[col_ind]) / (cols[col_ind + 1] - cols[col_ind - 1])
-        df_AOD_ANGSTROM[wavelength] = df_AOD_ANGSTROM.iloc[:, col_ind - 1] * \
-                                      ratio + (1 - ratio) * \
-                                      df_AOD_ANGSTROM.iloc[:, col_ind + 1]
-
-    # Create dataset of AOD per wavelength
-    ds_chans = []
-    for wavelength in wavelengths:
-        aeronet_ds_chan = xr.Dataset(
-            data_vars={'aod': ('Time', df_AOD_ANGSTROM[wavelength]),
-                       'lambda_nm': ('Wavelength', [wavelength])
-                       },
-            coords={'Time': df_AOD_ANGSTROM.index.tolist(),
-                    'Wavelength': [wavelength]
-                    })
-        ds_chans.append(aeronet_ds_chan)
-    ds_aod = xr.concat(ds_chans, dim='Wavelength')
+    df_aod, df_ang = calc_aod_angstrom(df_measured, wavelengths)
+    # Drop times without any valid AOD value
+    valid_times = df_aod.notna().any(axis=1)
+    df_aod, df_ang = df_aod[valid_times], df_ang[valid_times]
 
+    source_file = ', '.join(paths)
+    ds_aod = xr.Dataset(data_vars={'aod': (('Wavelength', 'Time'), df_aod.values.T),
+                                   'lambda_nm': ('Wavelength', wavelengths)},
+                        coords={'Time': df_aod.index.values, 'Wavelength': wavelengths})
     ds_aod.aod.attrs['long_name'] = r'$\tau$'
-    ds_aod = ds_aod.aod.where(ds_aod >= 0, drop=True)
     ds_aod.attrs = {'info': 'Aerosol Optical Depth - generated from AERONET - level 2.0',
-                    'location': station.name, 'source_file': file_name,
+                    'location': station.name, 'source_file': source_file,
                     'start_time': start_day.strftime("%Y-%d-%m"), 'end_time': end_day.strftime("%Y-%d-%m")}
 
-    # Calculate Angstrom Exponent
-    couples = [(355, 532), (355, 1064), (532, 1064)]
-    angstrom_daily = []
-    for lambda_1, lambda_2 in couples:
-        angstrom_couple = xr.apply_ufunc(lambda x, y: misc_lidar.angstrom(ds_aod.sel(Wavelength=x).aod,
-                                                               ds_aod.sel(Wavelength=y).aod, x, y), lambda_1, lambda_2,
-                                         keep_attrs=True).rename('angstrom')
-        angstrom_ds_chan = xr.Dataset(
-            data_vars={'angstrom': ('Time', angstrom_couple.values),
-                       'lambda_nm': ('Wavelengths', [f"{lambda_1}-{lambda_2}"])
-                       },
-            coords={'Time': df_AOD_ANGSTROM.index.tolist(),
-                    'Wavelengths': [f"{lambda_1}-{lambda_2}"]
-                    })
-
-        angstrom_daily.append(angstrom_ds_chan)
-    ds_ang = xr.concat(angstrom_daily, dim='Wavelengths')
+    ds_ang = xr.Dataset(data_vars={'angstrom': (('Wavelengths', 'Time'), df_ang.values.T),
+                                   'lambda_nm': ('Wavelengths', df_ang.columns.tolist())},
+                        coords={'Time': df_ang.index.values, 'Wavelengths': df_ang.columns.tolist()})
     ds_ang.angstrom.attrs['long_name'] = r'$\AA$'
     ds_ang.attrs = {'info': 'Angstrom Exponent - generated from AERONET AOD',
-                    'location': station.name, 'source_file': file_name,
+                    'location': station.name, 'source_file': source_file,
                     'start_time': start_day.strftime("%Y-%d-%m"), 'end_time': end_day.strftime("%Y-%d-%m")}
+    return ds_aod, ds_ang
+
+
+def read_aeronet_data_period(station_name, start_date, end_date, plot_results):
+    """
+    Same as read_aeronet_data_main(), for all the months in the period [start_date, end_date].
+    The AERONET data of the whole period is loaded and calculated once, and each month is a slice of it.
+    """
+    station = gs.Station(station_name)
+    months = pd.date_range(start=start_date, end=end_date, freq='MS')
+    if months.empty:
+        return
+    start_day = months[0].to_pydatetime()
+    end_day = (months[-1] + pd.offsets.MonthEnd(0)).to_pydatetime()
+    ds_aod, ds_ang = load_aeronet_period(station, start_day, end_day)
+    for month_date in months:
+        read_aeronet_data_main(station_name, month_date.month, month_date.year, plot_results,
+                               ds_aod=ds_aod, ds_ang=ds_ang)
+
+
+def read_aeronet_data_main(station_name, month, year, plot_results, ds_aod=None, ds_ang=None):
+    """
+    calculate Angstrom exponent based on AERONET measurements taken from the sunphotometere on EE building
+    Assumes aeronet files to exist. if not, download from - https://aeronet.gsfc.nasa.gov/cgi-bin/webtool_aod_v3?stage=3&region=Middle_East&state=Israel&site=Technion_Haifa_IL&place_code=10&if_polarized=0
+
+    Mean values per day will be using as typical values for aerosols creation
+    :param ds_aod: Optional. AOD dataset of a period including the month (see load_aeronet_period()).
+    :param ds_ang: Optional. Angstrom Exponent dataset of a period including the month (see load_aeronet_period()).
+    If ds_aod or ds_ang are None, the month is loaded from the AERONET files.
+    :return: Angstrom exponent data for the wavelengths couples: [(355, 532), (355, 1064), (532, 1064)]
+    """
+    # Load AERONET data of month-year
+    station = gs.Station(station_name)
+
+    monthdays = calendar.monthrange(year, month)[1]
+    start_day = datetime(year, month, 1, 0, 0)
+    end_day = datetime(year, month, monthdays, 0, 0)
+    wavelengths = [355, 532, 1064]
+    couples = [(355, 532), (355, 1064), (532, 1064)]
+
+    if ds_aod is None or ds_ang is None:
+        ds_aod, ds_ang = load_aeronet_period(station, start_day, end_day, wavelengths)
+    month_slice = slice(start_day, end_day + timedelta(days=1) - timedelta(seconds=1))
+    attrs = {'start_time': start_day.strftime("%Y-%d-%m"), 'end_time': end_day.strftime("%Y-%d-%m")}
+    ds_aod = ds_aod.sel(Time=month_slice).assign_attrs(attrs)
+    ds_ang = ds_ang.sel(Time=month_slice).assign_attrs(attrs)
 
     # Show AOD and Angstrom Exponent for a period
     if plot_results:
@@ -160,5 +263,4 @@ if __name__ == '__main__':
     parser = utils.get_base_arguments()
     args = parser.parse_args()
 
-    for date_ in pd.date_range(start=args.start_date, end=args.end_date, freq='MS'):
-        read_aeronet_data_main(args.station_name, date_.month, date_.year, args.plot_results)
+    read_aeronet_data_period(args.station_name, args.start_date, args.end_date, args.plot_results)
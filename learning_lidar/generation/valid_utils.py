@@ -3,11 +3,16 @@ from __future__ import division
 import os
 import pickle
 import platform
-import random
+import random as py_random
 import warnings
+from copy import deepcopy
 from datetime import datetime, timedelta
+from itertools import product
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from typing import Union
+from uuid import uuid4
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -19,7 +24,7 @@ from matplotlib import colors
 from matplotlib import dates as mdates
 from numpy import random
 from pytictoc import TicToc
-from scipy.spatial.distance import pdist, cdist
+from scipy.spatial.distance import pdist, cdist, squareform
 from scipy.stats import genextreme
 from scipy.stats import kstwobign, pearsonr
 from sklearn.mixture import BayesianGaussianMixture as BayesGMM
@@ -247,11 +252,20 @@ def get_model_name(models_folder: os.path,
 
 
 def save_params_to_csv(save_params: dict, csv_models: os.path = 'models.csv'):
+    if not os.path.isfile(csv_models):
+        print(f"Creating new models table {csv_models}")
+        pd.DataFrame(columns=list(save_params.keys())).to_csv(csv_models, index=False)
     table = pd.read_csv(csv_models)
     # get keys of the table
     keys = table.keys()
+    new_keys = [key for key in save_params.keys() if key not in keys]
+    if new_keys:
+        # extend the table with the new keys (e.g. fit times of a sweep), previous rows get empty values
+        print(f"Adding columns {new_keys} to {csv_models}")
+        keys = keys.append(pd.Index(new_keys))
+        table.reindex(columns=keys).to_csv(csv_models, index=False)
     model_unique_name = save_params['start_time']
-    if model_unique_name not in table.start_time.values:
+    if model_unique_name not in table.start_time.astype(str).values:
         # set a row according to the keys
         row = pd.DataFrame.from_dict(data=save_params, orient='index').T.reindex(columns=keys)
         # append a row to the csv
@@ -289,13 +303,156 @@ def run(model_path: Path, gmm_params: dict, db_name: str, samples: np.ndarray):
     save_params_to_csv(save_params)
 
 
+def get_sweep_grid(param_grid: dict) -> list[dict]:
+    """
+    :param param_grid: dict of gmm parameter name -> list of values, e.g. {'n_components': [5, 10, 15]}
+    :return: list of gmm_params dicts of all the combinations of param_grid
+    """
+    names = list(param_grid.keys())
+    return [dict(zip(names, values)) for values in product(*[param_grid[name] for name in names])]
+
+
+def _params_distance(params1: dict, params2: dict) -> float:
+    """
+    Distance between two gmm_params dicts, for choosing a model to warm-start from.
+    Models can be warm-started only from models with the same n_components and covariance_type (inf otherwise).
+    The distance is the sum of absolute (log scale for positive values) differences of the other numeric parameters.
+    """
+    for key in ['n_components', 'covariance_type']:
+        if params1.get(key) != params2.get(key):
+            return np.inf
+    dist = 0.0
+    for key in set(params1.keys()) | set(params2.keys()):
+        val1, val2 = params1.get(key), params2.get(key)
+        if isinstance(val1, (int, float)) and isinstance(val2, (int, float)) and \
+                not isinstance(val1, bool) and not isinstance(val2, bool):
+            dist += np.abs(np.log(val1) - np.log(val2)) if (val1 > 0 and val2 > 0) else np.abs(val1 - val2)
+        elif val1 != val2:
+            dist += 1.0
+    return dist
+
+
+_sweep_samples = None
+
+
+def _init_sweep_worker(samples: np.ndarray):
+    # keep the samples in each worker process, instead of pickling them per model
+    global _sweep_samples
+    _sweep_samples = samples
+
+
+def _fit_sweep_model(gmm_params: dict, init_model: BayesGMM = None, n_subsample: int = None,
+                     seed: int = None) -> (BayesGMM, dict):
+    """
+    Fit one model of the sweep on the worker's samples.
+    If init_model is given, the model is warm-started from it on the full data.
+    Otherwise, if n_subsample is given, the model is first fitted on a random subsample of n_subsample samples,
+    and then refined (warm-started) on the full data.
+    :return: the fitted model, and a dict of fit information (times, iterations and convergence)
+    """
+    samples = _sweep_samples
+    info = {'subsample_time': 0, 'subsample_n_iter': 0, 'subsample_converged': None}
+    if init_model is not None:
+        gmm = update_attributes(deepcopy(init_model), {**gmm_params, 'warm_start': True, 'n_init': 1})
+        info['prev_n_iter'] = init_model.n_iter_
+    else:
+        gmm = update_attributes(BayesGMM(), {'random_state': seed, **gmm_params})
+        info['prev_n_iter'] = 0
+        if n_subsample and n_subsample < len(samples):
+            rng = np.random.default_rng(seed)
+            sub_inds = rng.choice(len(samples), size=n_subsample, replace=False)
+            info['subsample_time'] = fit_gmm(gmm, samples[sub_inds])
+            info.update({'subsample_n_iter': gmm.n_iter_, 'subsample_converged': gmm.converged_})
+            gmm = update_attributes(gmm, {'warm_start': True, 'n_init': 1})
+    info['refine_time'] = fit_gmm(gmm, samples)
+    info.update({'fit_time': info['subsample_time'] + info['refine_time'],
+                 'converged': gmm.converged_, 'n_iter': gmm.n_iter_, 'warm_start': gmm.warm_start})
+    return gmm, info
+
+
+def run_sweep(param_grid: Union[dict, list[dict]], db_name: str, samples: np.ndarray, models_folder: os.path,
+              csv_models: os.path = 'models.csv', num_workers: int = 1, warm_start: bool = True,
+              n_subsample: int = None, seed: int = None,
+              model_base_name: str = 'sklearn_GMM_Model') -> pd.DataFrame:
+    """
+    Fit a sweep of BayesGMM models in parallel worker processes, and save each model and its row in csv_models
+    (as run() does for a single model).
+    The models are submitted by order of the grid. If warm_start is True, each model is warm-started from the
+    nearest finished model (see _params_distance()), if there is any.
+    Models without a model to start from are fitted on a subsample of n_subsample samples first (if given),
+    and then refined on the full data.
+    :param param_grid: dict of parameter name -> list of values (see get_sweep_grid()), or a list of gmm_params
+    :param db_name: name of the samples' database, saved to the table
+    :param samples: np.ndarray of the samples, of shape (n_samples, n_features)
+    :param models_folder: folder to save the models to
+    :param csv_models: path of the models table
+    :param num_workers: number of worker processes
+    :param warm_start: Whether to warm-start from finished models
+    :param n_subsample: size of the subsample for the initial fit. If None, fitting on the full data only.
+    :param seed: seed of the random states of the models and of the subsamples
+    :param model_base_name: base name of the saved models
+    :return: pd.DataFrame of the saved parameters of all the models of the sweep
+    """
+    grid = get_sweep_grid(param_grid) if isinstance(param_grid, dict) else list(param_grid)
+    seeds = [int(seed_seq.generate_state(1)[0]) for seed_seq in np.random.SeedSequence(seed).spawn(len(grid))]
+    # unique per sweep: sweeps that start in the same second don't overwrite each other's models and csv rows
+    sweep_name = f"{datetime.now().strftime('%H%M%S_%d%m')}_{uuid4().hex[:6]}"
+    finished = []  # list of (gmm_params, model, save_path)
+    rows = []
+    pending = list(range(len(grid)))
+    running = {}
+    with Pool(processes=max(1, num_workers), initializer=_init_sweep_worker, initargs=(samples,)) as pool:
+        while pending or running:
+            # submit models while there are free workers
+            while pending and len(running) < max(1, num_workers):
+                ind = pending.pop(0)
+                init_model, init_path = None, None
+                if warm_start and finished:
+                    dists = [_params_distance(grid[ind], params) for params, _, _ in finished]
+                    if np.min(dists) < np.inf:
+                        _, init_model, init_path = finished[int(np.argmin(dists))]
+                running[ind] = (pool.apply_async(_fit_sweep_model, (grid[ind], init_model, n_subsample, seeds[ind])),
+                                init_path)
+            # collect finished models
+            done = [ind for ind, (result, _) in running.items() if result.ready()]
+            if not done:
+                running[next(iter(running))][0].wait(timeout=1)
+                continue
+            for ind in done:
+                result, init_path = running.pop(ind)
+                try:
+                    gmm, info = result.get()
+                except Exception as e:
+                    print(f"Failed fitting model {grid[ind]}: {e}")
+                    continue
+                save_path = get_model_name(models_folder, model_base_name=model_base_name,
+                                           model_name_end=f"{sweep_name}_{ind}")
+                save_params = grid[ind].copy()
+                save_params.update({'model_path': init_path,
+                                    'start_time': f"{sweep_name}_{ind}",
+                                    'db_name': db_name,
+                                    'machine': platform.node(),
+                                    'save_path': save_path,
+                                    'n_subsample': n_subsample if init_path is None else None,
+                                    'seed': seeds[ind]})
+                save_params.update(info)
+                save_params['run_time'] = round(info['fit_time'])
+                save_model(gmm, save_path)
+                save_params_to_csv(save_params, csv_models)
+                finished.append((grid[ind], gmm, save_path))
+                rows.append(save_params)
+    return pd.DataFrame(rows)
+
+
 """ Pre-processing helper functions """
 
 
-def daily_backscatter_from_profiles(day_date: datetime, station: gs.Station, wavelength: int = 532,
-                                    df_calib: pd.DataFrame = None):
-    # set daily_datset_df.
-    # If df_calib is None, then generate a dataframe from TROPOS data at level1a
+def _get_daily_profiles_df(day_date: datetime, station: gs.Station, wavelength: int = 532,
+                           df_calib: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Dataframe of the TROPOS profiles of day_date, sorted by 'start_time_period'.
+    If df_calib is None, then generate a dataframe from TROPOS data at level1a
+    """
     if df_calib is None:
         profiles_paths = prep_utils.get_TROPOS_dataset_paths(station, day_date, file_type='profiles', level='level1a')
         profiles_paths.sort()
@@ -320,26 +477,22 @@ def daily_backscatter_from_profiles(day_date: datetime, station: gs.Station, wav
             (df_calib['wavelength'] == wavelength) & (pd.to_datetime(df_calib['date']) == day_date)]. \
             sort_values(by='start_time_period', ascending=True, ignore_index=True)
 
-    def _calc_mid_time(row):
-        # Set time of profile to the center of the time slice
-        dt_start = datetime.strptime(str(row['start_time_period']), '%Y-%m-%d %H:%M:%S')
-        dt_end = datetime.strptime(str(row['end_time_period']), '%Y-%m-%d %H:%M:%S')
-        dt_mid = dt_start + 0.5 * (dt_end - dt_start)
-        round_seconds = timedelta(seconds=dt_mid.second % 30)  # round according to time resolution of TROPOS
-        dt_mid += round_seconds
-        return dt_mid
+    return daily_datset_df
 
-    daily_datset_df['mid_time_period'] = daily_datset_df.apply(lambda row: _calc_mid_time(row), axis=1,
-                                                               result_type='expand')
-    # display(daily_datset_df)
 
-    ## % initialize dataset of daily_beta_chan (xr.DataSet)
+def _init_daily_beta_chan(day_date: datetime, station: gs.Station, wavelength: int = 532,
+                          beta: np.ndarray = None) -> xr.Dataset:
+    """
+    Initialize daily dataset of beta (Wavelength, Height, Time)
+    :param beta: np.ndarray of shape (Height, Time) to set as the values of beta. If None, the values are not set.
+    """
     heightIndx = station.get_height_bins_values()
     timeIndx = station.calc_daily_time_index(day_date)
     height_units = 'km'
+    if beta is None:
+        beta = np.empty((heightIndx.shape[0], timeIndx.shape[0]))
 
-    daily_beta_chan = xr.Dataset(data_vars={'beta': (('Height', 'Time', 'Wavelength'),
-                                                     np.empty((heightIndx.shape[0], timeIndx.shape[0], 1)))},
+    daily_beta_chan = xr.Dataset(data_vars={'beta': (('Height', 'Time', 'Wavelength'), beta[:, :, np.newaxis])},
                                  coords={'Height': heightIndx, 'Time': timeIndx, 'Wavelength': [wavelength]})
     daily_beta_chan.beta.attrs = {'long_name': r'$\beta $',
                                   'units': r'$\rm \frac{1}{km \cdot sr}$',
@@ -355,6 +508,28 @@ def daily_backscatter_from_profiles(day_date: datetime, station: gs.Station, wav
     daily_beta_chan = daily_beta_chan.transpose('Wavelength', 'Height', 'Time')
     daily_beta_chan['date'] = day_date
 
+    return daily_beta_chan
+
+
+def daily_backscatter_from_profiles(day_date: datetime, station: gs.Station, wavelength: int = 532,
+                                    df_calib: pd.DataFrame = None):
+    daily_datset_df = _get_daily_profiles_df(day_date, station, wavelength, df_calib)
+
+    def _calc_mid_time(row):
+        # Set time of profile to the center of the time slice
+        dt_start = datetime.strptime(str(row['start_time_period']), '%Y-%m-%d %H:%M:%S')
+        dt_end = datetime.strptime(str(row['end_time_period']), '%Y-%m-%d %H:%M:%S')
+        dt_mid = dt_start + 0.5 * (dt_end - dt_start)
+        round_seconds = timedelta(seconds=dt_mid.second % 30)  # round according to time resolution of TROPOS
+        dt_mid += round_seconds
+        return dt_mid
+
+    daily_datset_df['mid_time_period'] = daily_datset_df.apply(lambda row: _calc_mid_time(row), axis=1,
+                                                               result_type='expand')
+    # display(daily_datset_df)
+
+    daily_beta_chan = _init_daily_beta_chan(day_date, station, wavelength)
+
     ## Loading beta profiles and save into  daily_beta_chan
     Pollynet_key = f'aerBsc_klett_{wavelength}'
     valids = []
@@ -381,34 +556,128 @@ def daily_backscatter_from_profiles(day_date: datetime, station: gs.Station, wav
     return daily_beta_chan, daily_datset_df
 
 
+def _read_profile_column(profile_path: str, key: str) -> np.ndarray:
+    # Load one profile of a TROPOS profiles file
+    with xr.open_dataset(profile_path, engine='netcdf4') as profile_ds:
+        return profile_ds[key].values
+
+
+def period_backscatter_from_profiles(days: list[datetime], station: gs.Station, wavelength: int = 532,
+                                     df_calib: pd.DataFrame = None, num_workers: int = 1) -> (list, pd.DataFrame):
+    """
+    Same as daily_backscatter_from_profiles() for a list of days.
+    The profiles of all the days are read in parallel (by num_workers processes), the mid times are calculated
+    vectorially, and the valid profiles of each day are set to the daily array in one step.
+    Times without a valid profile are set to nan.
+    :param days: list of datetime.datetime objects of the days
+    :param station: gs.station() object of the lidar station
+    :param wavelength: wavelength [nm]
+    :param df_calib: pd.DataFrame of the calibration profiles. If None, using TROPOS level1a profiles
+    :param num_workers: number of processes to read the profiles files
+    :return: list of daily_beta_chan (xr.Dataset) per day, and pd.DataFrame of the profiles of all days
+     (with the columns 'mid_time_period' and 'valid')
+    """
+    days_df = [_get_daily_profiles_df(day_date, station, wavelength, df_calib) for day_date in days]
+    datset_df = pd.concat(days_df, keys=range(len(days)), names=['day_ind']).reset_index(level='day_ind')
+
+    # Set time of profiles to the center of the time slices, rounded according to time resolution of TROPOS
+    dt_start = pd.to_datetime(datset_df['start_time_period'].astype(str))
+    dt_end = pd.to_datetime(datset_df['end_time_period'].astype(str))
+    dt_mid = dt_start + 0.5 * (dt_end - dt_start)
+    datset_df['mid_time_period'] = dt_mid + pd.to_timedelta(dt_mid.dt.second % 30, unit='s')
+
+    ## Loading beta profiles of all days
+    Pollynet_key = f'aerBsc_klett_{wavelength}'
+    print(f"Loading {len(datset_df)} profiles of {len(days)} days at {wavelength}...")
+    read_args = [(profile_path, Pollynet_key) for profile_path in datset_df.profile_path]
+    if num_workers > 1:
+        with Pool(processes=num_workers) as pool:
+            profiles = pool.starmap(_read_profile_column, read_args)
+    else:
+        profiles = [_read_profile_column(*args) for args in read_args]
+    profiles = np.vstack(profiles) if profiles else np.empty((0, station.get_height_bins_values().shape[0]))
+    datset_df['valid'] = ~np.isnan(profiles).all(axis=1)
+    print(f"Done loading data.")
+
+    daily_beta_chans = []
+    for day_ind, day_date in enumerate(days):
+        timeIndx = station.calc_daily_time_index(day_date)
+        day_mask = (datset_df['day_ind'] == day_ind).values & datset_df['valid'].values
+        time_inds = timeIndx.get_indexer(datset_df.loc[day_mask, 'mid_time_period'])
+        if (time_inds < 0).any():
+            print(f"{(time_inds < 0).sum()} profiles of {day_date.strftime('%Y-%m-%d')} are out of the time index")
+        beta = np.full((profiles.shape[1], timeIndx.shape[0]), np.nan)
+        beta[:, time_inds[time_inds >= 0]] = profiles[day_mask][time_inds >= 0].T
+        # Convert from 1/(mr sr) to 1/(km sr)
+        daily_beta_chans.append(prep_utils.convert_profiles_units(
+            _init_daily_beta_chan(day_date, station, wavelength, beta)))
+
+    return daily_beta_chans, datset_df.reset_index(drop=True)
+
+
 def sample_grid_weights(XY_grid: np.ndarray,
                         weights: xr.DataArray,
-                        n_iter=10, total_samples=10000):
+                        n_iter=10, total_samples=10000,
+                        fast: bool = True, seed=None, plot: bool = True, return_counts: bool = False):
+    """
+    Sample (x,y) locations of the grid according to the weights of the grid cells.
+    :param XY_grid: np.ndarray of the meshgrid (X,Y) of the grid cells
+    :param weights: xr.DataArray of the weights, in the shape of the grid
+    :param n_iter: number of sampling iterations (used only if fast=False)
+    :param total_samples: number of samples to draw
+    :param fast: If True, all the samples are drawn in one call, by inverse-CDF lookup of the cumulative weights,
+     using np.random.Generator seeded by `seed`. Otherwise, using random.choices() in n_iter rounds.
+    :param seed: seed for np.random.default_rng() (used only if fast=True)
+    :param plot: Whether to show scatter of the samples
+    :param return_counts: Whether to return also the counts of samples per grid cell
+     (same as the histogram of calc_2D_hist(), without the separate pass)
+    :return: samples_df - pd.DataFrame() of the samples with columns ['x','y'],
+     and if return_counts is True, also counts_da - xr.DataArray of the counts, in the shape of weights.
+    """
     # estimate xy samples
 
     X = XY_grid[0]
     Y = XY_grid[1]
     weight_vector = weights.values.reshape(X.size)
     XY = np.vstack([X.reshape(X.size), Y.reshape(X.size)])
-    sampels_per_iter = round(total_samples / n_iter)
-    XY_s = []
-    for n_samples in range(n_iter):
-        # Sample indexes of (x,y) locations according to weight vector
-        inds = random.choices(population=np.arange(weight_vector.shape[0]),  # list to pick from
-                              weights=weight_vector,  # weights of the population, in order
-                              k=sampels_per_iter,  # amount of samples to draw
-
-                              )
+    if fast:
+        rng = np.random.default_rng(seed)
+        cum_weights = np.cumsum(weight_vector)
+        inds = np.searchsorted(cum_weights, rng.random(total_samples) * cum_weights[-1], side='right')
+        inds = np.minimum(inds, weight_vector.size - 1)  # guard against float round-off at the last cell
         inds.sort()
-        XY_s.append(XY[:, inds])
-
-    XY_samples = np.concatenate(XY_s, axis=1)
-
-    # Show scatter of samples
-    plt.scatter(XY_samples[0], XY_samples[1], s=.1)
-    plt.show()
+        XY_samples = XY[:, inds]
+    else:
+        sampels_per_iter = round(total_samples / n_iter)
+        XY_s = []
+        inds_s = []
+        for n_samples in range(n_iter):
+            # Sample indexes of (x,y) locations according to weight vector
+            inds = py_random.choices(population=np.arange(weight_vector.shape[0]),  # list to pick from
+                                     weights=weight_vector,  # weights of the population, in order
+                                     k=sampels_per_iter,  # amount of samples to draw
+
+                                     )
+            inds.sort()
+            XY_s.append(XY[:, inds])
+            inds_s.append(inds)
+
+        XY_samples = np.concatenate(XY_s, axis=1)
+        inds = np.concatenate(inds_s)
+
+    if plot:
+        # Show scatter of samples
+        plt.scatter(XY_samples[0], XY_samples[1], s=.1)
+        plt.show()
     samples_df = pd.DataFrame(XY_samples.T, columns=['x', 'y'])
-    return samples_df
+    if not return_counts:
+        return samples_df
+
+    counts_da = xr.zeros_like(weights)
+    counts_da.data = np.bincount(inds, minlength=weight_vector.size).reshape(weights.shape)
+    counts_da.attrs = {'name': 'Histogram', 'units': 'counts', 'long_name': r'$N_s$',
+                       'info': rf"2D histogram of grid samples, sample number {len(samples_df)}"}
+    return samples_df, counts_da
 
 
 def calc_2D_hist(XY_grid: np.array, samples_df: pd.DataFrame, weights: xr.DataArray, sample_source_name: str,
@@ -475,10 +744,10 @@ def calc_beta_from_gmm(gmm: BayesGMM, gmm_name: str, XY_grid: np.ndarray,
 
 """Kolmogorov-Smirnov test (2D)"""
 
-__all__ = ['ks2d2s', 'estat', 'estat2d']
+__all__ = ['ks2d2s', 'estat', 'estat2d', 'fast_estat']
 
 
-def ks2d2s(x1, y1, x2, y2, nboot=None, extra=False):
+def ks2d2s(x1, y1, x2, y2, nboot=None, extra=False, fast=True, seed=None, njobs=1):
     '''Two-dimensional Kolmogorov-Smirnov test on two samples.
     Parameters
     ----------
@@ -488,6 +757,13 @@ def ks2d2s(x1, y1, x2, y2, nboot=None, extra=False):
         Data of sample 2. Size of two samples can be different.
     extra: bool, optional
         If True, KS statistic is also returned. Default is False.
+    fast: bool, optional
+        If True (default), the statistic is calculated by fast_avgmaxdist() - O(n log n),
+        otherwise by avgmaxdist() - O(n^2). Both give the same statistic.
+    seed: int, optional
+        Seed of the bootstrap resampling (when `fast` is True). Default is None.
+    njobs: int, optional
+        Number of processes for the bootstrap (when `fast` is True). Default is 1.
 
     Returns
     -------
@@ -509,7 +785,7 @@ def ks2d2s(x1, y1, x2, y2, nboot=None, extra=False):
     '''
     assert (len(x1) == len(y1)) and (len(x2) == len(y2))
     n1, n2 = len(x1), len(x2)
-    D = avgmaxdist(x1, y1, x2, y2)
+    D = fast_avgmaxdist(x1, y1, x2, y2) if fast else avgmaxdist(x1, y1, x2, y2)
 
     if nboot is None:
         sqen = np.sqrt(n1 * n2 / (n1 + n2))
@@ -518,6 +794,20 @@ def ks2d2s(x1, y1, x2, y2, nboot=None, extra=False):
         r = np.sqrt(1 - 0.5 * (r1 ** 2 + r2 ** 2))
         d = D * sqen / (1 + r * (0.25 - 0.75 / sqen))
         p = kstwobign.sf(d)
+    elif fast:
+        x = np.concatenate([x1, x2])
+        y = np.concatenate([y1, y2])
+        njobs = max(1, min(njobs, nboot))
+        # Independent streams per worker, and the bootstraps are split evenly between the workers
+        seeds = np.random.SeedSequence(seed).spawn(njobs)
+        nboots = [len(inds) for inds in np.array_split(np.arange(nboot), njobs)]
+        args = [(x, y, n1, cur_nboot, cur_seed) for cur_nboot, cur_seed in zip(nboots, seeds)]
+        if njobs > 1:
+            with Pool(njobs) as pool:
+                d = np.concatenate(pool.starmap(_ks2d_bootstrap, args))
+        else:
+            d = _ks2d_bootstrap(*args[0])
+        p = np.sum(d > D).astype('f') / nboot
     else:
         n = n1 + n2
         x = np.concatenate([x1, x2])
@@ -568,6 +858,99 @@ def quadct(x, y, xx, yy):
     return a, b, c, d
 
 
+def _ks2d_bootstrap(x, y, n1, nboot, seed):
+    """
+    Bootstrap of the 2D KS statistic, by resampling (with replacement) the pooled sample (x, y).
+    :param x, y: ndarray, the pooled sample
+    :param n1: size of the first sample
+    :param nboot: number of bootstrap samples
+    :param seed: np.random.SeedSequence (or an int) of the resampling
+    :return: ndarray of the nboot bootstrap statistics
+    """
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    d = np.empty(nboot, 'f')
+    for i in range(nboot):
+        idx = rng.choice(n, n, replace=True)
+        ix1, ix2 = idx[:n1], idx[n1:]
+        d[i] = fast_avgmaxdist(x[ix1], y[ix1], x[ix2], y[ix2])
+    return d
+
+
+def fast_avgmaxdist(x1, y1, x2, y2):
+    """
+    Same as avgmaxdist(), with quadrant counts by fast_quadct() - O(n log n) instead of O(n^2).
+    """
+    D1 = fast_maxdist(x1, y1, x2, y2)
+    D2 = fast_maxdist(x2, y2, x1, y1)
+    return (D1 + D2) / 2
+
+
+def fast_maxdist(x1, y1, x2, y2):
+    """
+    Same as maxdist(), with quadrant counts by fast_quadct().
+    """
+    n1 = len(x1)
+    D1 = fast_quadct(x1, y1, x1, y1) - fast_quadct(x1, y1, x2, y2)
+
+    # re-assign the point to maximize difference,
+    # the discrepancy is significant for N < ~50
+    D1[:, 0] -= 1 / n1
+
+    dmin, dmax = -D1.min(), D1.max() + 1 / n1
+    return max(dmin, dmax)
+
+
+def fast_quadct(x, y, xx, yy):
+    """
+    Same as quadct(), for all the points (x, y) at once.
+    The count of the lower-left quadrant is calculated by a sweep over the sorted xx,
+    inserting the ranks of yy into a Fenwick tree (binary indexed tree). The other quadrants are derived from it,
+    and from the counts of xx <= x and yy <= y.
+    :param x, y: ndarray, shape (n, ), the points to count around
+    :param xx, yy: ndarray, shape (m, ), the sample to count
+    :return: ndarray, shape (n, 4), the fractions (a, b, c, d) of quadct() for each point
+    """
+    x, y, xx, yy = np.asarray(x), np.asarray(y), np.asarray(xx), np.asarray(yy)
+    m = len(xx)
+    y_vals = np.unique(yy)
+    yy_ranks = (np.searchsorted(y_vals, yy, side='left') + 1).tolist()  # 1-based ranks for the tree
+    y_ranks = np.searchsorted(y_vals, y, side='right').tolist()  # number of distinct yy values <= y
+
+    xx_order = np.argsort(xx, kind='stable')
+    x_order = np.argsort(x, kind='stable')
+    # Number of sample points with xx <= x, for each point (in the order of x_order)
+    n_insert = np.searchsorted(xx[xx_order], x[x_order], side='right').tolist()
+    xx_order = xx_order.tolist()
+
+    size = len(y_vals)
+    tree = [0] * (size + 1)
+    n_ll = [0] * len(x)
+    inserted = 0
+    for ind, n_cur in zip(x_order.tolist(), n_insert):
+        while inserted < n_cur:
+            i = yy_ranks[xx_order[inserted]]
+            while i <= size:
+                tree[i] += 1
+                i += i & -i
+            inserted += 1
+        j = y_ranks[ind]
+        count = 0
+        while j > 0:
+            count += tree[j]
+            j -= j & -j
+        n_ll[ind] = count
+
+    n_ll = np.array(n_ll, dtype=np.int64)
+    n_x = np.searchsorted(np.sort(xx), x, side='right')
+    n_y = np.searchsorted(np.sort(yy), y, side='right')
+    a = n_ll / m
+    b = (n_x - n_ll) / m
+    c = (n_y - n_ll) / m
+    d = 1 - a - b - c
+    return np.column_stack([a, b, c, d])
+
+
 def estat2d(x1, y1, x2, y2, **kwds):
     return estat(np.c_[x1, y1], np.c_[x2, y2], **kwds)
 
@@ -608,6 +991,113 @@ def estat(x, y, nboot=1000, replace=False, method='log', fitting=False):
         return p, en, en_boot
 
 
+def fast_estat(x, y, nboot=1000, replace=False, method='log', fitting=False, seed=None, njobs=1,
+               batch_size=100, max_memory=1e9):
+    '''
+    Same as estat(), where the pooled pairwise distances (transformed by `method`) are calculated only once.
+    Each permutation is represented by the weights of the pooled points in the two groups, so the statistics of
+    a batch of permutations are sums of matrix products with the distance matrix.
+    The batches are processed by njobs threads (the matrix products release the GIL), each with its own stream
+    spawned from `seed`.
+    If the distance matrix is larger than `max_memory` [bytes], it is not stored, and the distances are
+    calculated block-wise (per batch of permutations).
+    Note: duplicated points are ignored when resampling with replacement, i.e., their distance is taken as 0
+    (in estat() they give an infinite statistic for method='log').
+    '''
+    n, N = len(x), len(x) + len(y)
+    m = N - n
+    stack = np.vstack([x, y])
+    stack = (stack - stack.mean(0)) / stack.std(0)
+
+    block_size = N
+    if 8 * N ** 2 > max_memory:
+        block_size = max(1, int(max_memory // (8 * N)))
+        dists = None
+    else:
+        dists = _energy_transform(squareform(pdist(stack)), method)
+        np.fill_diagonal(dists, 0)
+        if not np.isfinite(dists).all():
+            warnings.warn("Found duplicated points, the statistics are not finite for method='log'")
+
+    weights_xy = np.zeros((2, 1, N))
+    weights_xy[0, 0, :n], weights_xy[1, 0, n:] = 1, 1
+    en = _energy_from_weights(weights_xy[0], weights_xy[1], stack, dists, method, block_size)[0]
+
+    batches = [len(inds) for inds in np.array_split(np.arange(nboot), int(np.ceil(nboot / batch_size)))]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+
+    def _batch_energy(n_perm, batch_seed):
+        weights_x, weights_y = _energy_group_weights(N, n, n_perm, replace, np.random.default_rng(batch_seed))
+        return _energy_from_weights(weights_x, weights_y, stack, dists, method, block_size)
+
+    with ThreadPool(max(1, njobs)) as pool:
+        en_boot = np.concatenate(pool.starmap(_batch_energy, zip(batches, seeds))).astype('f')
+
+    if fitting:
+        param = genextreme.fit(en_boot)
+        p = genextreme.sf(en, *param)
+        return p, en, param
+    else:
+        p = (en_boot >= en).sum() / nboot
+        return p, en, en_boot
+
+
+def _energy_transform(dists, method='log'):
+    if method == 'log':
+        with np.errstate(divide='ignore'):
+            return np.log(dists)
+    elif method == 'gaussian':
+        raise NotImplementedError
+    elif method == 'linear':
+        return dists
+    else:
+        raise ValueError
+
+
+def _energy_group_weights(N, n, n_perm, replace, rng):
+    """
+    Random assignments of the pooled points to two groups (of sizes n and N-n), as in estat().
+    :return: weights_x, weights_y - ndarrays of shape (n_perm, N), the number of times each pooled point
+    is in the first and in the second group, per permutation.
+    """
+    if replace:
+        idx = rng.integers(N, size=(n_perm, N))
+    else:
+        idx = rng.permuted(np.tile(np.arange(N), (n_perm, 1)), axis=1)
+    rows = np.arange(n_perm)[:, None]
+    weights_x, weights_y = np.zeros((n_perm, N)), np.zeros((n_perm, N))
+    np.add.at(weights_x, (rows, idx[:, :n]), 1)
+    np.add.at(weights_y, (rows, idx[:, n:]), 1)
+    return weights_x, weights_y
+
+
+def _energy_from_weights(weights_x, weights_y, stack, dists=None, method='log', block_size=None):
+    """
+    The energy statistics of energy() for the groups given by weights (see _energy_group_weights()).
+    :param dists: the transformed pooled distance matrix with a zero diagonal.
+    If None, the distances are calculated from stack in blocks of block_size rows.
+    :return: ndarray of the statistics, one per row of the weights
+    """
+    n, m = weights_x[0].sum(), weights_y[0].sum()
+    if dists is not None:
+        dists_x, dists_y = weights_x @ dists, weights_y @ dists
+        s_xy = (dists_x * weights_y).sum(1)
+        s_xx = (dists_x * weights_x).sum(1) / 2
+        s_yy = (dists_y * weights_y).sum(1) / 2
+    else:
+        N = len(stack)
+        s_xy, s_xx, s_yy = np.zeros(len(weights_x)), np.zeros(len(weights_x)), np.zeros(len(weights_x))
+        for start in range(0, N, block_size):
+            stop = min(start + block_size, N)
+            dists_block = _energy_transform(cdist(stack, stack[start:stop]), method)
+            dists_block[np.arange(start, stop), np.arange(stop - start)] = 0
+            dists_x, dists_y = weights_x @ dists_block, weights_y @ dists_block
+            s_xy += (dists_x * weights_y[:, start:stop]).sum(1)
+            s_xx += (dists_x * weights_x[:, start:stop]).sum(1) / 2
+            s_yy += (dists_y * weights_y[:, start:stop]).sum(1) / 2
+    return s_xy / (n * m) - s_xx / n ** 2 - s_yy / m ** 2
+
+
 def energy(x, y, method='log'):
     dx, dy, dxy = pdist(x), pdist(y), cdist(x, y)
     n, m = len(x), len(y)
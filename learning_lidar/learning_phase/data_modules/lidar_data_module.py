@@ -1,15 +1,17 @@
 import os
+import warnings
 from typing import Optional
 
 import numpy as np
 import pandas as pd
+import ray
 import torch
 import torchvision
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader, random_split
 
 import learning_lidar.utils.xr_utils as xr_utils
-from learning_lidar.learning_phase.learn_utils.custom_operations import XR2Tensor, ApplyPoisson
+from learning_lidar.learning_phase.learn_utils.custom_operations import XR2Tensor, ApplyPoisson, BatchTransform
 
 
 class LidarDataSet(torch.utils.data.Dataset):
@@ -125,11 +127,117 @@ class LidarDataSet(torch.utils.data.Dataset):
         return key_val
 
 
+class InMemoryLidarDataSet(torch.utils.data.Dataset):
+    """
+    Lidar dataset of samples that are already loaded and converted to tensors (see load_lidar_arrays()).
+    Only the remaining (e.g., random) transforms are applied per sample.
+    """
+
+    def __init__(self, arrays: dict, transforms=None):
+        """
+
+        :param arrays: dict of np.ndarray with keys 'x', 'y', 'wavelength' (of all samples, the first axis is the
+        sample index). The arrays can be read-only (e.g., shared by ray's object store), and they are not modified.
+        :param transforms: transforms to apply on X, after XR2Tensor()
+        """
+        with warnings.catch_warnings():
+            # the shared arrays are not writable, and the samples are cloned before applying transforms
+            warnings.simplefilter('ignore', UserWarning)
+            self.X = torch.from_numpy(arrays['x'])
+            self.Y = torch.from_numpy(arrays['y'])
+            self.wavelength = torch.from_numpy(arrays['wavelength'])
+        self.transforms = transforms
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, idx):
+        X = self.X[idx].clone()  # the transforms may work in place (e.g. ApplyPoisson)
+        if self.transforms:
+            X = self.transforms(X)
+        sample = {'x': X, 'y': self.Y[idx], 'wavelength': self.wavelength[idx]}
+        return sample
+
+    get_splits = LidarDataSet.get_splits
+
+
+def load_lidar_arrays(dataset_csv_file, data_folder, top_height, X_features, profiles, Y_features,
+                      filter_by, filter_values, num_workers=0, batch_size=64) -> dict:
+    """
+    Load all the (filtered) samples of a LidarDataSet, converted to tensors, as numpy arrays.
+    :param num_workers: number of DataLoader workers to load the samples with
+    :param batch_size: number of samples to load per worker call
+    For the other parameters see LidarDataSet()
+    :return: dict of np.ndarray with keys 'x' (samples, channels, height, time), 'y' (samples, Y_features)
+    and 'wavelength' (samples)
+    """
+    dataset = LidarDataSet(dataset_csv_file=dataset_csv_file, data_folder=data_folder, transforms=XR2Tensor(),
+                           top_height=top_height, X_features=X_features, profiles=profiles, Y_features=Y_features,
+                           filter_by=filter_by, filter_values=filter_values)
+    batches = list(DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers))
+    return {key: torch.cat([batch[key] for batch in batches]).numpy() for key in ['x', 'y', 'wavelength']}
+
+
+SHARED_DATA_ACTOR = 'lidar_shared_data'
+
+
+@ray.remote
+class SharedLidarData:
+    """
+    Ray actor holding the loaded lidar arrays in the object store, per data configuration.
+    The actor owns the objects, so they outlive the trials that requested them.
+    Requests are served one at a time, so concurrent trials wait for the first loading instead of repeating it.
+    """
+
+    def __init__(self):
+        self.refs = {}
+
+    def get(self, key: str, dataset_kwargs: dict) -> list:
+        if key not in self.refs:
+            self.refs[key] = ray.put(load_lidar_arrays(**dataset_kwargs))
+        # wrapped in a list, so the caller gets the reference and not a copy of the arrays
+        return [self.refs[key]]
+
+
+def get_shared_lidar_arrays(num_workers=0, **dataset_kwargs) -> dict:
+    """
+    Get the arrays of load_lidar_arrays(**dataset_kwargs), loaded once per node and shared by all trials.
+    The numpy arrays are read from ray's object store zero-copy.
+    If ray is not initialized, the arrays are loaded locally.
+    :param num_workers: number of DataLoader workers for the first loading
+    :param dataset_kwargs: parameters of load_lidar_arrays()
+    :return: dict of np.ndarray (read-only if shared)
+    """
+    if not ray.is_initialized():
+        return load_lidar_arrays(num_workers=num_workers, **dataset_kwargs)
+    try:
+        store = ray.get_actor(SHARED_DATA_ACTOR)
+    except ValueError:
+        try:
+            store = SharedLidarData.options(name=SHARED_DATA_ACTOR, lifetime='detached').remote()
+        except ValueError:
+            # created by another trial in the meantime
+            store = ray.get_actor(SHARED_DATA_ACTOR)
+    key = repr(sorted(dataset_kwargs.items()))
+    refs = ray.get(store.get.remote(key, {'num_workers': num_workers, **dataset_kwargs}))
+    return ray.get(refs[0])
+
+
 class LidarDataModule(LightningDataModule):
     def __init__(self, nn_data_folder, train_csv_path, test_csv_path, stats_csv_path,
                  powers, top_height, X_features_profiles, Y_features, batch_size, num_workers,
                  val_length=0.2, test_length=0.2, data_filter=None, data_norm: bool = False,
-                 shuffle_train: bool = True):
+                 shuffle_train: bool = True, shared_data: bool = False, shared_num_workers: int = 0,
+                 batch_transforms: bool = False, seed: int = None):
+        """
+        For the data parameters see LidarDataSet()
+        :param shared_data: If True, the train set is loaded once to memory and shared by all the trials that use the
+        same data (see get_shared_lidar_arrays()), instead of reading the samples' files by each trial.
+        :param shared_num_workers: number of workers for the first loading of the shared data
+        :param batch_transforms: If True, the Poisson noise and the normalization are applied on whole batches
+        (after the transfer to the device, see BatchTransform()), instead of per sample in the DataLoader workers.
+        :param seed: seed of the Poisson noise of batch_transforms
+        """
         super().__init__()
         self.test = None
         self.val = None
@@ -155,6 +263,11 @@ class LidarDataModule(LightningDataModule):
         self.data_norm = data_norm
         self.stats = self.calc_stats() if self.data_norm else None  # avoid loading stats if data_norm is disabled
         self.shffle_train = shuffle_train
+        self.shared_data = shared_data
+        self.shared_num_workers = shared_num_workers
+        self.batch_transforms = batch_transforms
+        self.seed = seed
+        self.batch_transform = None
 
     def calc_stats(self):
         stats_df = pd.read_csv(self.stats_csv_path)
@@ -198,16 +311,33 @@ class LidarDataModule(LightningDataModule):
 
         # Step 1. Set transforms to be applied on the data
         transforms_list = [XR2Tensor()]
-        if 'p_bg_poiss' in self.profiles:
+        if self.batch_transforms:
+            self.batch_transform = BatchTransform(
+                poisson_channel=2 if 'p_bg_poiss' in self.profiles else None,
+                mean=self.stats['x']['mean'] if self.data_norm else None,
+                std=self.stats['x']['std'] if self.data_norm else None,
+                seed=self.seed)
+        elif 'p_bg_poiss' in self.profiles:
             transforms_list.append(ApplyPoisson(channel=2))
-        if self.data_norm:
+        if self.data_norm and not self.batch_transforms:
             transforms_list.append(torchvision.transforms.Normalize(mean=tuple(self.stats['x']['mean']),
                                                                     std=tuple(self.stats['x']['std'])))
 
         transforms = torchvision.transforms.Compose(transforms_list)
 
         # Step 2. Load and split Datasets
-        if stage == 'fit' or stage is None:
+        if (stage == 'fit' or stage is None) and self.shared_data:
+            arrays = get_shared_lidar_arrays(num_workers=self.shared_num_workers,
+                                             dataset_csv_file=self.train_csv_path, data_folder=self.nn_data_folder,
+                                             top_height=self.top_height, X_features=self.X_features,
+                                             profiles=self.profiles, Y_features=self.Y_features,
+                                             filter_by=self.filter_by, filter_values=self.filter_values)
+            # XR2Tensor() was already applied when loading the data
+            trainable_dataset = InMemoryLidarDataSet(arrays,
+                                                     transforms=torchvision.transforms.Compose(transforms_list[1:]))
+            self.train, self.val = trainable_dataset.get_splits(n_val=self.val_length, n_test=0)
+
+        elif stage == 'fit' or stage is None:
             trainable_dataset = LidarDataSet(dataset_csv_file=self.train_csv_path, data_folder=self.nn_data_folder,
                                              transforms=transforms, top_height=self.top_height,
                                              X_features=self.X_features, profiles=self.profiles,
@@ -223,6 +353,11 @@ class LidarDataModule(LightningDataModule):
                                      profiles=self.profiles, Y_features=self.Y_features, filter_by=self.filter_by,
                                      filter_values=self.filter_values)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.batch_transform is not None:
+            batch['x'] = self.batch_transform(batch['x'])
+        return batch
+
     def train_dataloader(self):
         return DataLoader(self.train, batch_size=self.batch_size, shuffle=self.shffle_train,
                           num_workers=self.num_workers)
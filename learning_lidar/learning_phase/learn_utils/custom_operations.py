@@ -82,3 +82,42 @@ class ApplyPoisson(object):
         else:
             x[self.c] = torch.poisson(x[self.c])
         return x
+
+
+class BatchTransform(object):
+    """
+    Poisson noise and normalization of a whole batch of samples [B, C, H, W], on the batch's device.
+    Replaces the per-sample ApplyPoisson() and torchvision.transforms.Normalize().
+    The Poisson noise is drawn from a seeded generator (one per device), so it is reproducible.
+    """
+
+    def __init__(self, poisson_channel=None, mean=None, std=None, seed=None):
+        """
+        :param poisson_channel: channel to apply Poisson noise on. If None, no noise is applied.
+        :param mean: list of mean values per channel. If None, no normalization is applied.
+        :param std: list of std values per channel
+        :param seed: seed of the Poisson noise generator
+        """
+        self.c = poisson_channel
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1) if mean is not None else None
+        self.std = torch.tensor(std).view(1, -1, 1, 1) if std is not None else None
+        self.seed = seed
+        self.generators = {}
+
+    def get_generator(self, device):
+        if device not in self.generators:
+            generator = torch.Generator(device=device)
+            if self.seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(self.seed)
+            self.generators[device] = generator
+        return self.generators[device]
+
+    def __call__(self, x):
+        if self.c is not None:
+            x = x.clone()
+            x[:, self.c] = torch.poisson(x[:, self.c], generator=self.get_generator(x.device))
+        if self.mean is not None:
+            x = (x - self.mean.to(x)) / self.std.to(x)
+        return x
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from functools import lru_cache
+
+import pandas as pd
+
+LR_CACHE_KEY_PARAMS = ['hidden_sizes', 'fc_size', 'loss_type', 'X_features', 'powers', 'opt_powers', 'data_filter',
+                       'data_norm', 'fused_norm', 'batch_size', 'train_csv_checksum']
+
+
+@lru_cache(maxsize=None)
+def _file_checksum(path: str, mtime: float, size: int) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def file_checksum(path: str) -> str:
+    """
+    MD5 checksum of a file (computed once per file version)
+    :param path: path of the file
+    :return: the hex digest of the file's content
+    """
+    stat = os.stat(path)
+    return _file_checksum(os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+
+def get_lr_cache_params(config: dict, consts: dict, X_features, powers, dfilter) -> dict:
+    """
+    The parameters that determine the result of the learning rate finder of a trial
+    :param config: hyper parameters of the trial, after update_params()
+    :param consts: constants of the experiment (e.g. CONSTS)
+    :param X_features: X features of the trial, as returned by update_params()
+    :param powers: powers of the trial, as returned by update_params()
+    :param dfilter: data filter of the trial, as returned by update_params()
+    :return: dict of the parameters (see LR_CACHE_KEY_PARAMS)
+    """
+    used_profiles = [profile for _, profile in X_features] + list(consts['Y_features'])
+    return {'hidden_sizes': str(eval(config['hsizes'])),
+            'fc_size': str(eval(config['fc_size'])),
+            'loss_type': config['ltype'],
+            'X_features': str([list(feature) for feature in X_features]),
+            'powers': str({profile: powers[profile] for profile in used_profiles})
+            if (config['use_power'] and powers) else str(None),
+            'opt_powers': bool(config.get('opt_powers', False)),
+            'data_filter': str(dfilter if dfilter else None),
+            'data_norm': bool(config['dnorm']),
+            # normalization after the power (by the model, see PowerNormLayer), instead of before it (by the data)
+            'fused_norm': bool(config['dnorm'] and consts.get('fused_norm', False)),
+            'batch_size': int(config['bsize']),
+            'train_csv_checksum': file_checksum(consts['train_csv_path'])}
+
+
+def get_lr_cache_key(params: dict) -> str:
+    """
+    :param params: dict of the parameters that determine the learning rate (see get_lr_cache_params())
+    :return: hash of the parameters
+    """
+    key_params = {key: params[key] for key in LR_CACHE_KEY_PARAMS}
+    return hashlib.sha1(json.dumps(key_params, sort_keys=True).encode()).hexdigest()
+
+
+def load_lr_cache(cache_path: str) -> pd.DataFrame:
+    """
+    :param cache_path: path of the cache csv file
+    :return: pd.DataFrame() of the cached learning rates, with the last entry per key (empty if no cache)
+    """
+    if not os.path.exists(cache_path):
+        return pd.DataFrame(columns=['key', 'lr', 'date'] + LR_CACHE_KEY_PARAMS)
+    lr_cache_df = pd.read_csv(cache_path)
+    return lr_cache_df.drop_duplicates(subset='key', keep='last').reset_index(drop=True)
+
+
+def get_cached_lr(cache_path: str, key: str):
+    """
+    :param cache_path: path of the cache csv file
+    :param key: cache key (see get_lr_cache_key())
+    :return: the cached learning rate, or None if the key is not cached
+    """
+    lr_cache_df = load_lr_cache(cache_path)
+    lr_rows = lr_cache_df.loc[lr_cache_df.key == key, 'lr']
+    return float(lr_rows.iloc[0]) if len(lr_rows) else None
+
+
+def save_lr_to_cache(cache_path: str, key: str, lr: float, params: dict):
+    """
+    Append a learning rate to the cache. A single line is appended, so trials can write to the cache concurrently.
+    :param cache_path: path of the cache csv file
+    :param key: cache key (see get_lr_cache_key())
+    :param lr: the learning rate
+    :param params: dict of the parameters of the key (see get_lr_cache_params())
+    """
+    row_df = pd.DataFrame([{'key': key, 'lr': lr, 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            **{param: params[param] for param in LR_CACHE_KEY_PARAMS}}])
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    row_df.to_csv(cache_path, mode='a', header=not os.path.exists(cache_path), index=False)
+
+
+def find_learning_rate(trainer, model, datamodule, params: dict, cache_path: str, num_training: int = 100) -> \
+        (float, bool):
+    """
+    Find the learning rate of the model (trainer.tuner.lr_find()), or read it from the cache if this configuration
+    was already searched.
+    :param trainer: pytorch_lightning.Trainer() to run the search with
+    :param model: calibCNN model
+    :param datamodule: LidarDataModule of the train data
+    :param params: dict of the parameters that determine the learning rate (see get_lr_cache_params())
+    :param cache_path: path of the cache csv file
+    :param num_training: number of learning rates to test in the search
+    :return: the learning rate, and True if it was read from the cache
+    """
+    logger = logging.getLogger()
+    key = get_lr_cache_key(params)
+    lr = get_cached_lr(cache_path, key)
+    if lr is not None:
+        logger.info(f"\nUsing cached learning rate {lr:.3e} (key {key})")
+        return lr, True
+
+    lr_finder = trainer.tuner.lr_find(model, datamodule=datamodule, num_training=num_training)
+    lr = lr_finder.suggestion()
+    if lr is None:
+        logger.warning(f"\nThe learning rate finder failed (key {key}), using the learning rate {model.lr}")
+        return model.lr, False
+    save_lr_to_cache(cache_path, key, lr, params)
+    logger.info(f"\nFound learning rate {lr:.3e} (key {key}), saved to {cache_path}")
+    return lr, False
@@ -1,4 +1,5 @@
 import glob
+import json
 import os
 import sys
 
@@ -6,8 +7,11 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import yaml
 from ray import tune
 
+from learning_lidar.learning_phase.learn_utils.results_store import RESULTS_COLUMNS, connect_results_store, \
+    get_experiment_signature, get_stored_signatures, store_experiment_results, read_results, get_early_stopped
 from learning_lidar.utils import global_settings as gs, vis_utils
 
 mpl.rc('text', usetex=True)
@@ -17,6 +21,12 @@ plt.rcParams["axes.labelweight"] = "bold"
 mpl.rc('text', usetex=True)
 mpl.ticker.ScalarFormatter(useMathText=True)
 
+# Names of the model configurations by (hidden size, fc size), for uniform hidden sizes
+CONFIGS_NAMES = {(4, 16): 'A', (4, 32): 'B', (6, 16): 'C', (6, 32): 'D',
+                 (5, 16): 'E', (5, 32): 'F', (8, 16): 'G', (8, 32): 'H'}
+# Columns of a trial configuration, to find valid runs of non-valid trials
+DUPLICATE_KEYS = ['config', 'use_bg', 'db', 'source', 'fc_size', 'wavelength', 'pow_y', 'pow_x1', 'pow_x2', 'pow_x3']
+
 
 def extract_powers(row, in_channels):
     """
@@ -90,10 +100,209 @@ def plot_pivot_table(pivot_table: pd.pivot_table, title: str, figsize=(7, 5), vi
     return fig, ax, fpath
 
 
+def load_trials_status(state_path: str) -> dict:
+    """
+    :param state_path: path of an experiment state file (experiment_state*.json)
+    :return: dict of trial_id -> tune status of the trial ('TERMINATED', 'ERROR', ...)
+    """
+    with open(state_path, 'r') as f:
+        checkpoints = json.load(f)['checkpoints']
+    trials_status = {}
+    for trial_state in checkpoints:
+        trial_state = json.loads(trial_state) if type(trial_state) == str else trial_state
+        trials_status[trial_state['trial_id']] = trial_state['status']
+    return trials_status
+
+
+def load_trial_consts(logdir: str) -> dict:
+    """
+    :param logdir: trial folder
+    :return: the consts of the trial (saved by main_lightning.main()), or empty dict if missing
+    """
+    consts_path = os.path.join(logdir, 'consts.yaml')
+    if not os.path.exists(consts_path):
+        return {}
+    with open(consts_path, 'r') as f:
+        return yaml.load(f.read(), Loader=yaml.FullLoader) or {}
+
+
+def load_experiment_results(row: pd.Series) -> pd.DataFrame:
+    """
+    Load and process the results of all trials (and through all runs) of an experiment, from its jason state files
+    :param row: row of the experiments table (see generate_results_table()),
+     with the fields: experiment_folder, field_to_ignore, trial_to_ignore, overlap, database
+    :return: pd.DataFrame() of the trials results, with the columns RESULTS_COLUMNS (None if no state files)
+    """
+    states_paths = sorted(glob.glob(os.path.join(row.experiment_folder, r'experiment_state*.json')))
+    if not states_paths:
+        return None
+    results_dfs = []
+    trials_status = {}
+    last_iteration = {}
+    ignore_MARELoss = "MARELoss" in [row.field_to_ignore]
+    for state_path in states_paths:
+        analysis = tune.ExperimentAnalysis(state_path)
+        analysis.default_metric = "MARELoss"
+        analysis.default_mode = "min"
+        results_dfs.append(analysis.dataframe(metric="MARELoss", mode="min", ))
+        trials_status.update(load_trials_status(state_path))
+        last_iteration.update({logdir: trial_df.training_iteration.max()
+                               for logdir, trial_df in analysis.trial_dataframes.items() if not trial_df.empty})
+    results_df = pd.concat(results_dfs)
+
+    # Update fields:
+    if ignore_MARELoss:
+        results_df["MARELoss"] = None
+
+    # Rename column names:
+    results_df = results_df.rename(columns=lambda col: col.replace('config/', ""))
+
+    # Update power values:
+    no_power = results_df.use_power.isna() | results_df.use_power.isin(['FALSE', False])
+    results_df['powers'] = results_df.use_power.where(~no_power, '')
+    results_df['use_power'] = ~no_power
+    results_df['overlap'] = row.overlap
+    results_df['db'] = row.database
+
+    # Trials that were stopped by the trials scheduler (saved in the trial's consts by main_lightning)
+    trials_consts = {logdir: load_trial_consts(logdir) for logdir in results_df.logdir.unique()}
+    results_df['scheduler'] = results_df.logdir.map({logdir: consts.get('scheduler')
+                                                     for logdir, consts in trials_consts.items()})
+    max_t = results_df.logdir.map({logdir: consts.get('scheduler_max_t') if consts.get('scheduler') else None
+                                   for logdir, consts in trials_consts.items()}).astype(float)
+    results_df['early_stopped'] = get_early_stopped(results_df.logdir.map(last_iteration),
+                                                    results_df.trial_id.map(trials_status), max_t)
+
+    # Reorganize columns (and drop irrelevant columns):
+    if 'opt_powers' not in results_df.keys():
+        results_df['opt_powers'] = False
+    results_df = results_df.reindex(columns=RESULTS_COLUMNS)
+
+    # Remove irrelevant trials (e.g. when dnorm had wrong calculation)
+    if row.trial_to_ignore is not np.nan:
+        key, cond = eval(row.trial_to_ignore)
+        results_df.drop(index=results_df[results_df[key] == cond].index, inplace=True)
+    return results_df
+
+
+def ingest_experiments(runs_df: pd.DataFrame, conn) -> list:
+    """
+    Ingest to the results store the experiments that are new or changed since their last ingestion
+    (see get_experiment_signature()). The results of each ingested experiment are also saved to
+    'experiment_results.csv' in the experiment's folder.
+    :param runs_df: experiments table (see generate_results_table())
+    :param conn: connection to the results store (see connect_results_store())
+    :return: list of the ingested experiments folders
+    """
+    stored_signatures = get_stored_signatures(conn)
+    ingested = []
+    for idx, row in runs_df.iterrows():
+        signature = get_experiment_signature(row.experiment_folder,
+                                             extra=f"{row.field_to_ignore}_{row.trial_to_ignore}_"
+                                                   f"{row.overlap}_{row.database}")
+        if signature is None or stored_signatures.get(row.experiment_folder) == signature:
+            continue
+        try:
+            results_df = load_experiment_results(row)
+        except Exception as e:
+            print(f"Failed loading {row.experiment_folder}: {e}")
+            continue
+        store_experiment_results(conn, row.experiment_folder, signature, results_df)
+
+        # Save experiment's results in the main folder of the experiment
+        results_csv = os.path.join(row.experiment_folder, f'experiment_results.csv')
+        results_df.to_csv(results_csv, index=False)
+        print(results_csv, idx)
+        ingested.append(row.experiment_folder)
+    return ingested
+
+
+def _map_unique(series: pd.Series, func) -> pd.Series:
+    # apply func once per unique (non-null) value of the series
+    uniques = series.dropna().unique()
+    return series.map(dict(zip(uniques, map(func, uniques))))
+
+
+def _dfilter_wavelength(dfilter):
+    if type(dfilter) != str:
+        return 'all'
+    try:
+        [filter_by, filter_values] = dfilter.split(' ')
+    except ValueError:
+        # The dfilter was not formatted properly, or no filter was done
+        return 'all'
+    if filter_by != 'wavelength':
+        return 'all'
+    filter_values = eval(filter_values)
+    return tuple(filter_values) if len(filter_values) > 1 else filter_values[0]
+
+
+def classify_results(total_results: pd.DataFrame, in_channels: int = 3) -> pd.DataFrame:
+    """
+    Add to the trials results the columns of: the powers per channel (pow_y, pow_x1, ...), uniform hidden sizes
+    (u_hsize), the wavelength filter, and the name of the model configuration (config: 'A'-'H' or 'Other').
+    The parsing is done once per unique value, and the rest is vectorized.
+    :param total_results: pd.DataFrame() of trials results, with the columns RESULTS_COLUMNS
+    :param in_channels: number of input channels
+    :return: the updated total_results
+    """
+    if total_results.empty:
+        return total_results
+    total_results['fc_size'] = _map_unique(total_results.fc_size.astype(str), lambda x: eval(x)[0])
+
+    # Update powers values
+    powers = total_results.powers.replace('', np.nan)
+    unique_powers = powers.dropna().unique()
+    cols_powx = [f"pow_x{ind + 1}" for ind in range(in_channels)]
+    powers_table = pd.DataFrame([extract_powers({'powers': power}, in_channels) for power in unique_powers],
+                                columns=['pow_y', *cols_powx], index=unique_powers, dtype=float)
+    total_results[['pow_y', *cols_powx]] = powers_table.reindex(powers.values).values
+    # correct runs of use_bg, where the third channel input is missing to default value of 0.5)
+    missing_bg_power = total_results.use_power & total_results.use_bg.astype(str).isin(['True', 'range_corr']) & \
+                       total_results.pow_x3.isna()
+    total_results.loc[missing_bg_power, 'pow_x3'] = 0.5
+    total_results['powers'] = _map_unique(powers, eval)
+
+    # The test of changing the with at the last level , didn't show improvements
+    hsizes = _map_unique(total_results.hsizes, eval)
+    total_results['u_hsize'] = hsizes.map(lambda x: all([(hi == x[0]) for hi in x]))
+    hsize = hsizes.str[0]
+
+    # Specifying column of wavelength usage
+    # map through an object series, to keep the wavelengths as int / tuple (and not cast to float by the NaNs)
+    dfilters = total_results.dfilter.dropna().unique()
+    wavelengths = pd.Series([_dfilter_wavelength(dfilter) for dfilter in dfilters], index=dfilters, dtype=object)
+    total_results['wavelength'] = total_results.dfilter.map(wavelengths).fillna('all')
+    total_results.loc[total_results.wavelength == 'all', 'dfilter'] = ''
+
+    # Specify config name
+    configs_df = pd.DataFrame([(hsize_i, fc_size, config) for (hsize_i, fc_size), config in CONFIGS_NAMES.items()],
+                              columns=['hsize', 'fc_size', 'config'])
+    configs = pd.DataFrame({'hsize': hsize.values, 'fc_size': total_results.fc_size.values}). \
+        merge(configs_df, how='left', on=['hsize', 'fc_size'])['config']
+    total_results['config'] = np.where(total_results.u_hsize & configs.notna().values, configs.values, 'Other')
+    return total_results
+
+
+def mark_repeated_trials(valid_loss: pd.DataFrame, one_loss: pd.DataFrame) -> pd.Series:
+    """
+    Mark the non-valid trials (loss=1) that require re-run: 'repeat' if there is no valid trial with the same
+    configuration (see DUPLICATE_KEYS), otherwise 'ignore' (it was already repeated).
+    :param valid_loss: pd.DataFrame() of the valid trials (see classify_results())
+    :param one_loss: pd.DataFrame() of the non-valid trials (see classify_results())
+    :return: pd.Series() of the comments of one_loss
+    """
+    valid_keys = valid_loss[DUPLICATE_KEYS].dropna().drop_duplicates()
+    merged = one_loss[DUPLICATE_KEYS].merge(valid_keys, how='left', on=DUPLICATE_KEYS, indicator=True)
+    return pd.Series(np.where(merged['_merge'].values == 'both', 'ignore', 'repeat'), index=one_loss.index)
+
+
 def generate_results_table(results_folder: str = os.path.join(gs.PKG_ROOT_DIR, 'results'),
                            experiments_table_fname: str = 'runs_board.xlsx',
-                           dst_fname='total_results.csv'):
+                           dst_fname='total_results.csv', store_fname: str = 'results_store.db'):
     """ Postprocessing LCNET results from jason state files saved in experiments_table_fname.
+     The results of the experiments are kept in a results store (SQLite file store_fname in results_folder),
+     such that only new or changed experiments are read again (see ingest_experiments()).
      Then generating a summery table that includes the total trials of the experiment in experiments_table_fname,
      such that:
       1. The valid trials table saved to 'valid_res_fname' --> this table is used later in analysis results
@@ -105,176 +314,29 @@ def generate_results_table(results_folder: str = os.path.join(gs.PKG_ROOT_DIR, '
     :param results_folder:
     :param experiments_table_fname:
     :param dst_fname:
+    :param store_fname: file name of the results store in results_folder
     :return:
     """
     table_fname = os.path.join(results_folder, experiments_table_fname)
     runs_df = pd.read_excel(table_fname)
-    runs_df = runs_df[runs_df.include == True][runs_df.state != 'PENDING']
+    runs_df = runs_df[(runs_df.include == True) & (runs_df.state != 'PENDING')]
     print(runs_df)
 
-    for idx, row in runs_df.iterrows():
-        states_paths = sorted(glob.glob(os.path.join(row.experiment_folder, r'experiment_state*.json')))
-        if states_paths:
-            try:
-                # Load results of all trials (and through all runs) of the experiment
-                results_dfs = []
-                for state_path in states_paths:
-                    analysis = tune.ExperimentAnalysis(state_path)
-                    ignore_MARELoss = "MARELoss" in [row.field_to_ignore]
-                    analysis.default_metric = "MARELoss" if ignore_MARELoss else "MARELoss"
-                    analysis.default_mode = "min"
-                    results_dfs.append(analysis.dataframe(metric="MARELoss", mode="min", ))
-                results_df = pd.concat(results_dfs)
-
-                # Update fields:
-                if ignore_MARELoss:
-                    results_df["MARELoss"] = None
-
-                # Rename column names:
-                cols = results_df.columns.values.tolist()
-                new_cols = [col.replace('config/', "") for col in cols]
-                dict_cols = {}
-                for col, new_col in zip(cols, new_cols):
-                    dict_cols.update({col: new_col})
-                results_df = results_df.rename(columns=dict_cols)
-
-                # Update power values:
-                use_power = [False if (p is None) or (p == 'FALSE') or (p == False) else True for p in
-                             results_df.use_power]
-                powers = ['' if (p is None) or (p == 'FALSE') or (p == False) else p for p in results_df.use_power]
-                results_df['use_power'] = use_power
-                results_df['powers'] = powers
-                results_df['overlap'] = row.overlap
-                results_df['db'] = row.database
-
-                # Drop irrelevant columns:
-                drop_cols = ['time_this_iter_s', 'should_checkpoint', 'done',
-                             'timesteps_total', 'episodes_total',
-                             'experiment_id', 'timestamp', 'pid', 'hostname',
-                             'node_ip', 'time_since_restore', 'timesteps_since_restore',
-                             'iterations_since_restore']
-                results_df.drop(columns=drop_cols, inplace=True)
-
-                # Reorganize columns:
-                if 'opt_powers' not in results_df.keys():
-                    results_df['opt_powers'] = False
-
-                new_order = ['trial_id', 'date', 'time_total_s', 'training_iteration',
-                             'loss', 'MARELoss',
-                             'bsize', 'dfilter', 'dnorm', 'fc_size', 'hsizes', 'lr',
-                             'ltype', 'source', 'use_bg',
-                             'use_power', 'opt_powers', 'powers',
-                             'db', 'overlap', 'logdir']  # 'note'
-                results_df = results_df.reindex(columns=new_order)
-
-                # Remove irrelevant trials (e.g. when dnorm had wrong calculation)
-                if row.trial_to_ignore is not np.nan:
-                    key, cond = eval(row.trial_to_ignore)
-                    results_df.drop(index=results_df[results_df[key] == cond].index, inplace=True)
-
-                # Save experiment's results in the main folder of the experiment
-                results_csv = os.path.join(row.experiment_folder, f'experiment_results.csv')
-                results_df.to_csv(results_csv, index=False)
-
-                # Update csv path in main runs_board
-                runs_df.loc[idx, 'results_csv'] = results_csv
-                print(results_csv, idx)
-
-            except:
-                continue
-        else:
-            continue
-
-    # Concatenate results of all experiment that has 'include'==True
-    paths = [row['results_csv'] for idx, row in runs_df.iterrows() if not (pd.isnull(row['results_csv'])) == True]
-    results_dfs = [pd.read_csv(path) for path in paths]
-    total_results = pd.concat(results_dfs, ignore_index=True)
-    total_results['fc_size'] = total_results.fc_size.apply(lambda x: eval(str(x))[0])
-
-    # Update powers values
-    in_channels = 3
-    res = total_results.apply(extract_powers, args=(in_channels,), axis=1, result_type='expand')
-    cols_powx = [f"pow_x{ind + 1}" for ind in range(in_channels)]
-    res.rename(columns={0: 'pow_y', 1: cols_powx[0], 2: cols_powx[1], 3: cols_powx[2]}, inplace=True)
-    total_results[res.columns.values] = res
-    total_results.loc[total_results.query(
-        # correct runs of use_bg, where the third channel input is missing to default value of 0.5)
-        f"use_power & (use_bg=='{True}' or use_bg=='{'range_corr'}') & pow_x3.isna()").index, 'pow_x3'] = 0.5
-
-    total_results['powers'] = total_results.powers.apply(lambda x: eval(x) if type(x) == str else None)
-    hsizes = total_results.hsizes.apply(lambda x: eval(x))
-    total_results['u_hsize'] = hsizes.apply(lambda x: all(
-        [(hi == x[0]) for hi in x]))  # The test of changing the with at the last level , didn't show improvements
-
-    # Specifying column of wavelength usage
-    wavelengths = []
-    filtered = total_results.dfilter.apply(lambda x: type(x) == str)
-    for ind, f in enumerate(filtered):
-        if f:
-            try:
-                [filter_by, filter_values] = total_results.dfilter.iloc[ind].split(' ')
-            except:
-                # The dfilter was not formatted properly, or no filter was done
-                [filter_by, filter_values] = ['None', 'None']
-                pass
-            finally:
-                filter_values = eval(filter_values)
-            if filter_by == 'wavelength':
-                wavelength = tuple(filter_values) if len(filter_values) > 1 else filter_values[0]
-            else:
-                wavelength = 'all'
-        else:
-            wavelength = 'all'
-        wavelengths.append(wavelength)
-
-    total_results['wavelength'] = wavelengths
-    total_results.loc[total_results.wavelength == 'all', 'dfilter'] = ''
-
-    # Specify config name
-    configs = []
-    for idx, row in total_results.iterrows():
-        hsize = eval(row.hsizes)[0]
-        fcsize = row.fc_size
-        u_hsize = row.u_hsize
-        if (hsize == 4) and (fcsize == 16) and u_hsize:
-            configs.append('A')
-        elif (hsize == 4) and (fcsize == 32) and u_hsize:
-            configs.append('B')
-        elif (hsize == 6) and (fcsize == 16) and u_hsize:
-            configs.append('C')
-        elif (hsize == 6) and (fcsize == 32) and u_hsize:
-            configs.append('D')
-        elif (hsize == 5) and (fcsize == 16) and u_hsize:
-            configs.append('E')
-        elif (hsize == 5) and (fcsize == 32) and u_hsize:
-            configs.append('F')
-        elif (hsize == 8) and (fcsize == 16) and u_hsize:
-            configs.append('G')
-        elif (hsize == 8) and (fcsize == 32) and u_hsize:
-            configs.append('H')
-        else:
-            configs.append('Other')
-
-    total_results['config'] = configs
+    # Update the results store, and load the results of all experiment that has 'include'==True
+    conn = connect_results_store(os.path.join(results_folder, store_fname))
+    try:
+        ingest_experiments(runs_df, conn)
+        total_results = read_results(conn, runs_df.experiment_folder.tolist())
+    finally:
+        conn.close()
+    total_results = classify_results(total_results)
 
     # Split table to valid loss and non-valid loss (loss=1). The non-valid will be used to do re-runs.
     # If the comment is 'repeat'- then one should repeat it according to the logdir.
     # If the comment is 'ignore' it means that it was already repeated.
     valid_loss = total_results[total_results.MARELoss < 1].copy()
     one_loss = total_results[total_results.MARELoss == 1].copy()
-    comment = []
-    for idx, row in one_loss.iterrows():
-        res_duplicate = valid_loss[valid_loss['config'] == row['config']][valid_loss['use_bg'] == row['use_bg']][
-            valid_loss['db'] == row['db']][valid_loss['source'] == row['source']][
-            valid_loss['fc_size'] == row['fc_size']][
-            valid_loss['wavelength'] == row['wavelength']][valid_loss['pow_y'] == row['pow_y']][
-            valid_loss['pow_x1'] == row['pow_x1']][valid_loss['pow_x2'] == row['pow_x2']][
-            valid_loss['pow_x3'] == row['pow_x3']]
-        if res_duplicate.empty:
-            comment.append('repeat')
-        else:
-            comment.append('ignore')
-    one_loss['comment'] = comment
+    one_loss['comment'] = mark_repeated_trials(valid_loss, one_loss)
 
     # save
     # TODO: save runs_df with results_csv paths
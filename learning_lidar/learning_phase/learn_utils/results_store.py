@@ -0,0 +1,123 @@
+import glob
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+RESULTS_COLUMNS = ['trial_id', 'date', 'time_total_s', 'training_iteration', 'early_stopped', 'scheduler',
+                   'loss', 'MARELoss',
+                   'bsize', 'dfilter', 'dnorm', 'fc_size', 'hsizes', 'lr',
+                   'ltype', 'source', 'use_bg',
+                   'use_power', 'opt_powers', 'powers',
+                   'db', 'overlap', 'logdir']
+BOOL_COLUMNS = ['early_stopped', 'dnorm', 'use_power', 'opt_powers']
+TRIALS_TABLE = 'trials'
+EXPERIMENTS_TABLE = 'experiments'
+
+
+def get_early_stopped(last_iteration: pd.Series, trials_status: pd.Series, max_t) -> pd.Series:
+    """
+    Mark the trials that were stopped by the trials scheduler (see get_trial_scheduler()): trials that were
+    terminated before reaching max_t training iterations.
+    Note: 'done' can't be used for that, since tune reports done=True also in the last result of a stopped trial.
+    :param last_iteration: the last training iteration of each trial
+    :param trials_status: the tune status of each trial ('TERMINATED', 'ERROR', ...)
+    :param max_t: max training iterations of a trial (scalar or per trial). None if no scheduler was used.
+    :return: boolean pd.Series() of early stopped trials
+    """
+    if max_t is None:
+        return pd.Series(False, index=last_iteration.index)
+    return (trials_status == 'TERMINATED') & (last_iteration < max_t)
+
+
+def connect_results_store(store_path: str) -> sqlite3.Connection:
+    """
+    Connect to the results store (a SQLite file), and create its experiments table if it doesn't exist.
+    The store holds the processed trials results of each experiment (see generate_results_table()),
+    and the signature of each experiment at its last ingestion (see get_experiment_signature()).
+    :param store_path: path of the SQLite file
+    :return: sqlite3.Connection to the store
+    """
+    conn = sqlite3.connect(store_path)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {EXPERIMENTS_TABLE} "
+                 f"(experiment_folder TEXT PRIMARY KEY, signature TEXT, ingest_date TEXT)")
+    return conn
+
+
+def get_experiment_signature(experiment_folder: str, extra: str = '') -> str:
+    """
+    Signature of the current state of an experiment: the number and the latest modification time of its
+    experiment state files and of its trials results files.
+    :param experiment_folder: folder of the ray experiment
+    :param extra: additional string that changes the processing of the experiment (e.g., the runs_board row)
+    :return: signature string, or None if the experiment has no state files
+    """
+    states_paths = glob.glob(os.path.join(experiment_folder, r'experiment_state*.json'))
+    if not states_paths:
+        return None
+    paths = states_paths + glob.glob(os.path.join(experiment_folder, '*', 'result.json'))
+    return f"{len(paths)}_{max(os.path.getmtime(path) for path in paths)}_{extra}"
+
+
+def get_stored_signatures(conn: sqlite3.Connection) -> dict:
+    """
+    :param conn: connection to the results store
+    :return: dict of experiment_folder -> signature of the ingested experiments
+    """
+    return dict(conn.execute(f"SELECT experiment_folder, signature FROM {EXPERIMENTS_TABLE}").fetchall())
+
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() \
+           is not None
+
+
+def store_experiment_results(conn: sqlite3.Connection, experiment_folder: str, signature: str,
+                             results_df: pd.DataFrame):
+    """
+    Replace the trials results of an experiment in the store.
+    The values of the BOOL_COLUMNS are stored as 0/1. The values of other object and bool columns (e.g., use_bg that
+    can be True or 'range_corr', or overlap) are stored as strings, so they are read the same whether or not an
+    experiment has mixed values.
+    :param conn: connection to the results store
+    :param experiment_folder: folder of the ray experiment
+    :param signature: signature of the experiment (see get_experiment_signature())
+    :param results_df: the processed results of the experiment's trials, with the columns RESULTS_COLUMNS
+    """
+    results_df = results_df.reindex(columns=RESULTS_COLUMNS)
+    for col in BOOL_COLUMNS:
+        results_df[col] = results_df[col].astype('boolean').astype('Int64')
+    for col in [col for col in results_df.columns if col not in BOOL_COLUMNS and
+                (pd.api.types.is_object_dtype(results_df[col]) or pd.api.types.is_bool_dtype(results_df[col]))]:
+        results_df[col] = results_df[col].where(results_df[col].isna(), results_df[col].astype(str))
+    results_df.insert(0, 'experiment_folder', experiment_folder)
+
+    with conn:
+        if _table_exists(conn, TRIALS_TABLE):
+            conn.execute(f"DELETE FROM {TRIALS_TABLE} WHERE experiment_folder=?", (experiment_folder,))
+            # add columns that are missing in stores of older versions
+            stored_columns = [col_info[1] for col_info in conn.execute(f"PRAGMA table_info({TRIALS_TABLE})")]
+            for col in results_df.columns.difference(stored_columns):
+                conn.execute(f'ALTER TABLE {TRIALS_TABLE} ADD COLUMN "{col}"')
+        results_df.to_sql(TRIALS_TABLE, conn, if_exists='append', index=False)
+        conn.execute(f"INSERT OR REPLACE INTO {EXPERIMENTS_TABLE} VALUES (?, ?, ?)",
+                     (experiment_folder, signature, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def read_results(conn: sqlite3.Connection, experiment_folders: list) -> pd.DataFrame:
+    """
+    Read the trials results of the given experiments from the store
+    :param conn: connection to the results store
+    :param experiment_folders: list of experiments folders
+    :return: pd.DataFrame() of the results, with the columns RESULTS_COLUMNS (empty if none of the experiments
+    was ingested)
+    """
+    if not (_table_exists(conn, TRIALS_TABLE) and len(experiment_folders)):
+        return pd.DataFrame(columns=RESULTS_COLUMNS)
+    placeholders = ','.join('?' * len(experiment_folders))
+    results_df = pd.read_sql(f"SELECT * FROM {TRIALS_TABLE} WHERE experiment_folder IN ({placeholders})", conn,
+                             params=list(experiment_folders))
+    for col in BOOL_COLUMNS:
+        results_df[col] = results_df[col].fillna(0).astype(bool)
+    return results_df.reindex(columns=RESULTS_COLUMNS)
@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+from time import perf_counter
+
+import pandas as pd
+import torch
+from pytorch_lightning.callbacks import Callback
+from torch.utils.data import Subset
+
+PROFILER_METRICS = ['data_wait', 'forward', 'backward', 'optimizer', 'step', 'samples_per_sec']
+
+
+class TimedTransform(object):
+    """
+    Wraps a transform, and accumulates its run time to a counter that is shared with the DataLoader workers.
+    """
+
+    def __init__(self, transform, counter):
+        self.transform = transform
+        self.counter = counter
+
+    def __call__(self, x):
+        start = perf_counter()
+        x = self.transform(x)
+        with self.counter.get_lock():
+            self.counter.value += perf_counter() - start
+        return x
+
+
+class ProfiledDataSet(torch.utils.data.Dataset):
+    """
+    Wraps a dataset, and accumulates the run time of loading samples (__getitem__, including the transforms)
+    to counters that are shared with the DataLoader workers.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.getitem_time = multiprocessing.Value('d', 0.0)
+        self.n_items = multiprocessing.Value('i', 0)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        start = perf_counter()
+        sample = self.dataset[idx]
+        with self.getitem_time.get_lock():
+            self.getitem_time.value += perf_counter() - start
+            self.n_items.value += 1
+        return sample
+
+
+def profile_dataset(dataset) -> (ProfiledDataSet, dict):
+    """
+    Wrap a dataset (e.g. the train set of LidarDataModule) and its transforms with timers
+    :param dataset: LidarDataSet / InMemoryLidarDataSet, or a Subset of it (as returned by get_splits())
+    :return: the wrapped dataset, and dict of transform name -> shared time counter
+    """
+    base_dataset = dataset
+    while isinstance(base_dataset, Subset):
+        base_dataset = base_dataset.dataset
+    transform_counters = {}
+    transforms = getattr(base_dataset, 'transforms', None)
+    if transforms is not None:
+        transforms_list = transforms.transforms if hasattr(transforms, 'transforms') else [transforms]
+        timed_transforms = []
+        for ind, transform in enumerate(transforms_list):
+            if isinstance(transform, TimedTransform):
+                transform = transform.transform
+            name = f"{ind}_{type(transform).__name__}"
+            transform_counters[name] = multiprocessing.Value('d', 0.0)
+            timed_transforms.append(TimedTransform(transform, transform_counters[name]))
+        if hasattr(transforms, 'transforms'):
+            transforms.transforms = timed_transforms
+        else:
+            base_dataset.transforms = timed_transforms[0]
+    return ProfiledDataSet(dataset), transform_counters
+
+
+class ThroughputProfiler(Callback):
+    """
+    Measures per training step: the DataLoader wait time, forward, backward and optimizer times [sec], and the
+    throughput [samples/sec]. These are logged (so they can be reported to Tune) with the prefix 'profiler/'.
+    If the train set was wrapped by profile_dataset(), also measures per epoch: the mean loading time per sample,
+    the time of each transform per sample, and the DataLoader workers utilization (the fraction of the epoch time
+    the workers were busy loading samples).
+    All the measurements are saved to csv_path (a row per step, and a row per epoch).
+    """
+
+    def __init__(self, csv_path: str = 'throughput_profile.csv', dataset: ProfiledDataSet = None,
+                 transform_counters: dict = None, num_workers: int = 0):
+        """
+        :param csv_path: path of the output csv file
+        :param dataset: the profiled train set (see profile_dataset())
+        :param transform_counters: the transforms counters (see profile_dataset())
+        :param num_workers: number of DataLoader workers of the train set
+        """
+        self.csv_path = csv_path
+        self.dataset = dataset
+        self.transform_counters = transform_counters if transform_counters else {}
+        self.num_workers = num_workers
+        self.rows = []
+        self.times = {}
+        self.last_batch_end = None
+        self.epoch_start = None
+
+    def _reset_counters(self):
+        counters = [self.dataset.getitem_time, self.dataset.n_items] if self.dataset else []
+        for counter in counters + list(self.transform_counters.values()):
+            with counter.get_lock():
+                counter.value = 0
+
+    def on_train_epoch_start(self, trainer, pl_module, *args):
+        self._reset_counters()
+        self.epoch_start = perf_counter()
+        self.last_batch_end = self.epoch_start
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        self.times = {'batch_start': perf_counter()}
+
+    def on_before_backward(self, trainer, pl_module, *args):
+        self.times['before_backward'] = perf_counter()
+
+    def on_after_backward(self, trainer, pl_module, *args):
+        self.times['after_backward'] = perf_counter()
+
+    def on_before_optimizer_step(self, trainer, pl_module, *args):
+        self.times['before_optimizer_step'] = perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        end = perf_counter()
+        start = self.times['batch_start']
+        before_backward = self.times.get('before_backward', end)
+        after_backward = self.times.get('after_backward', before_backward)
+        before_optimizer_step = self.times.get('before_optimizer_step', after_backward)
+        batch_size = len(batch['x'])
+        row = {'epoch': trainer.current_epoch, 'global_step': trainer.global_step, 'batch_size': batch_size,
+               'data_wait': start - self.last_batch_end,
+               'forward': before_backward - start,
+               'backward': after_backward - before_backward,
+               'optimizer': end - before_optimizer_step,
+               'step': end - self.last_batch_end}
+        row['samples_per_sec'] = batch_size / row['step']
+        self.rows.append(row)
+        pl_module.log_dict({f"profiler/{key}": row[key] for key in PROFILER_METRICS})
+        self.last_batch_end = end
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        epoch_time = perf_counter() - self.epoch_start
+        steps = [row for row in self.rows if (row['epoch'] == trainer.current_epoch) and ('step' in row)]
+        row = {'epoch': trainer.current_epoch, 'epoch_time': epoch_time,
+               'epoch_samples_per_sec': sum(step['batch_size'] for step in steps) / epoch_time}
+        if self.dataset is not None and self.dataset.n_items.value > 0:
+            n_items = self.dataset.n_items.value
+            row['load_per_sample'] = self.dataset.getitem_time.value / n_items
+            row['workers_utilization'] = self.dataset.getitem_time.value / (epoch_time * max(1, self.num_workers))
+            for name, counter in self.transform_counters.items():
+                row[f"transform_{name}"] = counter.value / n_items
+        self.rows.append(row)
+        pl_module.log_dict({f"profiler/{key}": value for key, value in row.items() if key != 'epoch'})
+        self.save()
+
+    def save(self):
+        pd.DataFrame(self.rows).to_csv(self.csv_path, index=False)
+
+    def on_train_end(self, trainer, pl_module, *args):
+        self.save()
+        print(f"Saved throughput profile to {os.path.abspath(self.csv_path)}")
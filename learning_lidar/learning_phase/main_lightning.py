@@ -9,25 +9,47 @@ from ray import tune
 from ray.tune import CLIReporter
 from ray.tune.integration.pytorch_lightning import TuneReportCheckpointCallback
 
-from learning_lidar.learning_phase.data_modules.lidar_data_module import LidarDataModule
+from learning_lidar.learning_phase.data_modules.lidar_data_module import LidarDataModule, SHARED_DATA_ACTOR
+from learning_lidar.learning_phase.learn_utils.lr_finder_cache import find_learning_rate, get_lr_cache_params
+from learning_lidar.learning_phase.learn_utils.results_store import get_early_stopped
+from learning_lidar.learning_phase.learn_utils.throughput_profiler import ThroughputProfiler, profile_dataset
 from learning_lidar.learning_phase.models.calibCNN import calibCNN, init_funcs
 from learning_lidar.learning_phase.run_params import USE_RAY, DEBUG_RAY, CONSTS, RAY_HYPER_PARAMS, RESULTS_PATH, \
     NON_RAY_HYPER_PARAMS, update_params, RESUME_EXP, EXP_NAME, TRIAL_PARAMS, \
-    CHECKPOINT_PATH, INIT_PARAMETERS, TRIAL_CONSTS
+    CHECKPOINT_PATH, INIT_PARAMETERS, TRIAL_CONSTS, SCHEDULER, SCHEDULER_PARAMS, get_trial_scheduler
 from learning_lidar.utils.utils import create_and_configer_logger
 
-seed_everything(8318)  # Note, for full deterministic result add deterministic=True to trainer
+SEED = 8318
+seed_everything(SEED)  # Note, for full deterministic result add deterministic=True to trainer
 
 
 # for pytorch lightning and Ray integration see example at
 # https://github.com/ray-project/ray/blob/35ec91c4e04c67adc7123aa8461cf50923a316b4/python/ray/tune/examples/mnist_pytorch_lightning.py
 
-def main(config, checkpoint_dir=None, consts=None):
-    with open('consts.yaml', 'a') as f:
-        yaml.dump(consts, f)
-    with open('config.yaml', 'a') as f:
-        yaml.dump(config, f)
-    config, X_features, powers, dfilter = update_params(config, consts)
+def get_data_module_and_model(config, consts, X_features, powers, dfilter, checkpoint_dir=None):
+    """
+    Define the data module and the model of a trial
+    :param config: hyper parameters of the trial, after update_params()
+    :param consts: constants of the experiment (e.g. CONSTS)
+    :param X_features: X features of the trial, as returned by update_params()
+    :param powers: powers of the trial, as returned by update_params()
+    :param dfilter: data filter of the trial, as returned by update_params()
+    :param checkpoint_dir: If given, the model is loaded from its checkpoint
+    :return: LidarDataModule, calibCNN
+    """
+    # Define Data
+    shared_data = consts.get('shared_data', False)
+    # If fused_norm, the data is normalized by the model (after power), instead of by the data module
+    fused_norm = config['dnorm'] and consts.get('fused_norm', False)
+    lidar_dm = LidarDataModule(nn_data_folder=consts['nn_source_data'], train_csv_path=consts["train_csv_path"],
+                               test_csv_path=consts["test_csv_path"], stats_csv_path=consts["stats_csv_path"],
+                               powers=powers if config['use_power'] else None, top_height=consts["top_height"],
+                               X_features_profiles=X_features, Y_features=consts['Y_features'],
+                               batch_size=config['bsize'], data_filter=dfilter,
+                               data_norm=config['dnorm'] and not fused_norm,
+                               num_workers=consts.get('trial_num_workers', 0) if shared_data else consts['num_workers'],
+                               shared_data=shared_data, shared_num_workers=consts['num_workers'],
+                               batch_transforms=consts.get('batch_transforms', False), seed=SEED)
 
     # Define Model
     if checkpoint_dir:
@@ -37,28 +59,43 @@ def main(config, checkpoint_dir=None, consts=None):
                          hidden_sizes=eval(config['hsizes']), fc_size=eval(config['fc_size']),
                          loss_type=config['ltype'], learning_rate=config['lr'], weight_decay=config['wdecay'],
                          X_features_profiles=X_features, powers=powers,
-                         do_opt_powers=config['opt_powers'], conv_bias=config['cbias'])
+                         do_opt_powers=config.get('opt_powers', False), conv_bias=config['cbias'],
+                         x_norm_stats=lidar_dm.calc_stats()['x'] if fused_norm else None)
     if INIT_PARAMETERS:
         model.init_parameters(init_funcs)
 
-    # Define Data
-    lidar_dm = LidarDataModule(nn_data_folder=consts['nn_source_data'], train_csv_path=consts["train_csv_path"],
-                               test_csv_path=consts["test_csv_path"], stats_csv_path=consts["stats_csv_path"],
-                               powers=powers if config['use_power'] else None, top_height=consts["top_height"],
-                               X_features_profiles=X_features, Y_features=consts['Y_features'],
-                               batch_size=config['bsize'], num_workers=consts['num_workers'], data_filter=dfilter,
-                               data_norm=config['dnorm'])
+    return lidar_dm, model
+
+
+def main(config, checkpoint_dir=None, consts=None):
+    with open('consts.yaml', 'a') as f:
+        yaml.dump(consts, f)
+    with open('config.yaml', 'a') as f:
+        yaml.dump(config, f)
+    config, X_features, powers, dfilter = update_params(config, consts)
+
+    lidar_dm, model = get_data_module_and_model(config, consts, X_features, powers, dfilter, checkpoint_dir)
 
     # Define minimization parameter
     metrics = {"loss": f"loss/{config['ltype']}_val",
                "MARELoss": "rel_loss/MARELoss_val"}
-    callbacks = [TuneReportCheckpointCallback(metrics, filename="checkpoint", on="validation_end")]
-
-    # Setup the pytorch-lighting trainer and run the model
     if config['overfit']:
         overfit_path = os.path.join(os.path.dirname(consts['train_csv_path']), 'overfit_dataset.csv')
         lidar_dm.__setattr__('train_csv_path', overfit_path)
         lidar_dm.__setattr__('shffle_train', False)  # Not sure this is working well
+    lidar_dm.setup('fit')
+    callbacks = []
+    if consts.get('profile_throughput', False):
+        # Time the DataLoader, the transforms and the training steps, saved to 'throughput_profile.csv'
+        lidar_dm.train, transform_counters = profile_dataset(lidar_dm.train)
+        callbacks.append(ThroughputProfiler(dataset=lidar_dm.train, transform_counters=transform_counters,
+                                            num_workers=lidar_dm.num_workers))
+        metrics.update({"samples_per_sec": "profiler/samples_per_sec",
+                        "data_wait": "profiler/data_wait"})
+    callbacks.append(TuneReportCheckpointCallback(metrics, filename="checkpoint", on="validation_end"))
+
+    # Setup the pytorch-lighting trainer and run the model
+    if config['overfit']:
         trainer = Trainer(max_epochs=5000,
                           callbacks=callbacks,
                           gpus=[0] if consts['num_gpus'] > 0 else 0,
@@ -73,15 +110,20 @@ def main(config, checkpoint_dir=None, consts=None):
         trainer = Trainer(max_steps=consts['max_steps'],
                           max_epochs=consts['max_epochs'],
                           callbacks=callbacks,
-                          gpus=[0] if consts['num_gpus'] > 0 else 0,
-                          auto_lr_find=True)
-    lidar_dm.setup('fit')
+                          gpus=[0] if consts['num_gpus'] > 0 else 0)
+        if consts.get('lr_find', False):
+            # Search the learning rate once per model and data configuration (see find_learning_rate())
+            lr_params = get_lr_cache_params(config, consts, X_features, powers, dfilter)
+            lr, _ = find_learning_rate(trainer, model, lidar_dm, lr_params, consts['lr_cache_path'])
+            model.lr = lr
+            model.hparams.learning_rate = lr
     trainer.fit(model=model, datamodule=lidar_dm)
 
 
 if __name__ == '__main__':
     # Override number of workers if debugging
     CONSTS['num_workers'] = 0 if DEBUG_RAY else CONSTS['num_workers']
+    CONSTS['trial_num_workers'] = 0 if DEBUG_RAY else CONSTS.get('trial_num_workers', 0)
     LOG_RAY = not (RAY_HYPER_PARAMS['overfit'])
 
     logger = create_and_configer_logger(
@@ -94,26 +136,49 @@ if __name__ == '__main__':
             max_progress_rows=50,
             print_intermediate_tables=True)
 
+        trial_consts = TRIAL_CONSTS if TRIAL_CONSTS else CONSTS
+        # With shared data, the trials only train (the data is loaded once), so many trials can run concurrently
+        trial_cpus = 1 + trial_consts.get('trial_num_workers', 0) if trial_consts.get('shared_data', False) \
+            else CONSTS['num_workers']
+        # A trial is validated once per epoch, so by default max_t is the max epochs
+        scheduler_max_t = SCHEDULER_PARAMS.get('max_t') or trial_consts['max_epochs']
+        scheduler = get_trial_scheduler(SCHEDULER, **{**SCHEDULER_PARAMS, 'max_t': scheduler_max_t})
+        # Keep the scheduler in the trials consts, for the analysis of the results (see generate_results_table())
+        trial_consts = {**trial_consts, 'scheduler': SCHEDULER, 'scheduler_max_t': scheduler_max_t}
         analysis = tune.run(
-            tune.with_parameters(main, consts=TRIAL_CONSTS if TRIAL_CONSTS else CONSTS),
+            tune.with_parameters(main, consts=trial_consts),
             config=TRIAL_PARAMS if TRIAL_PARAMS else RAY_HYPER_PARAMS,
             local_dir=RESULTS_PATH,  # where to save the results
             fail_fast=False,  # if one run fails - stop all runs
             metric="MARELoss",
             mode="min",
             progress_reporter=reporter,
+            scheduler=scheduler,
             log_to_file=LOG_RAY,
-            resources_per_trial={"cpu": CONSTS['num_workers'], "gpu": CONSTS['num_gpus']},
+            resources_per_trial={"cpu": trial_cpus, "gpu": CONSTS['num_gpus']},
             resume=RESUME_EXP, name=EXP_NAME,
             restore=CHECKPOINT_PATH
         )
 
+        if trial_consts.get('shared_data', False):
+            # release the shared data
+            try:
+                ray.kill(ray.get_actor(SHARED_DATA_ACTOR))
+            except ValueError:
+                pass
+
         logger.info(f"best_trial {analysis.best_trial}")
         logger.info(f"best_config {analysis.best_config}")
         logger.info(f"best_logdir {analysis.best_logdir}")
         logger.info(f"best_checkpoint {analysis.best_checkpoint}")
         logger.info(f"best_result {analysis.best_result}")
         results_df = analysis.dataframe(metric="MARELoss", mode="min", )
+        trials_status = {trial.trial_id: trial.status for trial in analysis.trials}
+        last_iteration = {trial.trial_id: trial.last_result.get('training_iteration') for trial in analysis.trials}
+        results_df['early_stopped'] = get_early_stopped(results_df.trial_id.map(last_iteration),
+                                                        results_df.trial_id.map(trials_status),
+                                                        scheduler_max_t if SCHEDULER else None)
+        results_df['scheduler'] = SCHEDULER
         results_df.to_csv(os.path.join(analysis.trials[0].local_dir, f'output_table.csv'))
     else:
         main(config=NON_RAY_HYPER_PARAMS, consts=CONSTS)
@@ -0,0 +1,343 @@
+import argparse
+import logging
+import os.path
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import torch
+import xarray as xr
+from torch import nn
+
+from learning_lidar.learning_phase.data_modules.lidar_data_module import LidarDataModule
+from learning_lidar.learning_phase.models.calibCNN import calibCNN, PowerNormLayer
+from learning_lidar.learning_phase.run_params import RESULTS_PATH, update_params, get_checkpoint_params_const
+from learning_lidar.utils import xr_utils
+from learning_lidar.utils.utils import create_and_configer_logger
+
+
+class InferenceModel(nn.Module):
+    """
+    calibCNN with the input normalization of LidarDataModule, for inference on raw inputs.
+    If the model already normalizes its inputs (see PowerNormLayer), no normalization is added.
+    Note: the Poisson augmentation of the training is not applied.
+    """
+
+    def __init__(self, model: calibCNN, x_norm_stats: dict = None):
+        super(InferenceModel, self).__init__()
+        self.model = model
+        self.normalize = x_norm_stats is not None
+        if self.normalize:
+            self.register_buffer('mean', torch.tensor(x_norm_stats['mean'], dtype=torch.float).view(1, -1, 1, 1))
+            self.register_buffer('std', torch.tensor(x_norm_stats['std'], dtype=torch.float).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        x = x.float()
+        if self.normalize:
+            x = (x - self.mean) / self.std
+        return self.model(x)
+
+
+def load_inference_model(checkpoint_dir: str, params: dict, consts: dict) -> (InferenceModel, list):
+    """
+    Load a trial's checkpoint (saved by TuneReportCheckpointCallback) for inference
+    :param checkpoint_dir: the checkpoint folder of the trial
+    :param params: the trial's hyper parameters (params.json)
+    :param consts: the trial's consts (consts.yaml)
+    :return: InferenceModel in eval mode, and the X_features of the model (list of (feature, profile) tuples)
+    """
+    config, X_features, powers, dfilter = update_params(params.copy(), consts)
+    model = calibCNN.load_from_checkpoint(os.path.join(checkpoint_dir, "checkpoint"), map_location='cpu')
+
+    x_norm_stats = None
+    if config['dnorm'] and not isinstance(model.power_layer, PowerNormLayer):
+        # The normalization of the training data module
+        lidar_dm = LidarDataModule(nn_data_folder=consts['nn_source_data'], train_csv_path=consts["train_csv_path"],
+                                   test_csv_path=consts["test_csv_path"], stats_csv_path=consts["stats_csv_path"],
+                                   powers=powers if config['use_power'] else None, top_height=consts["top_height"],
+                                   X_features_profiles=X_features, Y_features=consts['Y_features'],
+                                   batch_size=config['bsize'], num_workers=0, data_filter=dfilter, data_norm=True)
+        x_norm_stats = lidar_dm.stats['x']
+
+    inference_model = InferenceModel(model, x_norm_stats)
+    inference_model.eval()
+    return inference_model, list(X_features)
+
+
+def export_model(inference_model: InferenceModel, example_x: torch.Tensor, export_path: str,
+                 export_format: str = 'torchscript') -> str:
+    """
+    Export the model (including the power and normalization steps) to a TorchScript or ONNX graph
+    :param inference_model: InferenceModel in eval mode
+    :param example_x: torch.Tensor of an input batch [B, C, H, W]
+    :param export_path: path of the exported file
+    :param export_format: 'torchscript' | 'onnx'
+    :return: export_path
+    """
+    logger = logging.getLogger()
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            traced = torch.jit.trace(inference_model, example_x)
+            traced.save(export_path)
+        elif export_format == 'onnx':
+            torch.onnx.export(inference_model, example_x, export_path, input_names=['x'], output_names=['y'],
+                              dynamic_axes={'x': {0: 'batch'}, 'y': {0: 'batch'}})
+        else:
+            raise ValueError(f"Unknown export format {export_format}. Should be 'torchscript' or 'onnx'")
+    logger.info(f"\nExported model to {export_path}")
+    return export_path
+
+
+def load_exported_model(export_path: str, export_format: str = 'torchscript'):
+    """
+    :return: a function of a np.ndarray batch [B, C, H, W] that returns np.ndarray of predictions [B, Y_features]
+    """
+    if export_format == 'torchscript':
+        model = torch.jit.load(export_path, map_location='cpu')
+
+        def predict(x):
+            with torch.no_grad():
+                return model(torch.from_numpy(x)).numpy()
+    else:
+        import onnxruntime  # required only for running ONNX graphs
+        session = onnxruntime.InferenceSession(export_path, providers=['CPUExecutionProvider'])
+
+        def predict(x):
+            return session.run(None, {'x': x.astype(np.float32)})[0]
+    return predict
+
+
+def load_daily_profiles(paths: list, profiles: list, top_height: float) -> list:
+    """
+    Load daily datasets, and crop the heights of the samples (as in LidarDataSet)
+    :param paths: list of the daily datasets paths, one per input channel (e.g., lidar, molecular, bg)
+    :param profiles: list of the profile names, one per input channel (e.g., 'range_corr', 'attbsc', 'p_bg')
+    :param top_height: The Height[km] above ground (Lidar) level of the samples
+    :return: list of xr.DataArray of the profiles
+    """
+    datasets = [xr_utils.load_dataset(path) for path in paths]
+    profiles_da = []
+    for ds, profile in zip(datasets, profiles):
+        hslice = slice(ds.Height.min().values.tolist(), ds.Height.min().values.tolist() + top_height)
+        profiles_da.append(ds[profile].sel(Height=hslice))
+    return profiles_da
+
+
+def get_daily_samples(paths: list, profiles: list, top_height: float, sample_size: str = '30min',
+                      wavelengths: list = None) -> (np.ndarray, pd.DataFrame):
+    """
+    Split daily datasets to the samples of the model: windows of sample_size per wavelength
+    :param paths: list of the daily datasets paths, one per input channel (e.g., lidar, molecular, bg)
+    :param profiles: list of the profile names, one per input channel (e.g., 'range_corr', 'attbsc', 'p_bg')
+    :param top_height: The Height[km] above ground (Lidar) level of the samples (as in LidarDataSet)
+    :param sample_size: time window of a sample
+    :param wavelengths: list of wavelengths to use. If None, all the wavelengths of the datasets.
+    :return: X - np.ndarray [samples, channels, height, time], and pd.DataFrame of the samples info
+    with columns 'wavelength', 'start_time_period', 'end_time_period'
+    """
+    profiles_da = load_daily_profiles(paths, profiles, top_height)
+    if wavelengths is None:
+        wavelengths = profiles_da[0].Wavelength.values.tolist()
+
+    times = pd.DatetimeIndex(profiles_da[0].Time.values)
+    n_t = int(pd.Timedelta(sample_size) / (times[1] - times[0]))
+    n_windows = len(times) // n_t
+    X_chan = []
+    for da in profiles_da:
+        # [wavelengths, height, windows, time] -> [wavelengths, windows, height, time]
+        values = da.sel(Wavelength=wavelengths).transpose('Wavelength', 'Height', 'Time').values
+        values = values[:, :, :n_windows * n_t].reshape(len(wavelengths), values.shape[1], n_windows, n_t)
+        X_chan.append(values.transpose(0, 2, 1, 3))
+    X = np.stack(X_chan, axis=2).reshape((len(wavelengths) * n_windows, len(X_chan)) + X_chan[0].shape[2:])
+
+    start_times = times[:n_windows * n_t:n_t]
+    samples_df = pd.DataFrame({'wavelength': np.repeat(wavelengths, n_windows),
+                               'start_time_period': np.tile(start_times, len(wavelengths)),
+                               'end_time_period': np.tile(times[n_t - 1:n_windows * n_t:n_t], len(wavelengths))})
+    return X, samples_df
+
+
+def run_batch_inference(predict, X: np.ndarray, batch_size: int = 256) -> (np.ndarray, float):
+    """
+    :param predict: function of a batch, see load_exported_model()
+    :param X: np.ndarray of all samples [samples, channels, height, time]
+    :param batch_size: number of samples per batch
+    :return: predictions [samples, Y_features], and the throughput [samples/sec]
+    """
+    start = perf_counter()
+    y_pred = np.concatenate([predict(np.ascontiguousarray(X[ind:ind + batch_size], dtype=np.float32))
+                             for ind in range(0, len(X), batch_size)])
+    return y_pred, len(X) / (perf_counter() - start)
+
+
+def daily_LC_inference(model: nn.Module, profiles_da: list, Y_features: list, wavelengths: list = None,
+                       sample_size: str = '30min', stride: int = 1, batch_size: int = 128) -> xr.Dataset:
+    """
+    Sliding-window LC inference for a whole day.
+    The windows of each wavelength are strided views (torch unfold) of the daily cube [channels, height, time],
+    such that only the batches are copied.
+    The LC of each window is set to the center time of the window, and the daily series is completed to all the
+    time bins of the day by the nearest window.
+    :param model: InferenceModel (or an exported TorchScript model) on CPU
+    :param profiles_da: list of daily xr.DataArray of the input channels (see load_daily_profiles())
+    :param Y_features: the outputs of the model (consts['Y_features']), must include 'LC'
+    :param wavelengths: list of wavelengths to use. If None, all the wavelengths of the datasets.
+    :param sample_size: time window of a sample, as in the training of the model
+    :param stride: stride of the windows [time bins]
+    :param batch_size: number of windows per forward pass
+    :return: xr.Dataset of the daily LC time series ('p', with dims 'Wavelength', 'Time'),
+    in the format of the generated LC (see daily_signals_generations_utils.get_daily_LC())
+    """
+    if 'LC' not in Y_features:
+        raise ValueError(f"The model doesn't estimate LC, its outputs are: {Y_features}")
+    lc_ind = list(Y_features).index('LC')
+    if wavelengths is None:
+        wavelengths = profiles_da[0].Wavelength.values.tolist()
+    times = pd.DatetimeIndex(profiles_da[0].Time.values)
+    window = int(pd.Timedelta(sample_size) / (times[1] - times[0]))
+    center_times = times[window // 2:len(times) - window + window // 2 + 1:stride]
+
+    paths_chan = []
+    for wavelength in wavelengths:
+        day_cube = torch.from_numpy(np.stack([da.sel(Wavelength=wavelength).transpose('Height', 'Time').values
+                                              for da in profiles_da])).float()
+        # [channels, height, windows, window] -> [windows, channels, height, window] (views, no copy)
+        windows = day_cube.unfold(dimension=2, size=window, step=stride).permute(2, 0, 1, 3)
+        with torch.no_grad():
+            lc = torch.cat([model(windows[ind:ind + batch_size].contiguous())
+                            for ind in range(0, windows.shape[0], batch_size)])[:, lc_ind].numpy()
+        lc_da = xr.DataArray(lc, dims=['Time'], coords={'Time': center_times}).reindex(Time=times, method='nearest')
+        paths_chan.append(xr.Dataset(data_vars={'p': ('Time', lc_da.values),
+                                                'lambda_nm': ('Wavelength', np.uint16([wavelength]))},
+                                     coords={'Time': times.values, 'Wavelength': np.uint16([wavelength])}))
+    lc_ds = xr.concat(paths_chan, dim='Wavelength')
+    lc_ds.p.attrs = {'units': r'$\rm{photons\,sr\,km^3}$',
+                     'long_name': r'$\rm{ LC_{estimated}}$',
+                     'info': f'LC - Lidar constant - estimated by calibCNN (windows of {sample_size}, '
+                             f'stride of {stride} time bins)'}
+    lc_ds.lambda_nm.attrs = {'units': r'$\rm nm$', 'long_name': r'$\lambda$'}
+    return lc_ds
+
+
+def infer_daily_LC(files_df: pd.DataFrame, checkpoint_dir: str, params: dict, consts: dict, output_path: str,
+                   stride: int = 1, batch_size: int = 128, sample_size: str = '30min') -> list:
+    """
+    Sliding-window LC inference of daily datasets, see daily_LC_inference().
+    :param files_df: pd.DataFrame with a row per day, and a column of the daily dataset path per input feature
+    :param checkpoint_dir: the checkpoint folder of the trial
+    :param params: the trial's hyper parameters
+    :param consts: the trial's consts
+    :param output_path: prefix of the output files. Saving <output_path>_<YYYY_MM_DD>_LC.nc per day.
+    :param stride: stride of the windows [time bins]
+    :param batch_size: number of windows per forward pass
+    :param sample_size: time window of a sample
+    :return: list of the saved paths
+    """
+    logger = logging.getLogger()
+    inference_model, X_features = load_inference_model(checkpoint_dir, params, consts)
+    features, profiles = map(list, zip(*X_features))
+    nc_paths = []
+    for _, row in files_df.iterrows():
+        profiles_da = load_daily_profiles(row[features].tolist(), profiles, consts['top_height'])
+        start = perf_counter()
+        lc_ds = daily_LC_inference(inference_model, profiles_da, consts['Y_features'], sample_size=sample_size,
+                                   stride=stride, batch_size=batch_size)
+        day_str = pd.Timestamp(lc_ds.Time.values[0]).strftime('%Y_%m_%d')
+        logger.info(f"\nEstimated daily LC of {day_str} in {perf_counter() - start:.1f} sec")
+        nc_path = f"{output_path}_{day_str}_LC.nc"
+        lc_ds.to_netcdf(nc_path)
+        nc_paths.append(nc_path)
+    return nc_paths
+
+
+def infer_daily_files(files_df: pd.DataFrame, checkpoint_dir: str, params: dict, consts: dict, output_path: str,
+                      export_format: str = 'torchscript', batch_size: int = 256,
+                      sample_size: str = '30min') -> pd.DataFrame:
+    """
+    Export a trained model, and apply it on daily datasets.
+    :param files_df: pd.DataFrame with a row per day, and a column of the daily dataset path per input feature
+    of the model (e.g., 'lidar_path', 'molecular_path', 'bg_path')
+    :param checkpoint_dir: the checkpoint folder of the trial
+    :param params: the trial's hyper parameters
+    :param consts: the trial's consts
+    :param output_path: path of the output files (without extension). Saving <output_path>.csv, <output_path>.nc,
+    and the exported model <output_path>.pt (or .onnx)
+    :param export_format: 'torchscript' | 'onnx'
+    :param batch_size: inference batch size
+    :param sample_size: time window of a sample
+    :return: pd.DataFrame of the predictions per (wavelength, time window)
+    """
+    logger = logging.getLogger()
+    inference_model, X_features = load_inference_model(checkpoint_dir, params, consts)
+    features, profiles = map(list, zip(*X_features))
+    Y_features = consts['Y_features']
+    export_path = f"{output_path}.{'pt' if export_format == 'torchscript' else 'onnx'}"
+
+    predict = None
+    results = []
+    n_samples, total_time = 0, 0.0
+    for _, row in files_df.iterrows():
+        X, samples_df = get_daily_samples(row[features].tolist(), profiles, consts['top_height'], sample_size)
+        if predict is None:
+            export_model(inference_model, torch.from_numpy(X[:2].astype(np.float32)), export_path, export_format)
+            predict = load_exported_model(export_path, export_format)
+        y_pred, samples_per_sec = run_batch_inference(predict, X, batch_size)
+        samples_df[Y_features] = y_pred
+        results.append(samples_df)
+        n_samples += len(X)
+        total_time += len(X) / samples_per_sec
+        logger.info(f"\nPredicted {len(X)} samples of {samples_df.start_time_period.iloc[0].date()}, "
+                    f"{samples_per_sec:.1f} samples/sec")
+
+    results_df = pd.concat(results, ignore_index=True)
+    logger.info(f"\nTotal throughput: {n_samples / total_time:.1f} samples/sec ({n_samples} samples)")
+
+    results_df.to_csv(f"{output_path}.csv", index=False)
+    results_ds = results_df.rename(columns={'wavelength': 'Wavelength', 'start_time_period': 'Time'}). \
+        set_index(['Wavelength', 'Time']).to_xarray()
+    results_ds.attrs = {'info': 'Predictions of calibCNN per wavelength and time window',
+                        'checkpoint': checkpoint_dir}
+    results_ds.to_netcdf(f"{output_path}.nc")
+    logger.info(f"\nSaved predictions to {output_path}.csv, {output_path}.nc")
+    return results_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--experiment_name', type=str, required=True,
+                        help='Experiment folder name in RESULTS_PATH, e.g. main_2022-03-26_19-43-28')
+    parser.add_argument('--trial_id', type=str, required=True,
+                        help='Trial id, e.g. dd418_00191')
+    parser.add_argument('--checkpoint_id', type=int, default=0,
+                        help='Epoch of the checkpoint')
+    parser.add_argument('--files_csv', type=str, required=True,
+                        help='csv of the daily datasets, a row per day with a column per input feature path '
+                             '(e.g. lidar_path, molecular_path, bg_path)')
+    parser.add_argument('--output_path', type=str, required=True,
+                        help='Path of the outputs, without extension')
+    parser.add_argument('--export_format', type=str, default='torchscript', choices=['torchscript', 'onnx'],
+                        help='Format of the exported model')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='Inference batch size')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='Number of CPU threads for inference (default: torch default)')
+    parser.add_argument('--daily_stride', type=int, default=None,
+                        help='If given, estimating LC for the whole day by sliding windows with this stride '
+                             '[time bins], instead of the separate windows')
+    args = parser.parse_args()
+
+    logger = create_and_configer_logger(
+        log_name=f"{os.path.dirname(__file__)}_inference_{datetime.now().strftime('%Y-%m-%d %H_%M_%S')}.log",
+        level=logging.INFO)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    checkpoint_dir, params, consts = get_checkpoint_params_const(RESULTS_PATH, args.experiment_name,
+                                                                 args.trial_id, args.checkpoint_id)
+    if args.daily_stride:
+        infer_daily_LC(pd.read_csv(args.files_csv), checkpoint_dir, params, consts, args.output_path,
+                       stride=args.daily_stride, batch_size=args.batch_size)
+    else:
+        infer_daily_files(pd.read_csv(args.files_csv), checkpoint_dir, params, consts, args.output_path,
+                          export_format=args.export_format, batch_size=args.batch_size)
@@ -1,12 +1,15 @@
+import os
 from abc import ABC
 
 import numpy as np
+import pandas as pd
 import torch
 from pytorch_lightning.core.lightning import LightningModule
 from torch import nn
 from torch.optim import Adam
 
 from learning_lidar.learning_phase.learn_utils.custom_losses import MARELoss
+from learning_lidar.utils.global_settings import eps
 
 
 class PowerLayer(nn.Module):
@@ -20,9 +23,24 @@ class PowerLayer(nn.Module):
         self.powers.retain_grad = do_opt_powers
 
     def forward(self, x):
-        for c_i, p_i in enumerate(self.powers):
-            x[:, c_i, :, :] = torch.pow(x[:, c_i, :, :], p_i)
-        return x
+        # broadcast the powers over the channels (not in place - the input batch is not changed)
+        return torch.pow(x, self.powers.view(1, -1, 1, 1).to(x.dtype))
+
+
+class PowerNormLayer(PowerLayer):
+    """
+    Fused input block: power, and then normalization by the mean and std of the data (after power).
+    This replaces the normalization of LidarDataModule, so the model takes the raw inputs directly.
+    """
+
+    def __init__(self, powers, mean, std, do_opt_powers: bool = False):
+        super(PowerNormLayer, self).__init__(powers=powers, do_opt_powers=do_opt_powers)
+        self.register_buffer('mean', torch.tensor(mean, dtype=torch.float).view(1, -1, 1, 1))
+        self.register_buffer('std', torch.tensor(std, dtype=torch.float).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        x = super(PowerNormLayer, self).forward(x)
+        return (x - self.mean.to(x.dtype)) / self.std.to(x.dtype)
 
 
 # init parameters https://stackoverflow.com/questions/49433936/how-to-initialize-weights-in-pytorch
@@ -45,17 +63,33 @@ class calibCNN(LightningModule, ABC):
                 init_func(p)
 
     def __init__(self, in_channels, output_size, hidden_sizes, fc_size, loss_type, learning_rate, X_features_profiles,
-                 powers, weight_decay=0, do_opt_powers: bool = False, conv_bias: bool = True):
+                 powers, weight_decay=0, do_opt_powers: bool = False, conv_bias: bool = True,
+                 x_norm_stats: dict = None, val_log_every: int = 10, save_val_predictions: bool = False):
+        """
+        :param x_norm_stats: dict of 'mean' and 'std' lists (per input channel, after power).
+        If given, the inputs are normalized by the model (fused with the power layer, see PowerNormLayer),
+        instead of by the data module.
+        :param val_log_every: log the per-wavelength and per-target validation metrics every val_log_every epochs
+        :param save_val_predictions: If True, save the validation predictions to a csv file every val_log_every epochs
+        (always saved in overfit mode)
+        """
         super().__init__()
         self.save_hyperparameters()  # TODO: IS this doing anything?
         self.lr = learning_rate
         self.weight_decay = weight_decay
         self.eps = torch.tensor(np.finfo(float).eps)
         self.cov_bias = conv_bias
+        self.val_log_every = val_log_every
+        self.save_val_predictions = save_val_predictions
         X_features, profiles = map(list, zip(*X_features_profiles))
         self.x_powers = [powers[profile] for profile in profiles] if powers else None
 
-        self.power_layer = PowerLayer(powers=self.x_powers, do_opt_powers=do_opt_powers) if powers else None
+        if x_norm_stats:
+            self.power_layer = PowerNormLayer(powers=self.x_powers if powers else [1.0] * in_channels,
+                                              mean=x_norm_stats['mean'], std=x_norm_stats['std'],
+                                              do_opt_powers=do_opt_powers if powers else False)
+        else:
+            self.power_layer = PowerLayer(powers=self.x_powers, do_opt_powers=do_opt_powers) if powers else None
         self.conv_layer = nn.Sequential(
             # Conv layer 1
             nn.Conv2d(in_channels=in_channels, out_channels=hidden_sizes[0], kernel_size=(5, 3), padding=3,
@@ -123,7 +157,7 @@ class calibCNN(LightningModule, ABC):
     def forward(self, x):
         batch_size, channels, width, height = x.size()
         x = x.float()
-        if self.x_powers is not None:
+        if self.power_layer is not None:
             x = self.power_layer(x)
 
         # conv layers
@@ -162,12 +196,58 @@ class calibCNN(LightningModule, ABC):
         if self.x_powers is not None:
             for c_i in range(x.size()[1]):
                 self.log(f"gamma_x/channel_{c_i}", self.x_powers[c_i])
-        # Log Y values for overfitt test
-        if (self.trainer.overfit_batches > 0) & (self.current_epoch % 10 == 0):
-            for ind, (y_i, y_pred_i) in enumerate(zip(y, y_pred)):
-                self.log(f"overfitt/y_{ind}/orig", y_i)
-                self.log(f"overfitt/y_{ind}/pred", y_pred_i)
-        return loss
+        return {'loss': loss, 'y': y.detach(), 'y_pred': y_pred.detach(), 'wavelength': batch['wavelength']}
+
+    def validation_epoch_end(self, outputs):
+        if self.current_epoch % self.val_log_every != 0:
+            return
+        y = torch.cat([output['y'] for output in outputs])
+        y_pred = torch.cat([output['y_pred'] for output in outputs])
+        wavelength = torch.cat([output['wavelength'].view(-1) for output in outputs])
+
+        self.log_dict(self.calc_val_metrics(y, y_pred, wavelength))
+        experiment = getattr(self.logger, 'experiment', None)
+        if hasattr(experiment, 'add_histogram'):
+            experiment.add_histogram("val_hist/rel_err", torch.abs(y_pred - y) / (y + eps), self.current_epoch)
+            experiment.add_histogram("val_hist/y_pred", y_pred, self.current_epoch)
+
+        # Save Y values (e.g. for overfitt test)
+        if self.save_val_predictions or (self.trainer.overfit_batches > 0):
+            self.save_predictions(y, y_pred, wavelength)
+
+    @staticmethod
+    def calc_val_metrics(y: torch.Tensor, y_pred: torch.Tensor, wavelength: torch.Tensor) -> dict:
+        """
+        Mean absolute error (MAE) and mean absolute relative error (MARE) per wavelength and per target,
+        calculated for all the samples at once (by a wavelengths indicator matrix).
+        :param y: [samples, targets] true values
+        :param y_pred: [samples, targets] predicted values
+        :param wavelength: [samples] wavelength of each sample
+        :return: dict of metric name -> value
+        """
+        wavelengths, inds = torch.unique(wavelength, return_inverse=True)
+        indicator = nn.functional.one_hot(inds, len(wavelengths)).to(y.dtype)  # [samples, wavelengths]
+        counts = indicator.sum(0).unsqueeze(1)
+        abs_err = torch.abs(y_pred - y)
+        mae = indicator.T @ abs_err / counts  # [wavelengths, targets]
+        mare = indicator.T @ (abs_err / (y + eps)) / counts
+        metrics = {}
+        for w_i, wavelength_i in enumerate(wavelengths.tolist()):
+            for t_i in range(y.shape[1]):
+                metrics[f"val_metrics/MAE_{wavelength_i}_y{t_i}"] = mae[w_i, t_i]
+                metrics[f"val_metrics/MARE_{wavelength_i}_y{t_i}"] = mare[w_i, t_i]
+        return metrics
+
+    def save_predictions(self, y: torch.Tensor, y_pred: torch.Tensor, wavelength: torch.Tensor):
+        """
+        Save the validation predictions of the current epoch to a single csv file in the log folder
+        """
+        log_dir = self.trainer.log_dir if self.trainer.log_dir else os.getcwd()
+        predictions_df = pd.DataFrame({'wavelength': wavelength.cpu().numpy()})
+        for t_i in range(y.shape[1]):
+            predictions_df[f"y{t_i}"] = y[:, t_i].cpu().numpy()
+            predictions_df[f"y{t_i}_pred"] = y_pred[:, t_i].cpu().numpy()
+        predictions_df.to_csv(os.path.join(log_dir, f"val_predictions_epoch={self.current_epoch}.csv"), index=False)
 
     def configure_optimizers(self):
         return Adam(self.parameters(), lr=self.lr, weight_decay=self.weight_decay)
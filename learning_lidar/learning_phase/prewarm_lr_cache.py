@@ -0,0 +1,78 @@
+import argparse
+import logging
+import os.path
+from copy import deepcopy
+from datetime import datetime
+from itertools import product
+
+from pytorch_lightning import Trainer, seed_everything
+
+from learning_lidar.learning_phase.learn_utils.lr_finder_cache import find_learning_rate, get_lr_cache_params, \
+    get_lr_cache_key
+from learning_lidar.learning_phase.main_lightning import SEED, get_data_module_and_model
+from learning_lidar.learning_phase.run_params import CONSTS, RAY_HYPER_PARAMS, NON_RAY_HYPER_PARAMS, update_params
+from learning_lidar.utils.utils import create_and_configer_logger
+
+
+def expand_hyper_params(hyper_params: dict) -> list:
+    """
+    Expand the search space of hyper parameters to a list of configurations.
+    tune.grid_search() and tune.choice() values are expanded to all their options.
+    :param hyper_params: dict of hyper parameters (e.g. RAY_HYPER_PARAMS)
+    :return: list of configuration dicts
+    """
+    options = {}
+    for key, value in hyper_params.items():
+        if isinstance(value, dict) and 'grid_search' in value:
+            options[key] = list(value['grid_search'])
+        elif hasattr(value, 'categories'):
+            options[key] = list(value.categories)
+        else:
+            options[key] = [value]
+    return [dict(zip(options.keys(), values)) for values in product(*options.values())]
+
+
+def prewarm_lr_cache(configs: list, consts: dict, num_training: int = 100) -> int:
+    """
+    Run the learning rate finder for each unique model and data configuration, that is not in the cache yet
+    :param configs: list of configuration dicts (see expand_hyper_params())
+    :param consts: constants of the experiment (e.g. CONSTS), with the 'lr_cache_path'
+    :param num_training: number of learning rates to test in each search
+    :return: number of searched configurations
+    """
+    logger = logging.getLogger()
+    searched_keys = set()
+    for config in configs:
+        config, X_features, powers, dfilter = update_params(deepcopy(config), deepcopy(consts))
+        lr_params = get_lr_cache_params(config, consts, X_features, powers, dfilter)
+        key = get_lr_cache_key(lr_params)
+        if key in searched_keys:
+            continue
+        searched_keys.add(key)
+
+        seed_everything(SEED)
+        lidar_dm, model = get_data_module_and_model(config, consts, X_features, powers, dfilter)
+        trainer = Trainer(gpus=[0] if consts['num_gpus'] > 0 else 0, logger=False, checkpoint_callback=False)
+        lidar_dm.setup('fit')
+        find_learning_rate(trainer, model, lidar_dm, lr_params, consts['lr_cache_path'], num_training=num_training)
+    logger.info(f"\nThe learning rate cache {consts['lr_cache_path']} is ready for {len(searched_keys)} configurations")
+    return len(searched_keys)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--non_ray', action='store_true',
+                        help='Pre-warm for NON_RAY_HYPER_PARAMS, instead of the sweep of RAY_HYPER_PARAMS')
+    parser.add_argument('--lr_cache_path', type=str, default=None,
+                        help="Path of the cache csv file (default: CONSTS['lr_cache_path'])")
+    parser.add_argument('--num_training', type=int, default=100,
+                        help='Number of learning rates to test in each search')
+    args = parser.parse_args()
+
+    logger = create_and_configer_logger(
+        log_name=f"{os.path.dirname(__file__)}_lr_cache_{datetime.now().strftime('%Y-%m-%d %H_%M_%S')}.log",
+        level=logging.INFO)
+    if args.lr_cache_path:
+        CONSTS['lr_cache_path'] = args.lr_cache_path
+    configs = expand_hyper_params(NON_RAY_HYPER_PARAMS if args.non_ray else RAY_HYPER_PARAMS)
+    prewarm_lr_cache(configs, CONSTS, num_training=args.num_training)
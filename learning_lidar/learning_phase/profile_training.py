@@ -0,0 +1,136 @@
+import argparse
+import logging
+import os.path
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import torch
+import torchvision
+from pytorch_lightning import Trainer, seed_everything
+from torch.utils.data import DataLoader
+
+from learning_lidar.learning_phase.data_modules.lidar_data_module import LidarDataModule, InMemoryLidarDataSet
+from learning_lidar.learning_phase.learn_utils.custom_operations import ApplyPoisson
+from learning_lidar.learning_phase.learn_utils.throughput_profiler import ThroughputProfiler, profile_dataset, \
+    PROFILER_METRICS
+from learning_lidar.learning_phase.models.calibCNN import calibCNN
+from learning_lidar.learning_phase.run_params import CONSTS, NON_RAY_HYPER_PARAMS, update_params
+from learning_lidar.utils.utils import create_and_configer_logger
+
+SEED = 8318
+SYNTHETIC_X_FEATURES = (("lidar_path", "range_corr"), ("molecular_path", "attbsc"), ("bg_path", "p_bg_poiss"))
+
+
+def get_synthetic_dataset(n_samples: int = 1024, height_bins: int = 2048, time_bins: int = 60,
+                          n_channels: int = 3, output_size: int = 2, seed: int = None) -> InMemoryLidarDataSet:
+    """
+    Generate a dataset of random samples in memory, with the per-sample transforms of LidarDataModule
+    (Poisson noise of the background channel and normalization).
+    Used as a baseline of the training throughput, without the files I/O.
+    :param n_samples: number of samples
+    :param height_bins: number of height bins per sample
+    :param time_bins: number of time bins per sample
+    :param n_channels: number of input channels (the Poisson noise is applied on the third channel)
+    :param output_size: number of outputs per sample
+    :param seed: seed of the random generator
+    :return: InMemoryLidarDataSet() of the samples
+    """
+    rng = np.random.default_rng(seed)
+    arrays = {'x': rng.uniform(1.0, 10.0, (n_samples, n_channels, height_bins, time_bins)).astype(np.float32),
+              'y': rng.uniform(0.5, 5.0, (n_samples, output_size)).astype(np.float32),
+              'wavelength': rng.choice([355, 532, 1064], n_samples)}
+    transforms_list = [ApplyPoisson(channel=2)] if n_channels > 2 else []
+    transforms_list.append(torchvision.transforms.Normalize(mean=(5.5,) * n_channels, std=(2.6,) * n_channels))
+    return InMemoryLidarDataSet(arrays, transforms=torchvision.transforms.Compose(transforms_list))
+
+
+def profile_training(config: dict, consts: dict, synthetic: bool = False, n_samples: int = 1024,
+                     max_steps: int = 100, num_workers: int = None, batch_size: int = None,
+                     csv_path: str = 'throughput_profile.csv') -> pd.DataFrame:
+    """
+    Profile the training throughput of calibCNN (see ThroughputProfiler())
+    :param config: hyper parameters of the model (e.g. NON_RAY_HYPER_PARAMS)
+    :param consts: constants of the experiment (e.g. CONSTS)
+    :param synthetic: If True, train on random samples in memory (see get_synthetic_dataset()),
+    otherwise on the train set of LidarDataModule
+    :param n_samples: number of synthetic samples
+    :param max_steps: number of training steps
+    :param num_workers: number of DataLoader workers (default: consts['num_workers'])
+    :param batch_size: batch size (default: config['bsize'])
+    :param csv_path: path of the output csv file
+    :return: pd.DataFrame() of the measurements (a row per step, and a row per epoch)
+    """
+    logger = logging.getLogger()
+    config, X_features, powers, dfilter = update_params(config, consts)
+    num_workers = consts['num_workers'] if num_workers is None else num_workers
+    batch_size = batch_size if batch_size else config['bsize']
+
+    if synthetic:
+        X_features = SYNTHETIC_X_FEATURES[:len(X_features)]
+        powers = None
+        train_set = get_synthetic_dataset(n_samples=n_samples, n_channels=len(X_features),
+                                          output_size=len(consts['Y_features']), seed=SEED)
+    else:
+        lidar_dm = LidarDataModule(nn_data_folder=consts['nn_source_data'], train_csv_path=consts["train_csv_path"],
+                                   test_csv_path=consts["test_csv_path"], stats_csv_path=consts["stats_csv_path"],
+                                   powers=powers if config['use_power'] else None, top_height=consts["top_height"],
+                                   X_features_profiles=X_features, Y_features=consts['Y_features'],
+                                   batch_size=batch_size, data_filter=dfilter, data_norm=config['dnorm'],
+                                   num_workers=num_workers)
+        lidar_dm.setup('fit')
+        train_set = lidar_dm.train
+
+    train_set, transform_counters = profile_dataset(train_set)
+    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                              persistent_workers=num_workers > 0)
+
+    model = calibCNN(in_channels=len(X_features), output_size=len(consts['Y_features']),
+                     hidden_sizes=eval(config['hsizes']), fc_size=eval(config['fc_size']),
+                     loss_type=config['ltype'], learning_rate=config['lr'], weight_decay=config['wdecay'],
+                     X_features_profiles=X_features, powers=powers,
+                     do_opt_powers=config.get('opt_powers', False), conv_bias=config['cbias'])
+
+    profiler = ThroughputProfiler(csv_path=csv_path, dataset=train_set, transform_counters=transform_counters,
+                                  num_workers=num_workers)
+    trainer = Trainer(max_steps=max_steps, callbacks=[profiler], limit_val_batches=0,
+                      gpus=[0] if (consts['num_gpus'] > 0 and not synthetic) else 0,
+                      checkpoint_callback=False, logger=False)
+    trainer.fit(model, train_loader)
+
+    profile_df = pd.DataFrame(profiler.rows)
+    steps_df = profile_df.dropna(subset=['step'])
+    logger.info(f"\nThroughput profile ({'synthetic' if synthetic else 'train set'}, batch size {batch_size}, "
+                f"{num_workers} workers):\nMean per step [sec]:\n{steps_df[PROFILER_METRICS].mean()}"
+                f"\nPer epoch:\n{profile_df[profile_df['step'].isna()].dropna(axis=1, how='all')}")
+    return profile_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--synthetic', action='store_true',
+                        help='Train on random samples in memory, as a baseline of the pure compute throughput')
+    parser.add_argument('--n_samples', type=int, default=1024,
+                        help='Number of synthetic samples')
+    parser.add_argument('--max_steps', type=int, default=100,
+                        help='Number of training steps to profile')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of DataLoader workers (default: CONSTS num_workers)')
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help='Batch size (default: bsize of NON_RAY_HYPER_PARAMS)')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='Number of CPU threads (default: torch default)')
+    parser.add_argument('--csv_path', type=str, default='throughput_profile.csv',
+                        help='Path of the output csv file')
+    args = parser.parse_args()
+
+    logger = create_and_configer_logger(
+        log_name=f"{os.path.dirname(__file__)}_profile_{datetime.now().strftime('%Y-%m-%d %H_%M_%S')}.log",
+        level=logging.INFO)
+    seed_everything(SEED)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    profile_training(NON_RAY_HYPER_PARAMS, CONSTS, synthetic=args.synthetic, n_samples=args.n_samples,
+                     max_steps=args.max_steps, num_workers=args.num_workers, batch_size=args.batch_size,
+                     csv_path=args.csv_path)
@@ -67,6 +67,30 @@ def update_params(config, consts):
     return config, X_features, powers, dfilter
 
 
+def get_trial_scheduler(scheduler_type, max_t=None, grace_period=1, reduction_factor=3):
+    """
+    Trials scheduler for tune.run(). The metric and mode are set by tune.run().
+    The time unit is 'training_iteration', i.e., number of validations reported by TuneReportCheckpointCallback.
+    :param scheduler_type: None (run all trials to the end) | 'asha' | 'median'
+    :param max_t: max training iterations of a trial (required by ASHA)
+    :param grace_period: min training iterations before a trial can be stopped
+    :param reduction_factor: ASHA halving rate - only 1/reduction_factor of the trials are promoted at each rung
+    :return: tune scheduler, or None for tune's default (FIFO) scheduler
+    """
+    if not scheduler_type:
+        return None
+    elif scheduler_type == 'asha':
+        if max_t is None:
+            raise ValueError("ASHA scheduler requires max_t: set CONSTS['max_epochs'] or SCHEDULER_PARAMS['max_t'] "
+                             "(e.g., when the trials are bounded by max_steps)")
+        return tune.schedulers.ASHAScheduler(time_attr='training_iteration', max_t=max_t,
+                                             grace_period=grace_period, reduction_factor=reduction_factor)
+    elif scheduler_type == 'median':
+        return tune.schedulers.MedianStoppingRule(time_attr='training_iteration', grace_period=grace_period)
+    else:
+        raise ValueError(f"Unknown scheduler type {scheduler_type}. Should be one of: None, 'asha', 'median'")
+
+
 # TODO: Load Trainer chekpoint  https://pytorch-lightning.readthedocs.io/en/stable/common/weights_loading.html
 #  restoring-training-state name of trainer : epoch=29-step=3539.ckpt found under
 #  C:...\main_2022-01-31_23-24-22\main_28520_00024_24_bsize=32,dfilter=('wavelength', [355]),dnorm=False,
@@ -173,6 +197,13 @@ CONSTS = CONSTS if CONSTS else {
     'max_epochs': 20,
     'max_steps': None,
     'num_workers': int(NUM_AVILABLE_CPU * 0.9),
+    'shared_data': False,  # Load the train data once per node to memory (ray's object store), shared by all trials
+    'trial_num_workers': 1,  # Number of DataLoader workers per trial if shared_data (the samples are in memory)
+    'batch_transforms': False,  # Apply Poisson noise and normalization on whole batches (on device), not per sample
+    'fused_norm': False,  # If dnorm, normalize the inputs in the model after the power layer (see PowerNormLayer)
+    'profile_throughput': False,  # Profile the data loading and training steps times (see ThroughputProfiler)
+    'lr_find': False,  # Search the learning rate of each trial, cached per model & data config (see lr_finder_cache)
+    'lr_cache_path': os.path.join(RESULTS_PATH, 'lr_finder_cache.csv'),
     'train_csv_path': train_csv_path,
     'test_csv_path': test_csv_path,
     'stats_csv_path': stats_csv_path,
@@ -246,6 +277,13 @@ NON_RAY_HYPER_PARAMS = {
     # 'operations': None
     'db_type': db_type,  # 'extended' or 'initial'. This is set at the beginning.(adding it for logging)
 }
+# ######## TRIALS SCHEDULER #########
+SCHEDULER = None  # Options: None (all trials run to max_epochs) | 'asha' | 'median'. Stopping is by MARELoss
+SCHEDULER_PARAMS = {'grace_period': 3,  # Min number of epochs (validations) before a trial can be stopped
+                    'reduction_factor': 3,  # ASHA only: 1/reduction_factor of the trials continue at each rung
+                    'max_t': None,  # ASHA only: max training iterations of a trial. None: CONSTS['max_epochs']
+                    }
+
 USE_RAY = True
 DEBUG_RAY = False
 INIT_PARAMETERS = True
@@ -0,0 +1,68 @@
+import logging
+import os
+import tracemalloc
+from datetime import timedelta
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import learning_lidar.preprocessing.preprocessing_utils as prep_utils
+from learning_lidar.utils import utils, global_settings as gs
+
+
+def benchmark_daily_range_corr(station: gs.Station, days: list, use_km_units: bool = True) -> pd.DataFrame:
+    """
+    Benchmark of the daily range corrected signal retrieval:
+    prep_utils.get_daily_range_corr() (xr.open_mfdataset) vs. prep_utils.assemble_daily_range_corr().
+    :param station: gs.station() object of the lidar station
+    :param days: list of datetime.date objects of the days to benchmark
+    :param use_km_units: Boolean flag, to set the scale of units of the output data ,True - km units, False - meter units
+    :return: pd.DataFrame() with the run time [sec] and peak memory [MB] of each method per day,
+     and the maximal absolute difference of the range corrected signals.
+    """
+    logger = logging.getLogger()
+    methods = {'mfdataset': prep_utils.get_daily_range_corr,
+               'assemble': prep_utils.assemble_daily_range_corr}
+    rows = []
+    for day_date in days:
+        row = {'date': day_date.strftime('%Y-%m-%d')}
+        range_corr = {}
+        for method, func in methods.items():
+            tracemalloc.start()
+            start = perf_counter()
+            try:
+                range_corr_ds = func(station, day_date, use_km_units=use_km_units).load()
+                range_corr[method] = range_corr_ds.range_corr.transpose('Wavelength', 'Height', 'Time')
+            except Exception:
+                logger.exception(f"\n{method} failed for {row['date']}")
+            row[f"{method}_time"] = perf_counter() - start
+            row[f"{method}_peak_MB"] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+
+        if len(range_corr) == len(methods) and range_corr['mfdataset'].shape == range_corr['assemble'].shape:
+            row['max_abs_diff'] = float(np.abs(range_corr['mfdataset'].values - range_corr['assemble'].values).max())
+        else:
+            row['max_abs_diff'] = np.nan
+        logger.info(f"\n{row}")
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = utils.get_base_arguments()
+    parser.add_argument('--num_days', type=int, default=7,
+                        help='Number of days to benchmark, starting at start_date')
+    parser.add_argument('--use_km_unit', action='store_true',
+                        help='Whether to use_km_unit')
+    args = parser.parse_args()
+
+    logging.getLogger('matplotlib').setLevel(logging.ERROR)  # Fix annoying matplotlib logs
+    logging.getLogger('PIL').setLevel(logging.ERROR)  # Fix annoying PIL logs
+    logger = utils.create_and_configer_logger(os.path.join(gs.PKG_ROOT_DIR, "preprocessing", "logs",
+                                                           "benchmark_range_corr.log"), level=logging.INFO)
+    station = gs.Station(station_name=args.station_name)
+    days = [(args.start_date + timedelta(days=i)).date() for i in range(args.num_days)]
+    benchmark_df = benchmark_daily_range_corr(station, days, use_km_units=args.use_km_unit)
+    logger.info(f"\nBenchmark results:\n{benchmark_df}\n\nMean:\n{benchmark_df.mean(numeric_only=True)}")
@@ -13,7 +13,7 @@ from tqdm import tqdm
 
 import learning_lidar.preprocessing.preprocessing_utils as prep_utils
 from learning_lidar.preprocessing.fix_gdas_errors import download_from_noa_gdas_files
-from learning_lidar.utils import utils, xr_utils, global_settings as gs
+from learning_lidar.utils import utils, global_settings as gs
 
 
 def preprocessing_main(params):
@@ -111,46 +111,39 @@ def preprocessing_main(params):
             ZipFile(file_name).extractall(save_path)
 
     ''' Generate lidar datasets for required period --> take post-processed data by PollyNet : level1a'''
+    logs_folder = os.path.join(gs.PKG_ROOT_DIR, "preprocessing", "logs")
+    period_str = f"{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}"
     if params.generate_lidar_ds:
-        lidarpaths = []
         logger.info(
             f"\nStart generating lidar datasets for period [{start_date.strftime('%Y-%m-%d')},"
             f"{end_date.strftime('%Y-%m-%d')}]")
 
-        for day_date in tqdm(valid_gdas_days):
-            # Generate daily range corrected
-            lidar_ds = prep_utils.get_daily_range_corr(station, day_date, use_km_units=True,
-                                                       optim_size=False,
-                                                       verbose=False)
-
-            # Save lidar dataset
-            lidar_paths = xr_utils.save_prep_dataset(station, lidar_ds, data_source='lidar', level='level1a',
-                                                     save_mode='single',
-                                                     profiles=['range_corr'])
-            lidarpaths.extend(lidar_paths)
+        report_df = prep_utils.gen_periodic_lidar_ds(station, valid_gdas_days, level='level1a', use_km_units=True,
+                                                     num_workers=params.num_workers, overwrite=params.overwrite,
+                                                     report_path=os.path.join(logs_folder,
+                                                                              f"failed_level1a_{period_str}.csv"),
+                                                     assemble_range_corr=params.assemble_range_corr,
+                                                     from_zip=params.from_zip, tmp_folder=params.tmp_folder)
         logger.info(
             f"\nDone creation of lidar datasets for period "
             f"[{start_date.strftime('%Y-%m-%d')},{end_date.strftime('%Y-%m-%d')}]")
 
-        logger.debug(f'\nLidar paths: {lidarpaths}')
+        logger.debug(f'\nLidar paths: {report_df.paths.sum()}')
     ''' Obtaining lidar datasets for required period --> take raw measurements : level0'''''
     if params.generate_raw_lidar_ds:
-        lidarpaths = []
         logger.info(f"\nStart obtaining raw lidar datasets for period [{start_date.strftime('%Y-%m-%d')},"
                     f"{end_date.strftime('%Y-%m-%d')}]")
 
-        for day_date in tqdm(valid_gdas_days):
-            # Generate daily range corrected
-            # TODO delete the raw separated lidar measurements after creating the merge dataset
-            lidar_ds = prep_utils.get_daily_raw_measurements(station, day_date, use_km_units=params.use_km_unit)
-
-            # Save lidar dataset
-            lidar_paths = xr_utils.save_prep_dataset(station, lidar_ds, data_source='lidar', save_mode='single')
-            lidarpaths.extend(lidar_paths)
+        report_df = prep_utils.gen_periodic_lidar_ds(station, valid_gdas_days, level='level0',
+                                                     use_km_units=params.use_km_unit,
+                                                     num_workers=params.num_workers, overwrite=params.overwrite,
+                                                     report_path=os.path.join(logs_folder,
+                                                                              f"failed_level0_{period_str}.csv"),
+                                                     from_zip=params.from_zip, tmp_folder=params.tmp_folder)
         logger.info(f"\nDone creation of lidar datasets for period "
                     f"[{start_date.strftime('%Y-%m-%d')},{end_date.strftime('%Y-%m-%d')}]")
 
-        logger.debug(f'\nLidar paths: {lidarpaths}')
+        logger.debug(f'\nLidar paths: {report_df.paths.sum()}')
 
 
 if __name__ == '__main__':
@@ -176,6 +169,25 @@ if __name__ == '__main__':
 
     parser.add_argument('--unzip_lidar_tropos', action='store_true',
                         help='Whether to unzip downloaded TROPOS lidar data')
+
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of processes for generating the lidar datasets (generate_lidar_ds, '
+                             'generate_raw_lidar_ds). Default is the number of cpu-s minus one')
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Whether to generate lidar datasets again for days having existing datasets')
+
+    parser.add_argument('--assemble_range_corr', action='store_true',
+                        help='Whether to assemble the daily range corrected signal from level1a files with '
+                             'prep_utils.assemble_daily_range_corr() instead of xr.open_mfdataset()')
+
+    parser.add_argument('--from_zip', action='store_true',
+                        help='Whether to read the TROPOS files for generate_lidar_ds / generate_raw_lidar_ds directly '
+                             'from the downloaded zip archives, instead of the extracted files (see unzip_lidar_tropos)')
+
+    parser.add_argument('--tmp_folder', type=str, default=None,
+                        help='Folder for temporary files streamed from the zip archives (when using from_zip). '
+                             'Default is the system temp folder')
     args = parser.parse_args()
 
     preprocessing_main(args)
@@ -2,15 +2,23 @@ import glob
 import logging
 import os
 import re
+import shutil
+import tempfile
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta, time, date
+from fnmatch import fnmatch
 from functools import partial
+from multiprocessing import Pool, cpu_count
 from typing import Union
+from zipfile import ZipFile
 
+import dask
 import numpy as np
 import pandas as pd
 import xarray as xr
 from lidar_molecular import rayleigh_scattering
 from pandas.core.dtypes.common import is_numeric_dtype
+from tqdm import tqdm
 
 from learning_lidar.utils import misc_lidar, xr_utils, global_settings as gs
 from learning_lidar.utils.utils import write_row_to_csv
@@ -326,6 +334,65 @@ def get_TROPOS_day_folder_name(parent_folder: os.path, day_date: datetime) -> os
     return day_folder
 
 
+def get_TROPOS_zip_paths(station: gs.Station, day_date: datetime, level: str = 'level0') -> list[os.path]:
+    """
+    Retrieves the zip archives downloaded from TROPOS for a given station and day_date.
+    The archives are expected in station.lidar_src_folder (level0) or station.lidar_src_calib_folder (level1a),
+    named by: '<YYYY>_<MM>_<DD>_*.zip'
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.datetime object of the measuring date
+    :param level: str, should be 'level0' or 'level1a' according to tropos data.
+    :return: paths: sorted paths to the zip files of day_date
+    """
+    parent_folder = station.lidar_src_folder if level == 'level0' else station.lidar_src_calib_folder
+    paths_pattern = os.path.join(parent_folder, f"{day_date.strftime('%Y_%m_%d')}_*.zip")
+    return sorted(glob.glob(paths_pattern))
+
+
+@contextmanager
+def extract_TROPOS_zip_members(station: gs.Station, day_date: datetime, file_type: Union[str, None] = 'att_bsc',
+                               level: str = 'level0', tmp_folder: Union[os.path, None] = None) -> list[os.path]:
+    """
+    Context manager, streaming the netcdf members of the day's TROPOS zip archives that match file_type,
+    each to a temporary file. The zip archives are not extracted, and the temporary files are deleted on exit.
+    Members with the same file name are streamed once (from the first archive).
+    Usage:
+        with extract_TROPOS_zip_members(station, day_date, file_type=None, level='level0') as raw_paths:
+            ds = get_daily_raw_measurements(station, day_date, nc_paths=raw_paths)
+
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.datetime object of the measuring date
+    :param file_type: type of data stored in the files, see get_TROPOS_dataset_file_name()
+    :param level: str, should be 'level0' or 'level1a' according to tropos data.
+    :param tmp_folder: Optional. Folder for the temporary files (e.g., a RAM disk). Default is the system temp folder.
+    :return: sorted paths to the temporary netcdf files
+    """
+    logger = logging.getLogger()
+    zip_paths = get_TROPOS_zip_paths(station, day_date, level)
+    if not zip_paths:
+        logger.warning(f"\nNo zip files of {level} for {day_date.strftime('%Y-%m-%d')}")
+    file_name = get_TROPOS_dataset_file_name(file_type=file_type)
+    with tempfile.TemporaryDirectory(dir=tmp_folder) as tmp_dir:
+        nc_paths = []
+        for zip_path in zip_paths:
+            with ZipFile(zip_path) as zip_file:
+                for member in zip_file.infolist():
+                    member_name = os.path.basename(member.filename)
+                    if member.is_dir() or not fnmatch(member_name, file_name):
+                        continue
+                    nc_path = os.path.join(tmp_dir, member_name)
+                    if nc_path in nc_paths:
+                        # the same file in several archives (or folders of an archive) is streamed once
+                        logger.warning(f"\nSkipping {member.filename} of {zip_path}, a file named {member_name} "
+                                       f"was already streamed")
+                        continue
+                    with zip_file.open(member) as src_file, open(nc_path, 'wb') as dst_file:
+                        shutil.copyfileobj(src_file, dst_file)
+                    nc_paths.append(nc_path)
+        logger.debug(f"\nStreamed {len(nc_paths)} files of {level} from {zip_paths}")
+        yield sorted(nc_paths)
+
+
 def get_range_corr_ds_chan(darray: xr.DataArray, altitude: float, lambda_nm: int, use_km_units: bool = True,
                            optim_size: bool = False, verbose: bool = False):
     """
@@ -625,7 +692,7 @@ def gen_daily_molecular_ds(day_date: date):
 
 
 def get_daily_range_corr(station: gs.Station, day_date: date, use_km_units: bool = True,
-                         optim_size: bool = False, verbose: bool = False):
+                         optim_size: bool = False, verbose: bool = False, nc_paths: list[os.path] = None):
     """
     Retrieving daily range corrected lidar signal (pr^2) from 'level1a' data by Pollynet Processing chain.
     The range corrected signal is represented by 'att_bsc' (aka attenuated backscatter coefficient) in the source data,
@@ -638,6 +705,8 @@ def get_daily_range_corr(station: gs.Station, day_date: date, use_km_units: bool
     :param optim_size: Boolean. False(default): the retrieved values are of type 'float64',
                                 True: the retrieved values are of type 'float'.
     :param verbose: Boolean. False(default). True: prints information regarding size optimization.
+    :param nc_paths: Optional. Paths to the '*att_bsc.nc' files of the day (e.g., by extract_TROPOS_zip_members()).
+    Default is None, for searching the files in station.lidar_src_calib_folder.
     :return: xarray.Dataset() a daily range corrected lidar signal, holding 5 data variables:
              1 daily dataset of range_corrected signal in 3 channels, with dimensions of : Height, Time, Wavelength
              3 variables : lambda_nm, plot_min_range, plot_max_range, with dimension of : Wavelength
@@ -648,7 +717,8 @@ def get_daily_range_corr(station: gs.Station, day_date: date, use_km_units: bool
     logger = logging.getLogger()
     date_datetime = datetime.combine(date=day_date, time=time.min) if isinstance(day_date, date) else day_date
 
-    bsc_paths = get_TROPOS_dataset_paths(station, date_datetime, file_type='att_bsc', level='level1a')
+    bsc_paths = nc_paths if nc_paths is not None else \
+        get_TROPOS_dataset_paths(station, date_datetime, file_type='att_bsc', level='level1a')
     if len(bsc_paths) > 4:
         logger.info(f"Found more than four '*_att_bsc.nc' files for Station"
                     f" name:{station.name} date: {day_date}. Taking the four most newest ones.")
@@ -692,13 +762,168 @@ def get_daily_range_corr(station: gs.Station, day_date: date, use_km_units: bool
     return range_corr_ds
 
 
+def get_range_corr_block(ds: xr.Dataset, use_km_units: bool = True) -> (pd.DatetimeIndex, np.ndarray, dict):
+    """
+    Getting the range corrected signal (LC * att_bsc) of a 6-hours '*att_bsc.nc' file of 'level1a'.
+    If ds was opened with chunks, the returned signals are lazy (dask) arrays.
+    :param ds: xr.Dataset of the '*att_bsc.nc' file
+    :param use_km_units: Boolean flag, to set the scale of units of the output data ,True - km units, False - meter units
+    :return: times - pd.DatetimeIndex of the file's time bins,
+             heights - np.array of the heights above sea level,
+             signals - dict of {wavelength: array of the range corrected signal with dimensions of : height, time}
+    """
+    scale = 1e-3 if use_km_units else 1
+    altitude = np.atleast_1d(ds.altitude.values)[0]
+    heights = scale * (ds.height.values + altitude)
+    times = pd.to_datetime(np.round(ds.time.values), unit='s')
+    signals = {}
+    for dvar in [v for v in ds.data_vars if 'attenuated_backscatter' in v]:
+        wavelength = int(dvar.split(sep='_')[-1].strip('nm'))
+        darray = ds.get(dvar)
+        LC = darray.attrs['Lidar_calibration_constant_used']
+        signals[wavelength] = (LC * scale ** 2) * darray.transpose(*reversed(darray.dims)).data
+    return times, heights, signals
+
+
+def assemble_daily_range_corr(station: gs.Station, day_date: date, use_km_units: bool = True,
+                              optim_size: bool = False, chunks: dict = None, parallel: bool = True,
+                              min_coverage: float = 0.0, nc_paths: list[os.path] = None) -> xr.Dataset:
+    """
+    Retrieving daily range corrected lidar signal (pr^2) from 'level1a' data by Pollynet Processing chain.
+    This is an alternative to get_daily_range_corr(), having the same output.
+    All '*att_bsc.nc' files of the day are opened lazily with the given chunks, read together by dask
+    (in parallel threads), and their time bins are placed into one contiguous array of (Wavelength, Height, Time).
+    Instead of limiting the number of files, the time coverage is checked: time bins outside the day are ignored,
+    time bins covered by more than one file are taken from the first file (by sorted name),
+    and time bins not covered by any file are filled with zeros.
+
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.date object of the required date
+    :param use_km_units: Boolean flag, to set the scale of units of the output data ,True - km units, False - meter units
+    :param optim_size: Boolean. False(default): the retrieved values are of type 'float64',
+                                True: the retrieved values are of type 'float'.
+    :param chunks: dict of chunks sizes used to open the files. Default is one chunk per file: {'time': -1, 'height': -1}
+    :param parallel: Boolean. True(default): read the files in parallel threads.
+    :param min_coverage: The minimal fraction of the daily time bins that should be covered by the files.
+                        A warning is logged if the coverage is lower.
+    :param nc_paths: Optional. Paths to the '*att_bsc.nc' files of the day (e.g., by extract_TROPOS_zip_members()).
+    Default is None, for searching the files in station.lidar_src_calib_folder.
+    :return: xarray.Dataset() a daily range corrected lidar signal, holding 3 data variables:
+             1 daily dataset of range_corrected signal in 3 channels, with dimensions of : Wavelength, Height, Time
+             1 variable : lambda_nm, with dimension of : Wavelength
+             1 shared variable: date
+    """
+    logger = logging.getLogger()
+    date_datetime = datetime.combine(date=day_date, time=time.min) if isinstance(day_date, date) else day_date
+    day_str = date_datetime.strftime('%Y-%m-%d')
+
+    bsc_paths = nc_paths if nc_paths is not None else \
+        get_TROPOS_dataset_paths(station, date_datetime, file_type='att_bsc', level='level1a')
+    if not bsc_paths:
+        raise FileNotFoundError(f"No '*_att_bsc.nc' files for Station name:{station.name} date: {day_str}")
+    chunks = chunks if chunks else {'time': -1, 'height': -1}
+
+    wavelengths = gs.LAMBDA_nm().get_elastic()
+    time_indx = station.calc_daily_time_index(date_datetime)
+    covered = np.zeros(len(time_indx), dtype=bool)
+    range_corr, heights = None, None
+
+    datasets = [xr.open_dataset(bsc_path, engine='netcdf4', chunks=chunks, cache=False) for bsc_path in bsc_paths]
+    try:
+        blocks = [get_range_corr_block(ds, use_km_units=use_km_units) for ds in datasets]
+        blocks, = dask.compute(blocks, scheduler='threads' if parallel else 'synchronous')
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    for bsc_path, (times, file_heights, signals) in zip(bsc_paths, blocks):
+        if range_corr is None:
+            heights = file_heights
+            range_corr = np.zeros([len(wavelengths), len(heights), len(time_indx)],
+                                  dtype=np.float32 if optim_size else np.float64)
+        elif (file_heights.shape != heights.shape) or not np.allclose(file_heights, heights):
+            logger.warning(f"\nIgnoring {bsc_path}, its heights differ from the first file of {day_str}")
+            continue
+
+        time_inds = time_indx.get_indexer(times)
+        in_day = time_inds >= 0
+        new_bins = in_day.copy()
+        new_bins[in_day] = ~covered[time_inds[in_day]]
+        if (~in_day).any():
+            logger.debug(f"\n{(~in_day).sum()} time bins of {bsc_path} are not in the daily time index")
+        if in_day.sum() > new_bins.sum():
+            logger.debug(f"\n{in_day.sum() - new_bins.sum()} time bins of {bsc_path} are already covered")
+
+        for chan_ind, wavelength in enumerate(wavelengths):
+            if wavelength in signals:
+                range_corr[chan_ind][:, time_inds[new_bins]] = signals[wavelength][:, new_bins]
+        covered[time_inds[new_bins]] = True
+
+    coverage = covered.mean()
+    logger.debug(f"\nTime coverage of range corrected signal for {day_str}: {100 * coverage:.2f}% "
+                 f"({len(bsc_paths)} files)")
+    if coverage < min_coverage:
+        logger.warning(f"\nLow time coverage of range corrected signal for {day_str}: {100 * coverage:.2f}%")
+
+    height_units = 'km' if use_km_units else 'm'
+    range_corr_ds = xr.Dataset(
+        data_vars={'range_corr': (('Wavelength', 'Height', 'Time'), range_corr),
+                   'lambda_nm': ('Wavelength', wavelengths)},
+        coords={'Wavelength': wavelengths,
+                'Height': heights,
+                'Time': time_indx})
+    range_corr_ds.range_corr.attrs = {'long_name': 'Estimated RCS',
+                                      'units': r'$\rm photons$' + r'$\cdot$' + fr'${height_units}^2$',
+                                      'info': "PollyNet estimated RSC lidar signal",
+                                      'source_type': "Multiplying the estimated attenuated backscatter and LC"
+                                                     r": $LC \cdot \beta \cdot \exp(-2\tau)$"}
+    range_corr_ds.Height.attrs = {'units': fr'$\rm {height_units}$',
+                                  'info': 'Measurements heights above sea level'}
+    range_corr_ds.Wavelength.attrs = {'long_name': r'$\lambda$', 'units': r'$\rm nm$'}
+    range_corr_ds = range_corr_ds.assign_attrs({'station': station.name,
+                                                'location': station.location,
+                                                'info': 'Estimated daily range corrected lidar signal',
+                                                'source_type': "PollNet output files named by: '<DATE>_<PollyNet "
+                                                               "STATION>_<MEASUREMENT START TIME>_att_bsc.nc'"})
+    range_corr_ds['date'] = date_datetime
+
+    return range_corr_ds
+
+
+def read_raw_lidar_block(nc_path: str, channel_ids: list, height_slice: slice,
+                         profile: str = 'raw_signal') -> np.ndarray:
+    """
+    Reading a block of raw lidar signal from a level0 PollyNet file.
+    The file is opened lazily, and only the required channels and height bins are read from disk.
+
+    :param nc_path: path to a level0 *.nc file
+    :param channel_ids: list of channel indexes to read, e.g. gs.CHANNELS().get_elastic()
+    :param height_slice: slice object of height bins indexes to read
+    :param profile: name of the variable to read. Default is 'raw_signal'
+    :return: np.array of the raw signal, with dimensions of : channel, height, time
+    """
+    logger = logging.getLogger()
+    try:
+        with xr.open_dataset(nc_path, engine='netcdf4', cache=False) as cur_ds:
+            darray = cur_ds[profile].isel(channel=channel_ids, height=height_slice)
+            # Reversing the stored dimensions (as transpose() does) to get: channel, height, time
+            block = darray.transpose(*reversed(darray.dims)).values
+        logger.debug(f"\nReading raw signal block {block.shape} from: {nc_path}")
+    except Exception as e:
+        logger.exception(f"\nFailed to read raw signal from: {nc_path}")
+        raise e
+    return block
+
+
 def get_raw_lidar_signal(station: gs.Station, day_date: datetime, height_slice: slice, ds_attr: dict,
-                         use_km_units: bool) -> xr.Dataset:
+                         use_km_units: bool, nc_paths: list[os.path] = None) -> xr.Dataset:
     """
         Retrieving daily raw lidar signal (p / bg) from attenuated_backscatter signals in three channels
      (355,532,1064).
 
-    The attenuated_backscatter are from 4 files of 6-hours *.nc for a given day_date and station
+    The attenuated_backscatter are from 4 files of 6-hours *.nc for a given day_date and station.
+    Only the required channels and height bins are read from each file (see read_raw_lidar_block()),
+    and placed into a preallocated daily array. Missing time bins are filled with zeros.
 
     Height slice determines if it is background - slice(0, station.pt_bin) or
      p - slice(station.pt_bin, station.pt_bin + station.n_bins)
@@ -708,13 +933,17 @@ def get_raw_lidar_signal(station: gs.Station, day_date: datetime, height_slice:
     :param height_slice: slice object deterining the heights to keep
     :param ds_attr: dict, the attributes of the dataset
     :param use_km_units: datetime.date object of the required date
+    :param nc_paths: Optional. Paths to the level0 files of the day (e.g., by extract_TROPOS_zip_members()).
+    Default is None, for searching the files in station.lidar_src_folder.
     :return: xarray.Dataset() a daily raw lidar signal, holding 5 data variables:
              1 daily dataset of background or raw lidar signal in 3 channels,
              with dimensions of : Height, Time, Wavelength
              1 variables : lambda_nm, with dimension of : Wavelength
              1 shared variable: date
     """
-    raw_paths = get_TROPOS_dataset_paths(station, day_date, file_type=None, level='level0')
+    logger = logging.getLogger()
+    raw_paths = nc_paths if nc_paths is not None else \
+        get_TROPOS_dataset_paths(station, day_date, file_type=None, level='level0')
 
     profile = 'raw_signal'
     num_times = int(station.total_time_bins / 4)
@@ -722,37 +951,30 @@ def get_raw_lidar_signal(station: gs.Station, day_date: datetime, height_slice:
     wavelengths = gs.LAMBDA_nm().get_elastic()
     all_times = station.calc_daily_time_index(day_date)
     heights_ind = station.calc_height_index(USE_KM_UNITS=use_km_units)
-
-    dss = []
-    for part_of_day_indx, bsc_path in enumerate(raw_paths):
-        cur_ds = xr_utils.load_dataset(bsc_path)
-        # get 6-hours range corrected dataset for three channels [355,532,1064]
-        cur_darry = cur_ds.get(profile).transpose(transpose_coords=True)
-        times = list(all_times)[num_times * part_of_day_indx:num_times * (part_of_day_indx + 1)]
-
-        darray = cur_darry.sel(channel=channel_ids, height=height_slice)
-
-        ''' Create p dataset'''
-        # Validate that the input nc file has 720 time bins, otherwise puts zeros
-        nchans, nheights, ntimes = darray.values.shape
-        if ntimes < num_times:
-            new_data = np.zeros([nchans, nheights, num_times])
-            new_data[:, :, 0:ntimes] = darray.values
-        else:
-            new_data = darray.values
-        ds_partial = xr.Dataset(
-            data_vars={'p': (('Wavelength', 'Height', 'Time'), new_data)},
-            coords={'Height': heights_ind[:height_slice.stop - height_slice.start],
-                    'Time': times,
-                    'Wavelength': wavelengths})
-
-        dss.append(ds_partial)
-
-    # merge range corrected of lidar through 24-hours
-    ds = xr.merge(dss, compat='no_conflicts')
-
-    # Fixing missing timestamps values:
-    ds = ds.reindex({"Time": all_times}, fill_value=0)
+    num_heights = height_slice.stop - height_slice.start
+
+    data = None
+    for part_of_day_indx, raw_path in enumerate(raw_paths):
+        start_ind = num_times * part_of_day_indx
+        if start_ind >= len(all_times):
+            logger.warning(f"\nIgnoring {raw_path}, more than 4 level0 files found for {day_date.strftime('%Y-%m-%d')}")
+            continue
+        # get 6-hours raw signal for three channels [355,532,1064]
+        block = read_raw_lidar_block(raw_path, channel_ids, height_slice, profile)
+        if data is None:
+            data = np.zeros([len(channel_ids), num_heights, len(all_times)], dtype=block.dtype)
+        # Validate that the input nc file has 720 time bins, otherwise the missing bins remain zeros
+        ntimes = min(block.shape[-1], num_times)
+        data[:, :, start_ind:start_ind + ntimes] = block[:, :, 0:ntimes]
+
+    if data is None:
+        data = np.zeros([len(channel_ids), num_heights, len(all_times)])
+
+    ds = xr.Dataset(
+        data_vars={'p': (('Wavelength', 'Height', 'Time'), data)},
+        coords={'Height': heights_ind[:num_heights],
+                'Time': all_times,
+                'Wavelength': wavelengths})
 
     ds.p.attrs = ds_attr
     ds.Height.attrs = {'units': r'$\rm km$', 'info': 'Measurements heights above sea level'}
@@ -764,7 +986,7 @@ def get_raw_lidar_signal(station: gs.Station, day_date: datetime, height_slice:
 
 
 def get_daily_raw_measurements(station: gs.Station, day_date: Union[datetime.date, datetime],
-                               use_km_units: bool = True) -> xr.Dataset:
+                               use_km_units: bool = True, nc_paths: list[os.path] = None) -> xr.Dataset:
     """
     Retrieving daily range corrected lidar signal (pr^2), background and raw lidar signal
      from attenuated_backscatter signals in three channels (355,532,1064).
@@ -772,6 +994,8 @@ def get_daily_raw_measurements(station: gs.Station, day_date: Union[datetime.dat
     :param station: gs.station() object of the lidar station
     :param day_date: datetime.date object of the required date
     :param use_km_units: whether to use km units or not. If False  uses 'm'
+    :param nc_paths: Optional. Paths to the level0 files of the day (e.g., by extract_TROPOS_zip_members()).
+    Default is None, for searching the files in station.lidar_src_folder.
     :return: xarray.Dataset() a daily range corrected lidar signal, holding 5 data variables:
              3 daily datasets of range_corrected signal, background and raw lidar signal in 3 channels,
              with dimensions of : Height, Time, Wavelength
@@ -790,7 +1014,8 @@ def get_daily_raw_measurements(station: gs.Station, day_date: Union[datetime.dat
                                  day_date=day_date,
                                  height_slice=slice(station.pt_bin, station.pt_bin + station.n_bins),
                                  ds_attr=pn_ds_attr,
-                                 use_km_units=use_km_units)
+                                 use_km_units=use_km_units,
+                                 nc_paths=nc_paths)
 
     # Raw Background Measurement Dataset
     bg_ds_attr = {'info': 'Raw Background Measurement',
@@ -801,7 +1026,8 @@ def get_daily_raw_measurements(station: gs.Station, day_date: Union[datetime.dat
                                  day_date=day_date,
                                  height_slice=slice(0, station.pt_bin),
                                  ds_attr=bg_ds_attr,
-                                 use_km_units=use_km_units)
+                                 use_km_units=use_km_units,
+                                 nc_paths=nc_paths)
 
     bg_mean = bg_ds.mean(dim='Height', keep_attrs=True)
     p_bg = bg_mean.p.broadcast_like(pn_ds.p)
@@ -830,3 +1056,147 @@ def get_daily_raw_measurements(station: gs.Station, day_date: Union[datetime.dat
                       'source_file': os.path.basename(__file__)}
 
     return lidar_ds
+
+
+def get_daily_lidar_ds_path(station: gs.Station, day_date: datetime, level: str = 'level1a') -> os.path:
+    """
+    Retrieves the path of a daily lidar dataset saved by gen_daily_lidar_ds()
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.datetime object of the required date
+    :param level: 'level1a' - for range corrected signal by PollyNet, or 'level0' - for raw measurements
+    :return: path to the netcdf file of the daily lidar dataset
+    """
+    month_folder = xr_utils.get_prep_month_folder(station, day_date, data_source='lidar', level=level)
+    file_name = xr_utils.get_prep_dataset_file_name(station, day_date, data_source='lidar',
+                                                    lambda_nm='all', file_type='all')
+    return os.path.join(month_folder, file_name)
+
+
+def get_daily_lidar_ds(station: gs.Station, day_date: datetime, level: str = 'level1a', use_km_units: bool = True,
+                       assemble_range_corr: bool = False, nc_paths: list[os.path] = None) -> xr.Dataset:
+    """
+    Retrieving a daily lidar dataset.
+    For level='level1a' the dataset is the range corrected signal of PollyNet (see get_daily_range_corr()),
+    for level='level0' the dataset holds the raw measurements (see get_daily_raw_measurements()).
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.datetime object of the required date
+    :param level: 'level1a' or 'level0'
+    :param use_km_units: Boolean flag, to set the scale of units of the output data ,True - km units, False - meter units
+    :param assemble_range_corr: If True, the range corrected signal is retrieved by assemble_daily_range_corr()
+    instead of get_daily_range_corr() (relevant for level='level1a')
+    :param nc_paths: Optional. Paths to the source files of the day. Default is None, for searching the TROPOS folders.
+    :return: xarray.Dataset() of the daily lidar dataset
+    """
+    if level == 'level1a' and assemble_range_corr:
+        lidar_ds = assemble_daily_range_corr(station, day_date, use_km_units=use_km_units,
+                                             optim_size=False, nc_paths=nc_paths)
+    elif level == 'level1a':
+        lidar_ds = get_daily_range_corr(station, day_date, use_km_units=use_km_units,
+                                        optim_size=False, verbose=False, nc_paths=nc_paths)
+    elif level == 'level0':
+        # TODO delete the raw separated lidar measurements after creating the merge dataset
+        lidar_ds = get_daily_raw_measurements(station, day_date, use_km_units=use_km_units, nc_paths=nc_paths)
+    else:
+        raise ValueError(f"Unsupported level: {level}. Should be 'level1a' or 'level0'.")
+    return lidar_ds
+
+
+def gen_daily_lidar_ds(station: gs.Station, day_date: date, level: str = 'level1a', use_km_units: bool = True,
+                       overwrite: bool = False, assemble_range_corr: bool = False, from_zip: bool = False,
+                       tmp_folder: Union[os.path, None] = None) -> dict:
+    """
+    Generating and saving a daily lidar dataset (see get_daily_lidar_ds()).
+    Failures are caught and reported, such that a failing day does not stop the generation of other days.
+    :param station: gs.station() object of the lidar station
+    :param day_date: datetime.date object of the required date
+    :param level: 'level1a' or 'level0'
+    :param use_km_units: Boolean flag, to set the scale of units of the output data ,True - km units, False - meter units
+    :param overwrite: If False (default), days having an existing dataset are skipped.
+    :param assemble_range_corr: If True, the range corrected signal is retrieved by assemble_daily_range_corr()
+    instead of get_daily_range_corr() (relevant for level='level1a')
+    :param from_zip: If True, the source files are streamed from the TROPOS zip archives of the day
+    (see extract_TROPOS_zip_members()), instead of reading the extracted files.
+    :param tmp_folder: Optional. Folder for the temporary files streamed from the zip archives.
+    :return: dict with the report of the day: 'date', 'level', 'status' ('done' | 'skipped' | 'failed'),
+    'paths' (the saved paths) and 'error' (the error message, in case of failure).
+    """
+    logger = logging.getLogger()
+    date_datetime = datetime.combine(date=day_date, time=time.min) if isinstance(day_date, date) else day_date
+    report = {'date': date_datetime.strftime('%Y-%m-%d'), 'level': level, 'status': 'done', 'paths': [], 'error': ''}
+
+    nc_path = get_daily_lidar_ds_path(station, date_datetime, level)
+    if not overwrite and os.path.exists(nc_path):
+        logger.debug(f"\nSkipping {report['date']}, the lidar dataset already exists: {nc_path}")
+        report.update({'status': 'skipped', 'paths': [nc_path]})
+        return report
+
+    try:
+        src_context = extract_TROPOS_zip_members(station, date_datetime,
+                                                 file_type='att_bsc' if level == 'level1a' else None,
+                                                 level=level, tmp_folder=tmp_folder) if from_zip else nullcontext()
+        with src_context as src_paths:
+            lidar_ds = get_daily_lidar_ds(station, date_datetime, level=level, use_km_units=use_km_units,
+                                          assemble_range_corr=assemble_range_corr, nc_paths=src_paths)
+            ncpaths = xr_utils.save_prep_dataset(station, lidar_ds, data_source='lidar', level=level,
+                                                 save_mode='single',
+                                                 profiles=['range_corr'] if level == 'level1a' else None)
+            # Releasing the source files (that may be temporary files)
+            lidar_ds.close()
+        if not ncpaths:
+            raise IOError(f"Failed saving the lidar dataset to: {nc_path}")
+        report['paths'] = ncpaths
+    except Exception as e:
+        logger.exception(f"\nFailed generating {level} lidar dataset for {report['date']}")
+        report.update({'status': 'failed', 'error': repr(e)})
+    return report
+
+
+def gen_periodic_lidar_ds(station: gs.Station, days: list, level: str = 'level1a', use_km_units: bool = True,
+                          num_workers: int = None, overwrite: bool = False,
+                          report_path: os.path = None, assemble_range_corr: bool = False,
+                          from_zip: bool = False, tmp_folder: Union[os.path, None] = None) -> pd.DataFrame:
+    """
+    Generating and saving daily lidar datasets for a list of days, using a pool of num_workers processes.
+    Each day is handled by gen_daily_lidar_ds().
+    :param station: gs.station() object of the lidar station
+    :param days: list of datetime.date objects of the required days
+    :param level: 'level1a' or 'level0'. See gen_daily_lidar_ds()
+    :param use_km_units: Boolean flag, to set the scale of units of the output data ,True - km units, False - meter units
+    :param num_workers: number of processes. None (default) - the number of cpu-s minus one, 1 - no multiprocessing.
+    :param overwrite: If False (default), days having an existing dataset are skipped.
+    :param report_path: Optional. Path to a csv file to save the report of the failed days.
+    :param assemble_range_corr: See gen_daily_lidar_ds()
+    :param from_zip: See gen_daily_lidar_ds()
+    :param tmp_folder: See gen_daily_lidar_ds()
+    :return: pd.DataFrame() - the report of all days (see gen_daily_lidar_ds())
+    """
+    logger = logging.getLogger()
+    if not days:
+        logger.info(f"\nNo days to generate {level} lidar datasets for.")
+        return pd.DataFrame(columns=['date', 'level', 'status', 'paths', 'error'])
+    if num_workers is None:
+        num_workers = cpu_count() - 1
+    num_workers = max(1, min(num_workers, len(days)))
+
+    daily_func = partial(gen_daily_lidar_ds, station, level=level, use_km_units=use_km_units, overwrite=overwrite,
+                         assemble_range_corr=assemble_range_corr, from_zip=from_zip, tmp_folder=tmp_folder)
+    desc = f"Generating {level} lidar datasets"
+    if num_workers > 1:
+        with Pool(num_workers) as p:
+            reports = list(tqdm(p.imap_unordered(daily_func, days), total=len(days), desc=desc))
+    else:
+        reports = [daily_func(day_date) for day_date in tqdm(days, desc=desc)]
+
+    report_df = pd.DataFrame(reports).sort_values(by='date', ignore_index=True)
+    status_counts = report_df.status.value_counts()
+    logger.info(f"\nDone {level} lidar datasets: {status_counts.get('done', 0)} generated, "
+                f"{status_counts.get('skipped', 0)} skipped (already exist), {status_counts.get('failed', 0)} failed.")
+
+    failed_df = report_df[report_df.status == 'failed']
+    if not failed_df.empty:
+        logger.warning(f"\nFailed days: {failed_df.date.tolist()}")
+        if report_path:
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+            failed_df.to_csv(report_path, index=False)
+            logger.warning(f"\nThe report of failed days saved to: {report_path}")
+    return report_df
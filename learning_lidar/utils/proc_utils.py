@@ -1,6 +1,7 @@
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy.interpolate import griddata
+from scipy.linalg import solve_banded
 
 
 def smooth(x, window_len=11, window='hanning'):
@@ -162,6 +163,70 @@ class Bezier:
         total_path = np.append(path, last_section, axis=0)
         return total_path
 
+    @staticmethod
+    def _get_bezier_coef_banded(points):
+        """
+        Same as _get_bezier_coef(), for a batch of curves.
+        The system is tridiagonal, hence it is solved with a banded solver, for all the curves at once.
+        :param points: np.ndarray of shape (..., n+1, d) - the n+1 points of each curve
+        :return: A, B - np.ndarrays of shape (..., n, d)
+        """
+        points = np.asarray(points, dtype=float)
+        n = points.shape[-2] - 1
+
+        # build the diagonals of the coefficients matrix (upper, main, lower)
+        ab = np.zeros((3, n))
+        ab[0, 1:] = 1
+        ab[1, :] = 4
+        ab[2, :-1] = 1
+        ab[1, 0] = 2
+        if n > 1:
+            ab[1, n - 1] = 7
+            ab[2, n - 2] = 2
+
+        # build points vectors
+        P = 2 * (2 * points[..., :-1, :] + points[..., 1:, :])
+        P[..., 0, :] = points[..., 0, :] + 2 * points[..., 1, :]
+        P[..., n - 1, :] = 8 * points[..., n - 1, :] + points[..., n, :]
+
+        # solve system for all curves, find a & b
+        P_cols = np.moveaxis(P, -2, 0).reshape(n, -1)
+        A = np.moveaxis(solve_banded((1, 1), ab, P_cols).reshape((n,) + P.shape[:-2] + P.shape[-1:]), 0, -2)
+        B = np.empty_like(A)
+        B[..., :-1, :] = 2 * points[..., 1:n, :] - A[..., 1:, :]
+        B[..., n - 1, :] = (A[..., n - 1, :] + points[..., n, :]) / 2
+
+        return A, B
+
+    @staticmethod
+    def _get_bernstein_basis(n):
+        """
+        :param n: number of points on the range [0, 1]
+        :return: np.ndarray of shape (n, 4) of the cubic Bernstein polynomials at n points on the range [0, 1]
+        """
+        t = np.linspace(0, 1, n)[:, np.newaxis]
+        return np.hstack([np.power(1 - t, 3), 3 * np.power(1 - t, 2) * t, 3 * (1 - t) * np.power(t, 2),
+                          np.power(t, 3)])
+
+    @staticmethod
+    def fast_evaluate_bezier(points, n):
+        """
+        Same as evaluate_bezier(), for a single curve or a batch of curves.
+        All the sections of all the curves are evaluated as one broadcasted polynomial.
+        :param points: np.ndarray of shape (n_points, d), or (..., n_points, d) for a batch of curves
+        :param n: number of points to evaluate each section on the range [0, 1]
+        :return: np.ndarray of shape (..., (n_points - 1) * n + 1, d)
+        """
+        points = np.asarray(points, dtype=float)
+        A, B = Bezier._get_bezier_coef_banded(points)
+        # control points of each section: (..., n_sections, 4, d)
+        controls = np.stack([points[..., :-1, :], A, B, points[..., 1:, :]], axis=-2)
+        path = np.einsum('tk,...skd->...std', Bezier._get_bernstein_basis(n), controls[..., :-1, :, :])
+        path = path.reshape(path.shape[:-3] + (-1,) + path.shape[-1:])
+        last_section = np.einsum('tk,...kd->...td', Bezier._get_bernstein_basis(n + 1), controls[..., -1, :, :])
+        total_path = np.concatenate([path, last_section], axis=-2)
+        return total_path
+
     @staticmethod
     def bezier_example_usage():
         # generate 5 (or any number that you want) random points that we want to fit (or set them yourself)